@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+#
+# Asyncio engine: run the snapshot collectors in a single event loop,
+# overlapping the cassandra requests of every table
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from metrics import TaskMetrics
+from snapshot import SnapshotCollector, TickStats
+from writer import BatchWriter, WriteError, batch_of
+
+
+def wrap_future(response_future, loop:asyncio.AbstractEventLoop) -> asyncio.Future:
+    """
+    Asyncio future resolved by a cassandra-driver ResponseFuture
+    """
+    future = loop.create_future()
+
+    def set_result(rows):
+        if not future.done():
+            future.set_result(rows)
+
+    def set_exception(error):
+        if not future.done():
+            future.set_exception(error)
+
+    # driver callbacks run in its event loop thread
+    response_future.add_callbacks(lambda rows: loop.call_soon_threadsafe(set_result, rows),
+                                  lambda error: loop.call_soon_threadsafe(set_exception, error))
+    return future
+
+
+class AsyncBatchWriter(BatchWriter):
+    """
+    BatchWriter whose flush is a coroutine, the in-flight requests can be
+    capped by a semaphore shared by several writers
+    """
+    def __init__(self, session = None, max_in_flight:int = 1024, slots:asyncio.Semaphore = None):
+        super().__init__(session, max_in_flight)
+        self._async_slots = slots or asyncio.Semaphore(max_in_flight)
+
+    async def _send_async(self, group, statements, loop, failed:list):
+        async with self._async_slots:
+            try:
+                statement, params = batch_of(statements, group[0]._has_counter)
+                await wrap_future(self.session.execute_async(statement, params), loop)
+            except Exception as error:
+                logging.error(f"Unable to write {group[0].__name__} {group[1]}: {error}")
+                failed.append(group)
+
+    async def flush(self):
+        """
+        Send every pending write and wait until all of them were acknowledged
+        """
+        pending, self._pending = self._pending, OrderedDict()
+        loop = asyncio.get_running_loop()
+
+        failed = []
+        await asyncio.gather(*(self._send_async(group, statements, loop, failed)
+                               for group, statements in pending.items()))
+        if failed:
+            raise WriteError(f"{len(failed)} writes failed", failed)
+
+
+class AsyncSnapshotCollector:
+    """
+    Run a SnapshotCollector in an event loop: writes are awaited, and what
+    would block the loop is offloaded to a thread executor (pyslurm calls,
+    the diff, the staging of the writes, which may prepare statements, and
+    the commit, which may save a checkpoint). The diff and the shadow copy
+    are the ones of the blocking collector
+    """
+    def __init__(self, collector:SnapshotCollector, executor:ThreadPoolExecutor = None):
+        if not isinstance(collector.writer, AsyncBatchWriter):
+            raise TypeError("The writer of an async collector must be an AsyncBatchWriter")
+
+        self.collector = collector
+        self.executor = executor
+        self.name = collector.name
+
+    async def load(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.collector.load)
+
+    async def tick(self) -> TickStats:
+        collector = self.collector
+        loop = asyncio.get_running_loop()
+
+        metrics = collector.metrics
+
+        start = time.monotonic()
+        snapshot = await loop.run_in_executor(self.executor, collector.source)
+        fetched = time.monotonic()
+        changes = await loop.run_in_executor(self.executor, collector.diff, snapshot)
+        diffed = time.monotonic()
+
+        await loop.run_in_executor(self.executor, collector.stage, changes)
+        failed = set()
+        try:
+            await collector.writer.flush()
+        except WriteError as error:
+            failed = collector.failed_keys(error)
+        metrics.write.observe(time.monotonic() - diffed)
+
+        await loop.run_in_executor(self.executor, collector.commit, snapshot, changes, failed)
+
+        metrics.fetch.observe(fetched - start)
+        metrics.diff.observe(diffed - fetched)
+        return collector.report(snapshot, changes, failed, start)
+
+    async def run(self, period:float):
+        """
+        Collect on fixed-rate ticks, skipping the ticks missed on overruns
+        """
+        loop = asyncio.get_running_loop()
+        metrics = TaskMetrics(f"{self.name}_collector")
+        await self.load()
+        try:
+            next_tick = loop.time()
+            while True:
+                metrics.lag.set(loop.time() - next_tick)
+                try:
+                    await self.tick()
+                except Exception as error:
+                    metrics.errors.inc()
+                    logging.error(f"{self.name}: {error}")
+
+                next_tick += period
+                now = loop.time()
+                if now > next_tick:
+                    missed = int((now - next_tick) // period) + 1
+                    metrics.overruns.inc()
+                    metrics.skipped.inc(missed)
+                    logging.warning(f"{self.name} overran its period ({period}s) by "
+                                    f"{now - next_tick:.3f}s, {missed} ticks skipped")
+                    next_tick += missed * period
+
+                await asyncio.sleep(next_tick - loop.time())
+        finally:
+            self.collector.close()
+
+
+async def run_collectors(collectors:List[Tuple[AsyncSnapshotCollector, float]]):
+    """
+    Run several async collectors (with their periods) concurrently
+    """
+    await asyncio.gather(*(collector.run(period) for collector, period in collectors))
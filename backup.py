@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 #
-# Perform a backup of all the tables in a keyspace in a json file
+# Perform a backup of all the tables in a keyspace in a (line-delimited) json file
 # Also this script load data in json script to DB
 #
 # Maintainer: glozanoa <glozanoa@uni.pe>
 
 import argparse
 from getpass import getpass
-import json
 
 
 # THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
@@ -15,14 +14,17 @@ from cassandra.cluster import Cluster
 from cassandra.cqlengine import connection
 from cassandra.cqlengine.management import sync_table
 from cassandra.auth import PlainTextAuthProvider
-from cassandra.util import OrderedMapSerializedKey
 
 # importing tables
-from tables import (
-    Jobs,
-    Partitions,
-    Nodes
+from tables import TABLES
+
+from exporter import (
+    COMPRESSIONS,
+    export_keyspace,
+    export_parallel,
+    retry_parallel
 )
+from loader import BulkLoader, read_restore
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -31,7 +33,21 @@ if __name__ == "__main__":
     parser.add_argument('--hosts', default=["127.0.0.1"], nargs='+', 
                     help='Hostname or IP4 of cassandra DB server')
     parser.add_argument('--load', action='store_true', help="Load data of json file to keyspace's tables")
-    parser.add_argument('data', help="Json file to backup keyspace or to load data to keyspace's tables")
+    parser.add_argument('--fetch-size', type=int, default=1000, help='Rows fetched per page during a backup')
+    parser.add_argument('--compress', choices=COMPRESSIONS,
+                        help='Compression of the backup file (by default given by its extension: .gz, .zst)')
+    parser.add_argument('-p', '--parallel', type=int,
+                        help='Export the token ranges of each table with a pool of PARALLEL processes '
+                             '(data is then a directory of shards plus a manifest)')
+    parser.add_argument('--ranges', type=int, help='Token ranges per table of a parallel export (default: 4*PARALLEL)')
+    parser.add_argument('-i', '--incremental', metavar='PARENT',
+                        help='Parallel export of the rows modified since the backup in the PARENT directory')
+    parser.add_argument('--retry', action='store_true',
+                        help='Export again the failed ranges of the parallel export in data')
+    parser.add_argument('-c', '--concurrency', type=int, default=100,
+                        help='Concurrent inserts while loading a backup')
+    parser.add_argument('data', help="Json file to backup keyspace or to load data to keyspace's tables "
+                                     "(json, line-delimited json or directory of a parallel export)")
 
     args = parser.parse_args()
 
@@ -41,62 +57,43 @@ if __name__ == "__main__":
         password = getpass(prompt=f"Password for {args.user} role: ")
 
         auth_provider = PlainTextAuthProvider(username=args.user, password=password)
-        cluster = Cluster(auth_provider=auth_provider)
+        cluster = Cluster(args.hosts, auth_provider=auth_provider)
         session = cluster.connect(args.keyspace)
 
-        if not args.load:
-            tables = [table.name for table in session.execute("DESCRIBE TABLES")]
-
-            keyspace_data = {}
-            for table in tables:
-                import pdb; pdb.set_trace()
-                print(f"[*] Performing a backup to {table} table")
-                keyspace_data[table] = []
-                rows = session.execute(f"select * from {args.keyspace}.{table}")
-                for row in rows:
-                    #print(f"row: {row}")
-                    row2dict = {}
-                    for key, value in row._asdict().items():
-                        if isinstance(value, OrderedMapSerializedKey):
-                            value = dict(value)      
-                        row2dict[key] = value
-                    keyspace_data[table].append(row2dict)
-
-            with open(args.data, 'w') as data_file:
-               json.dump(keyspace_data, data_file, indent=4)            
-
-            print(f"[+] Backup was saved to {args.data}")
-
-        else:
+        if not args.load and (args.parallel or args.retry or args.incremental):
+            if args.retry:
+                manifest = retry_parallel(args.data, args.hosts, args.user, password, args.parallel)
+            else:
+                manifest = export_parallel(session, args.keyspace, args.data, args.hosts, args.user, password,
+                                           args.parallel, args.ranges, fetch_size=args.fetch_size,
+                                           compression=args.compress or 'gzip', parent=args.incremental)
 
-            tables = {
-                "partitions": Partitions,
-                "nodes": Nodes,
-                "jobs": Jobs
-            }
+            failed = [shard for shard in manifest["shards"] if shard["status"] != "done"]
+            rows = sum(shard["rows"] for shard in manifest["shards"])
+            print(f"[+] {manifest['kind'].capitalize()} backup was saved to {args.data} "
+                  f"({rows} rows, {len(failed)} failed ranges, watermark: {manifest['watermark']})")
+            if failed:
+                print(f"[-] Retry the failed ranges with: --retry {args.data}")
 
-            keyspace_data = None
-            with open(args.data, 'r') as data_file:
-                keyspace_data = json.load(data_file)
+        elif not args.load:
+            counts = export_keyspace(session, args.keyspace, args.data,
+                                     fetch_size=args.fetch_size, compression=args.compress)
 
-            if keyspace_data:
-                connection.setup(args.hosts, args.keyspace, protocol_version=3, auth_provider=auth_provider)
+            print(f"[+] Backup was saved to {args.data} ({sum(counts.values())} rows)")
 
-                for table_name, rows in keyspace_data.items():
-                    #import pdb; pdb.set_trace()
-                    print(f"[*] Inserting {len(rows)} rows in {table_name} table")
+        else:
 
-                    model = tables[table_name]
-                    sync_table(model)
+            connection.setup(args.hosts, args.keyspace, protocol_version=3, auth_provider=auth_provider)
+            for model in TABLES.values():
+                sync_table(model)
 
-                    for data in rows: 
-                        purged_data = model.purge_args(**data)
-                        model.create(**purged_data)
+            loader = BulkLoader(session, TABLES, args.concurrency)
+            loaded = loader.load(read_restore(args.data, args.compress))
 
-                print("[+] The data of file {args.data} was successfully loaded in {args.keyspace} keyspace")
+            if not loaded and loader.failed:
+                raise Exception("Failed to load backup file")
 
-            else:
-                raise Exception("Failed to read backup file")
+            print(f"[+] The data of {args.data} was successfully loaded in {args.keyspace} keyspace")
 
     except Exception as error:
         if cluster:
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark: per-row cost of purging and diffing slurm data,
+# before (model instances, per call column lookup) and after (row codecs)
+#
+# Usage: python -m bench.codec_bench [-n ROUNDS] [--data test.json]
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import argparse
+import json
+import timeit
+
+# importing tables
+from tables import (
+    Jobs,
+    Partitions,
+    Nodes
+)
+from tables.jobs import STR_COLUMNS
+
+
+def legacy_purge_args(model, **kwargs):
+    cols = model().keys()
+    purged_args = {}
+    for name, value in kwargs.items():
+        if name in cols:
+            if model is Jobs and name in STR_COLUMNS:
+                value = str(value)
+            purged_args[name] = value
+
+    return purged_args
+
+
+def legacy_updated_columns(old, updated):
+    dict_old = dict(old)
+    dict_updated = dict(updated)
+
+    common_keys = set(dict_old.keys()).intersection(set(dict_updated))
+
+    updated_cols = {}
+    for key in common_keys:
+        if dict_old[key] != dict_updated[key]:
+            updated_cols[key] = dict_updated[key]
+
+    return updated_cols
+
+
+def per_row(func, rows, rounds:int) -> float:
+    """
+    Mean cost (microseconds) of calling func on each row
+    """
+    elapsed = timeit.timeit(lambda: [func(row) for row in rows], number=rounds)
+    return elapsed / (rounds * len(rows)) * 1e6
+
+
+def bench_table(model, rows, rounds:int):
+    codec = model.codec
+    # a changed copy of each row, so the diff has something to report
+    old_rows = [codec.extract(row) for row in rows]
+    new_rows = [dict(row, **{codec.columns[-1]: None}) for row in old_rows]
+    pairs = list(zip(old_rows, new_rows))
+    old_models = [model(**row) for row in old_rows]
+    model_pairs = list(zip(old_models, new_rows))
+
+    results = [
+        ("purge  (before)", per_row(lambda row: legacy_purge_args(model, **row), rows, rounds)),
+        ("purge  (after)", per_row(codec.extract, rows, rounds)),
+        ("diff   (before)", per_row(lambda pair: legacy_updated_columns(pair[0], model(**pair[1])), model_pairs, rounds)),
+        ("diff   (after)", per_row(lambda pair: codec.diff(*pair), pairs, rounds)),
+    ]
+
+    print(f"{model.__name__} ({len(codec.columns)} columns, {len(rows)} rows)")
+    for name, cost in results:
+        print(f"    {name:<16} {cost:10.2f} us/row")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rounds', type=int, default=2000, help='Rounds per measure')
+    parser.add_argument('--data', default='test.json', help='Json file with sample rows (backup.py layout)')
+
+    args = parser.parse_args()
+
+    with open(args.data, 'r') as data_file:
+        samples = json.load(data_file)
+
+    for table_name, model in [("jobs", Jobs), ("nodes", Nodes), ("partitions", Partitions)]:
+        bench_table(model, samples[table_name], args.rounds)
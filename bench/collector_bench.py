@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+#
+# Collector benchmark: run jobs_collector, nodes_collector and
+# partitions_collector against a synthetic slurm (bench/fakeslurm.py)
+# and an in-memory session (bench/fakedb.py), in polling or snapshot mode
+# (tracking rows by copy or by fingerprint index, or writing them through
+# a write-behind queue)
+#
+# Reports ticks/s and p50/p99 latency of the steady-state ticks (the first
+# tick inserts the whole population and is reported apart), the database
+# operations per tick and the peak RSS. Each run is made in its own
+# process, so peak RSS is the one of a single population size
+#
+# Usage: python -m bench.collector_bench [--jobs 1000 10000 100000 1000000]
+#                                        [--mode polling snapshot] [--save FILE] [--compare FILE]
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import sys
+import json
+import time
+import logging
+import resource
+import argparse
+import subprocess
+from typing import List
+
+from bench.fakeslurm import FakeSlurm
+
+COLLECTORS = ['jobs', 'nodes', 'partitions']
+MODES = ['polling', 'snapshot', 'index', 'writebehind']
+
+
+class BenchDone(Exception):
+    pass
+
+
+def peak_rss() -> float:
+    """
+    Peak resident set size of this process (MB)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def percentile(values:List[float], q:float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+class TickProbe:
+    """
+    Tick boundaries of a collector, given by its polls of slurm (ids()
+    in polling mode, get() in snapshot mode): the cluster advances, the
+    tick latency and the database operations of the last tick are kept
+    """
+    def __init__(self, cluster:FakeSlurm, entity:str, ticks:int):
+        self.cluster = cluster
+        self.entity = entity
+        self.ticks = ticks
+        self.session = None
+        self.latencies = []
+        self.ops = []
+        self._start = None
+        self._ops_start = None
+
+    def poll(self, entity:str):
+        if entity != self.entity:
+            return
+
+        now = time.perf_counter()
+        if self._start is not None:
+            self.latencies.append(now - self._start)
+            self.ops.append(self.session.stats - self._ops_start)
+        if len(self.latencies) > self.ticks:
+            raise BenchDone()
+
+        self.cluster.advance()
+        self._ops_start = self.session.stats.copy()
+        self._start = time.perf_counter()
+
+
+def run_collector(config:dict) -> dict:
+    """
+    Run a collector for the ticks of config and measure it
+    (imports collector, so it must run in a fresh process)
+    """
+    # the other entities are only referenced by the benchmarked ones
+    populations = {'jobs': 0, 'nodes': 16, 'partitions': 4}
+    populations[config["collector"]] = config["size"]
+    cluster = FakeSlurm(populations['jobs'], populations['nodes'], populations['partitions'],
+                        churn=config["churn"], seed=config["seed"], samples=config["samples"])
+
+    entity = config["collector"][:-1]
+    probe = TickProbe(cluster, entity, config["ticks"])
+    cluster.install(probe.poll)
+
+    from bench.fakedb import FakeSession
+    from tables import TABLES
+
+    probe.session = FakeSession(TABLES.values(), latency=config.get("db_latency", 0)).connect()
+
+    import collector
+    # schema management isn't part of a tick
+    collector.sync_table = lambda *args, **kwargs: None
+    if not config["log"]:
+        logging.disable(logging.INFO)
+
+    rss_setup = peak_rss()
+    try:
+        if config["mode"] != 'polling':
+            model = TABLES[config["collector"]]
+            collector.snapshot_collector('bench', model, index=config["mode"] == 'index',
+                                         write_behind=config["mode"] == 'writebehind').run(0)
+        else:
+            tick = getattr(collector, f"{config['collector']}_collector")('bench', 0)
+            while True:
+                tick()
+    except BenchDone:
+        pass
+
+    # the first tick inserts every row of the population
+    first, steady = probe.latencies[0], probe.latencies[1:]
+    steady_ops = probe.ops[1:]
+    per_tick = lambda value: sum(value(ops) for ops in steady_ops) / max(len(steady_ops), 1)
+
+    return dict(config,
+                first_tick=first,
+                ticks_per_s=len(steady) / sum(steady) if steady else 0.0,
+                p50=percentile(steady, 0.50),
+                p99=percentile(steady, 0.99),
+                requests=per_tick(lambda ops: ops.requests),
+                inserts=per_tick(lambda ops: ops.statements['insert']),
+                updates=per_tick(lambda ops: ops.statements['update']),
+                selects=per_tick(lambda ops: ops.statements['select']),
+                batches=per_tick(lambda ops: ops.batches),
+                db_share=sum(ops.elapsed for ops in steady_ops) / sum(steady) if steady else 0.0,
+                rss_setup=rss_setup,
+                rss_peak=peak_rss())
+
+
+def run_isolated(config:dict) -> dict:
+    """
+    Run a benchmark in a new python process
+    """
+    process = subprocess.run([sys.executable, '-m', 'bench.collector_bench', '--run', json.dumps(config)],
+                             stdout=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise Exception(f"{config['collector']} collector ({config['mode']}, {config['size']}) "
+                        f"failed with status {process.returncode}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def report(result:dict, baseline:dict = None):
+    line = (f"{result['collector']:<10} {result['mode']:<11} {result['size']:>8} "
+            f"{result['first_tick']*1e3:>10.1f} {result['ticks_per_s']:>9.1f} "
+            f"{result['p50']*1e3:>9.2f} {result['p99']*1e3:>9.2f} "
+            f"{result['requests']:>9.1f} {result['inserts']:>8.1f} {result['updates']:>8.1f} "
+            f"{result['selects']:>8.1f} {result['db_share']*100:>6.1f}% "
+            f"{result['rss_setup']:>8.1f} {result['rss_peak']:>8.1f}")
+    if baseline:
+        change = result['ticks_per_s'] / baseline['ticks_per_s'] - 1 if baseline['ticks_per_s'] else 0.0
+        line += f" {change*100:>+7.1f}%"
+    print(line, flush=True)
+
+
+def key_of(result:dict) -> str:
+    return f"{result['collector']}/{result['mode']}/{result['size']}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--collectors', nargs='+', choices=COLLECTORS, default=COLLECTORS,
+                        help='Collectors to benchmark')
+    parser.add_argument('--mode', nargs='+', choices=MODES, default=MODES,
+                        help='Polling (one request per id), snapshot, fingerprint-indexed snapshot '
+                        'or write-behind snapshot collectors')
+    parser.add_argument('--jobs', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help='Job populations (up to 1000000)')
+    parser.add_argument('--nodes', nargs='+', type=int, default=[100, 1000], help='Node populations')
+    parser.add_argument('--partitions', nargs='+', type=int, default=[16], help='Partition populations')
+    parser.add_argument('-t', '--ticks', type=int, default=20, help='Steady-state ticks per run')
+    parser.add_argument('--churn', type=float, default=0.01, help='Fraction of the entities changed per tick')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic cluster')
+    parser.add_argument('--db-latency', type=float, default=0, help='Latency of each database request (ms)')
+    parser.add_argument('--data', default='test.json', help='Json file with sample rows (backup.py layout)')
+    parser.add_argument('--log', action='store_true', help='Keep the INFO logs of the collectors')
+    parser.add_argument('--save', help='Save the results to a json file')
+    parser.add_argument('--compare', help='Compare ticks/s with the results saved in a json file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Slowdown of ticks/s reported as a regression by --compare')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_collector(json.loads(args.run))))
+        exit(0)
+
+    baselines = {}
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baselines = {key_of(result): result for result in json.load(baseline_file)}
+
+    print(f"{'collector':<10} {'mode':<11} {'size':>8} {'first(ms)':>10} {'ticks/s':>9} "
+          f"{'p50(ms)':>9} {'p99(ms)':>9} {'requests':>9} {'inserts':>8} {'updates':>8} "
+          f"{'selects':>8} {'db':>7} {'rss0(MB)':>8} {'rss(MB)':>8}" + (" vs base" if baselines else ""))
+
+    sizes = {'jobs': args.jobs, 'nodes': args.nodes, 'partitions': args.partitions}
+    results, regressions = [], []
+    for collector_name in args.collectors:
+        for mode in args.mode:
+            for size in sizes[collector_name]:
+                config = {"collector": collector_name, "mode": mode, "size": size,
+                          "ticks": args.ticks, "churn": args.churn, "seed": args.seed,
+                          "samples": args.data, "log": args.log, "db_latency": args.db_latency / 1000}
+                try:
+                    result = run_isolated(config)
+                except Exception as error:
+                    print(f"[-] {error}")
+                    continue
+
+                baseline = baselines.get(key_of(result))
+                report(result, baseline)
+                results.append(result)
+                if baseline and result['ticks_per_s'] < baseline['ticks_per_s'] * (1 - args.tolerance):
+                    regressions.append(key_of(result))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=4)
+
+    if regressions:
+        print(f"[-] Regressions (ticks/s more than {args.tolerance*100:.0f}% slower): {', '.join(regressions)}")
+        exit(1)
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+#
+# In-process stand-in of a cassandra session: the statements sent by
+# cqlengine and by the prepared statements of statements.py are applied
+# to in-memory tables, counted and timed
+#
+# Only the statement shapes used by the collectors are understood
+# (INSERT, UPDATE, DELETE and SELECT by primary key or of a whole table,
+# the TTLs and lightweight transactions of the leases). A session can be
+# served to other processes (serve() and RemoteSession)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import re
+import time
+import threading
+from abc import ABC, abstractmethod
+from multiprocessing.managers import BaseManager
+from typing import Callable, Dict, List, Tuple
+
+# THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
+from cassandra.cqlengine import connection, models as cqlengine_models
+from cassandra.cqlengine.connection import _ConfigMode
+from cassandra.encoder import Encoder
+from cassandra.query import BatchStatement, PreparedStatement
+
+
+NAME = r'(?:"\w+"|\w+)'
+TABLE = rf'(?:{NAME}\.)?{NAME}'
+MARK = r'(?:%\(\w+\)s|\?)'
+
+TTL = rf'(?: USING TTL (?P<ttl>{MARK}|\d+))?'
+IF = r'(?: IF (?P<conditions>.+))?'
+
+SELECT = re.compile(rf'SELECT (?P<fields>.+?) FROM (?P<table>{TABLE})'
+                    rf'(?: WHERE (?P<where>.+?))?(?: LIMIT (?P<limit>\d+))?$')
+INSERT = re.compile(rf'INSERT INTO (?P<table>{TABLE}) \((?P<fields>.+?)\) VALUES \((?P<marks>(?:{MARK}(?:, )?)+)\)'
+                    rf'(?P<not_exists> IF NOT EXISTS)?{TTL}$')
+DELETE = re.compile(rf'DELETE (?:(?P<fields>.+?) )?FROM (?P<table>{TABLE}) WHERE (?P<where>.+?){IF}$')
+UPDATE = re.compile(rf'UPDATE (?P<table>{TABLE}){TTL} SET (?P<assignments>.+?) WHERE (?P<where>.+?){IF}$')
+ASSIGNMENT = re.compile(rf'(?P<field>{NAME})(?:\[(?P<item>{MARK})\])? = '
+                        rf'(?:{NAME} (?P<op>[+-]) )?(?P<value>{MARK})')
+CONDITION = re.compile(rf'(?P<field>{NAME}) = (?P<value>{MARK})')
+
+
+def unquote(name:str) -> str:
+    return name.replace('"', '').split('.')[-1]
+
+
+class Statement:
+    """
+    Parsed statement: kind, table and (field, marker) pairs of its
+    values, assignments and conditions (where and if), its TTL
+    (marker or seconds) and whether it's a lightweight transaction
+    """
+    def __init__(self, query:str):
+        self.query = query
+        self._positional = 0
+        # TTL given by a marker or in the query (seconds)
+        self.ttl = None
+        self.ttl_seconds = None
+        self.conditions = []
+        self.if_not_exists = False
+
+        match = INSERT.match(query)
+        if match:
+            self.kind, self.table = 'insert', unquote(match['table'])
+            fields = [unquote(field) for field in match['fields'].split(', ')]
+            self.values = list(zip(fields, map(self._mark, match['marks'].split(', '))))
+            self.if_not_exists = bool(match['not_exists'])
+            self._ttl(match['ttl'])
+            return
+
+        match = UPDATE.match(query)
+        if match:
+            self.kind, self.table = 'update', unquote(match['table'])
+            self._ttl(match['ttl'])
+            self.assignments = [(unquote(m['field']), self._mark(m['item']) if m['item'] else None,
+                                 m['op'], self._mark(m['value']))
+                                for m in ASSIGNMENT.finditer(match['assignments'])]
+            self.where = self._conditions(match['where'])
+            self.conditions = self._conditions(match['conditions']) if match['conditions'] else []
+            return
+
+        match = DELETE.match(query)
+        if match:
+            self.kind, self.table = 'delete', unquote(match['table'])
+            fields = match['fields']
+            self.fields = None if fields is None else [unquote(field) for field in fields.split(', ')]
+            self.where = self._conditions(match['where'])
+            self.conditions = self._conditions(match['conditions']) if match['conditions'] else []
+            return
+
+        match = SELECT.match(query)
+        if match:
+            self.kind, self.table = 'select', unquote(match['table'])
+            fields = match['fields']
+            self.fields = None if fields == '*' else [unquote(field) for field in fields.split(', ')]
+            self.where = self._conditions(match['where']) if match['where'] else []
+            self.limit = int(match['limit']) if match['limit'] else None
+            return
+
+        raise ValueError(f"Statement not supported by the fake session: {query}")
+
+    def _mark(self, mark:str):
+        # %(name)s markers are looked up by name, ? markers by position
+        if mark == '?':
+            self._positional += 1
+            return self._positional - 1
+        return mark[2:-2]
+
+    @property
+    def lwt(self) -> bool:
+        return self.if_not_exists or bool(self.conditions)
+
+    def _ttl(self, ttl:str):
+        if ttl is None:
+            return
+        if ttl.isdigit():
+            self.ttl_seconds = int(ttl)
+        else:
+            self.ttl = self._mark(ttl)
+
+    def _conditions(self, where:str) -> list:
+        conditions = where.split(' AND ')
+        parsed = [CONDITION.fullmatch(condition) for condition in conditions]
+        if not all(parsed):
+            raise ValueError(f"Condition not supported by the fake session: {where}")
+        return [(unquote(m['field']), self._mark(m['value'])) for m in parsed]
+
+
+class FakePrepared(PreparedStatement):
+    """
+    Prepared statement of the fake session (bound values aren't serialized)
+    """
+    def __init__(self, statement:Statement, query_id:bytes):
+        self.statement = statement
+        self.query_string = statement.query
+        self.query_id = query_id
+        self.keyspace = None
+        self.routing_key = None
+        self.custom_payload = None
+
+    def bind(self, values):
+        return FakeBound(self, tuple(values))
+
+
+class FakeBound:
+    def __init__(self, prepared:FakePrepared, values:tuple):
+        self.prepared_statement = prepared
+        self.values = values
+        self.keyspace = None
+        self.routing_key = None
+        self.custom_payload = None
+
+
+class FakeResult(list):
+    """
+    Rows of a statement (dicts, as the dict_factory of cqlengine),
+    was_applied is False for a lightweight transaction not applied
+    """
+    was_applied = True
+    has_more_pages = False
+
+    def __init__(self, rows:list = (), applied:bool = True):
+        super().__init__(rows)
+        self.was_applied = applied
+
+    @property
+    def current_rows(self):
+        return self
+
+    def one(self):
+        return self[0] if self else None
+
+
+class FakeFuture:
+    """
+    Already resolved ResponseFuture, callbacks are run when added
+    """
+    def __init__(self, result = None, error:Exception = None):
+        self._result = result
+        self._error = error
+
+    def result(self):
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_callbacks(self, callback, errback, callback_args=(), callback_kwargs=None,
+                      errback_args=(), errback_kwargs=None):
+        if self._error is not None:
+            errback(self._error, *errback_args, **(errback_kwargs or {}))
+        else:
+            callback(self._result, *callback_args, **(callback_kwargs or {}))
+
+    def add_callback(self, callback, *args, **kwargs):
+        if self._error is None:
+            callback(self._result, *args, **kwargs)
+
+    def add_errback(self, errback, *args, **kwargs):
+        if self._error is not None:
+            errback(self._error, *args, **kwargs)
+
+
+class OpStats:
+    """
+    Requests (round trips), statements per kind and time spent applying them
+    """
+    def __init__(self):
+        self.requests = 0
+        self.statements = {'insert': 0, 'update': 0, 'delete': 0, 'select': 0}
+        self.batches = 0
+        self.rows_read = 0
+        self.elapsed = 0.0
+
+    def copy(self) -> 'OpStats':
+        stats = OpStats()
+        stats.__dict__.update(self.__dict__, statements=dict(self.statements))
+        return stats
+
+    def __sub__(self, other:'OpStats') -> 'OpStats':
+        stats = OpStats()
+        stats.requests = self.requests - other.requests
+        stats.statements = {kind: count - other.statements[kind] for kind, count in self.statements.items()}
+        stats.batches = self.batches - other.batches
+        stats.rows_read = self.rows_read - other.rows_read
+        stats.elapsed = self.elapsed - other.elapsed
+        return stats
+
+
+class FakeCluster:
+    _config_mode = _ConfigMode.LEGACY
+    protocol_version = 4
+
+    def register_user_type(self, keyspace, user_type, klass):
+        pass
+
+
+class SessionBase(ABC):
+    """
+    What cqlengine and the writers need of a session, the subclasses
+    implement execute (in memory or in a served session)
+    """
+    def __init__(self, keyspace:str = 'bench'):
+        self.keyspace = keyspace
+        self.hosts = []
+        self.cluster = FakeCluster()
+        self.row_factory = None
+        self.encoder = Encoder()
+
+        self._parsed = {}
+        self._prepared = {}
+        self._prepared_ids = {}
+
+    def connect(self):
+        """
+        Make this session the default connection of cqlengine
+        """
+        cqlengine_models.DEFAULT_KEYSPACE = self.keyspace
+        connection.register_connection('bench', session=self, default=True)
+        return self
+
+    def _parse(self, query:str) -> Statement:
+        statement = self._parsed.get(query)
+        if statement is None:
+            statement = self._parsed[query] = Statement(query)
+        return statement
+
+    def prepare(self, query:str) -> FakePrepared:
+        prepared = self._prepared.get(query)
+        if prepared is None:
+            query_id = len(self._prepared).to_bytes(4, 'big')
+            prepared = self._prepared[query] = FakePrepared(self._parse(query), query_id)
+            self._prepared_ids[query_id] = prepared
+        return prepared
+
+    def _batch_of(self, batch:BatchStatement) -> List[Tuple[str, tuple]]:
+        return [(self._prepared_ids[query_id].query_string, values)
+                for _prepared, query_id, values in batch._statements_and_parameters]
+
+    @abstractmethod
+    def execute(self, query, parameters = None, timeout = None, **kwargs) -> FakeResult:
+        pass
+
+    def execute_async(self, query, parameters = None, timeout = None, **kwargs) -> FakeFuture:
+        try:
+            return FakeFuture(self.execute(query, parameters, timeout))
+        except Exception as error:
+            return FakeFuture(error=error)
+
+    def shutdown(self):
+        pass
+
+
+class FakeSession(SessionBase):
+    """
+    Session keeping the tables of models in memory: table -> {primary key: row},
+    each request can be delayed latency seconds (e.g. a slow cluster)
+    """
+    def __init__(self, models:List, keyspace:str = 'bench', latency:float = 0):
+        super().__init__(keyspace)
+        self.latency = latency
+
+        self.tables = {}
+        self.primary_keys = {}
+        # table -> {primary key: time.time() the row expires at}
+        self.expires = {}
+        for model in models:
+            table = unquote(model.column_family_name(include_keyspace=False))
+            self.tables[table] = {}
+            self.expires[table] = {}
+            self.primary_keys[table] = [model._columns[name].db_field_name for name in model._primary_keys]
+
+        self.stats = OpStats()
+        self._lock = threading.Lock()
+
+    def _key(self, statement:Statement, pairs:Dict[str, object]) -> tuple:
+        return tuple(pairs[name] for name in self.primary_keys[statement.table])
+
+    def _expire(self, statement:Statement):
+        expires = self.expires[statement.table]
+        if expires:
+            now = time.time()
+            for key in [key for key, deadline in expires.items() if deadline <= now]:
+                del expires[key]
+                self.tables[statement.table].pop(key, None)
+
+    def _set_ttl(self, statement:Statement, params, key:tuple):
+        ttl = params[statement.ttl] if statement.ttl is not None else statement.ttl_seconds
+        if ttl:
+            self.expires[statement.table][key] = time.time() + ttl
+        else:
+            self.expires[statement.table].pop(key, None)
+
+    def _applied(self, statement:Statement, params, key:tuple) -> bool:
+        row = self.tables[statement.table].get(key)
+        if statement.if_not_exists:
+            return row is None
+        return row is not None and all(row.get(field) == params[mark] for field, mark in statement.conditions)
+
+    def _apply(self, statement:Statement, params) -> FakeResult:
+        self.stats.statements[statement.kind] += 1
+        table = self.tables[statement.table]
+        self._expire(statement)
+
+        if statement.kind == 'insert':
+            row = {field: params[mark] for field, mark in statement.values}
+            key = self._key(statement, row)
+            if statement.lwt and not self._applied(statement, params, key):
+                return FakeResult([dict(table[key], **{'[applied]': False})], applied=False)
+
+            table.setdefault(key, {}).update(row)
+            self._set_ttl(statement, params, key)
+            return FakeResult([{'[applied]': True}]) if statement.lwt else FakeResult()
+
+        where = {field: params[mark] for field, mark in statement.where}
+
+        if statement.kind in ('update', 'delete') and statement.lwt:
+            key = self._key(statement, where)
+            if not self._applied(statement, params, key):
+                row = table.get(key)
+                return FakeResult([dict(row or {}, **{'[applied]': False})], applied=False)
+
+        if statement.kind == 'update':
+            key = self._key(statement, where)
+            self._set_ttl(statement, params, key)
+            row = table.setdefault(key, dict(where))
+            for field, item, op, mark in statement.assignments:
+                value = params[mark]
+                if item is not None:
+                    row[field] = dict(row.get(field) or {}, **{params[item]: value})
+                elif op == '+':
+                    old = row.get(field)
+                    row[field] = value if old is None else old + value
+                elif op == '-':
+                    row[field] = [old for old in row.get(field) or [] if old not in value]
+                else:
+                    row[field] = value
+            return FakeResult([{'[applied]': True}]) if statement.lwt else FakeResult()
+
+        if statement.kind == 'delete':
+            key = self._key(statement, where)
+            if statement.fields is None:
+                table.pop(key, None)
+                self.expires[statement.table].pop(key, None)
+            elif key in table:
+                for field in statement.fields:
+                    table[key].pop(field, None)
+            return FakeResult([{'[applied]': True}]) if statement.lwt else FakeResult()
+
+        if len(where) == len(self.primary_keys[statement.table]):
+            row = table.get(self._key(statement, where))
+            rows = [] if row is None else [row]
+        else:
+            rows = [row for row in table.values()
+                    if all(row.get(field) == value for field, value in where.items())]
+
+        if statement.limit:
+            rows = rows[:statement.limit]
+        if statement.fields is not None:
+            rows = [{field: row.get(field) for field in statement.fields} for row in rows]
+        else:
+            rows = [dict(row) for row in rows]
+
+        self.stats.rows_read += len(rows)
+        return FakeResult(rows)
+
+    def _request(self, apply:Callable[[], FakeResult]) -> FakeResult:
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.stats.requests += 1
+            try:
+                return apply()
+            finally:
+                self.stats.elapsed += time.perf_counter() - start
+
+    def execute(self, query, parameters = None, timeout = None, **kwargs) -> FakeResult:
+        if isinstance(query, BatchStatement):
+            return self.execute_batch(self._batch_of(query))
+
+        query_string = query if isinstance(query, str) else query.query_string
+        return self._request(lambda: self._apply(self._parse(query_string), parameters or {}))
+
+    def execute_batch(self, statements:List[Tuple[str, tuple]]) -> FakeResult:
+        """
+        Apply the (query, values) statements of a batch
+        """
+        def apply():
+            self.stats.batches += 1
+            for query_string, values in statements:
+                self._apply(self._parse(query_string), values)
+            return FakeResult()
+
+        return self._request(apply)
+
+
+class FakeDBManager(BaseManager):
+    pass
+
+
+def serve(session:FakeSession, address:Tuple[str, int] = ('127.0.0.1', 0),
+          authkey:bytes = b'fakedb') -> Tuple[str, int]:
+    """
+    Serve a session to other processes (see RemoteSession) from a daemon
+    thread, return its address
+    """
+    FakeDBManager.register('session', callable=lambda: session, exposed=('execute', 'execute_batch'))
+    server = FakeDBManager(address=address, authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, name='fakedb', daemon=True).start()
+    return server.address
+
+
+class RemoteSession(SessionBase):
+    """
+    Session of another process served by serve(), statements are sent
+    as query strings and values
+    """
+    def __init__(self, address:Tuple[str, int], authkey:bytes = b'fakedb', keyspace:str = 'bench'):
+        super().__init__(keyspace)
+        FakeDBManager.register('session')
+        manager = FakeDBManager(address=tuple(address), authkey=authkey)
+        manager.connect()
+        self.remote = manager.session()
+
+    def execute(self, query, parameters = None, timeout = None, **kwargs) -> FakeResult:
+        if isinstance(query, BatchStatement):
+            return self.remote.execute_batch(self._batch_of(query))
+
+        query_string = query if isinstance(query, str) else query.query_string
+        return self.remote.execute(query_string, parameters)
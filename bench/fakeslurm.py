@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# Synthetic slurm: populations of jobs, nodes and partitions built from
+# the record shapes of test.json, changed on each tick with a churn rate,
+# served through a module with the pyslurm API used by the collectors
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import sys
+import json
+import types
+import random
+import threading
+from typing import Callable, Dict
+
+# pending -> running -> one of the terminal states
+FINAL_STATES = ['COMPLETED', 'COMPLETED', 'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT']
+NODE_STATES = ['IDLE', 'MIXED', 'ALLOCATED']
+
+
+class FakeSlurm:
+    """
+    Jobs, nodes and partitions of a synthetic cluster.
+
+    On each advance a churn fraction of the jobs moves to its next state,
+    finished jobs leave slurm after min_job_age ticks and new jobs are
+    submitted to keep the population, a churn fraction of the nodes and
+    partitions changes its load. Changed values are replaced, never
+    mutated in place, so rows handed out before stay as they were
+    """
+    def __init__(self, jobs:int = 1000, nodes:int = 100, partitions:int = 4,
+                 churn:float = 0.01, min_job_age:int = 10, seed:int = 0,
+                 samples:str = 'test.json'):
+        with open(samples, 'r') as samples_file:
+            templates = json.load(samples_file)
+
+        self.random = random.Random(seed)
+        self.churn = churn
+        self.min_job_age = min_job_age
+        self.ticks = 0
+        self.population = jobs
+
+        self._job_templates = templates["jobs"]
+        self._node_templates = templates["nodes"]
+        self._partition_templates = templates["partitions"]
+
+        self.partitions = {}
+        for index in range(partitions):
+            name = f"part{index:02d}"
+            self.partitions[name] = dict(self._partition_templates[index % len(self._partition_templates)],
+                                         name=name)
+
+        self.nodes = {}
+        names = list(self.partitions)
+        for index in range(nodes):
+            name = f"node{index:05d}"
+            self.nodes[name] = dict(self._node_templates[index % len(self._node_templates)],
+                                    name=name, node_hostname=name,
+                                    partitions=[names[index % len(names)]])
+
+        self.jobs = {}
+        # job id -> tick it finished at
+        self.finished = {}
+        self.next_job_id = 1
+        for _ in range(jobs):
+            self.submit(self.random.choice(['PENDING', 'RUNNING']))
+
+    def submit(self, state:str = 'PENDING'):
+        job_id = self.next_job_id
+        self.next_job_id += 1
+
+        node = f"node{self.random.randrange(max(len(self.nodes), 1)):05d}"
+        self.jobs[job_id] = dict(self._job_templates[job_id % len(self._job_templates)],
+                                 job_id=job_id,
+                                 name=f"job{job_id}",
+                                 job_state=state,
+                                 user_id=1000 + job_id % 97,
+                                 partition=self.random.choice(list(self.partitions)),
+                                 nodes=node,
+                                 cpus_allocated={node: 1 + job_id % 4},
+                                 submit_time=self.ticks,
+                                 run_time=0,
+                                 std_out=f"/home/user/slurm-{job_id}.out")
+
+    def advance(self):
+        """
+        Move the cluster to its next tick
+        """
+        self.ticks += 1
+        rand = self.random
+
+        for job_id in [job_id for job_id, tick in self.finished.items()
+                       if self.ticks - tick >= self.min_job_age]:
+            del self.finished[job_id]
+            del self.jobs[job_id]
+
+        active = [job_id for job_id in self.jobs if job_id not in self.finished]
+        for job_id in rand.sample(active, int(len(active) * self.churn)):
+            job = self.jobs[job_id]
+            if job["job_state"] == 'PENDING':
+                self.jobs[job_id] = dict(job, job_state='RUNNING', start_time=self.ticks)
+            else:
+                state = rand.choice(FINAL_STATES)
+                self.jobs[job_id] = dict(job, job_state=state, end_time=self.ticks,
+                                         run_time=self.ticks - job["submit_time"],
+                                         exit_code="0:0" if state == 'COMPLETED' else "1:0")
+                self.finished[job_id] = self.ticks
+
+        while len(self.jobs) - len(self.finished) < self.population:
+            self.submit()
+
+        for name in rand.sample(list(self.nodes), int(len(self.nodes) * self.churn)):
+            node = self.nodes[name]
+            self.nodes[name] = dict(node, cpu_load=rand.randrange(400),
+                                    free_mem=rand.randrange(node["real_memory"] or 1),
+                                    alloc_cpus=rand.randrange(node["cpus"] + 1),
+                                    state=rand.choice(NODE_STATES))
+
+        for name in rand.sample(list(self.partitions), int(len(self.partitions) * self.churn)):
+            partition = self.partitions[name]
+            self.partitions[name] = dict(partition, state=rand.choice(['UP', 'DRAIN']))
+
+    def module(self, poll:Callable[[str], None] = None) -> types.ModuleType:
+        """
+        pyslurm-like module over this cluster, poll(entity) is called
+        first by every get() and ids() (e.g. to advance the cluster)
+        """
+        module = types.ModuleType('pyslurm')
+        poll = poll or (lambda entity: None)
+        cluster = self
+        # collectors poll from their own threads
+        lock = threading.Lock()
+
+        def entity_class(entity:str, items:Callable[[], Dict], find:Callable):
+            class Entity:
+                def get(self):
+                    with lock:
+                        poll(entity)
+                        # pyslurm builds new dicts on each call
+                        return {key: dict(data) for key, data in items().items()}
+
+                def ids(self):
+                    with lock:
+                        poll(entity)
+                        return list(items())
+
+                def find_id(self, key):
+                    data = items().get(key)
+                    if data is None:
+                        raise ValueError(f"Invalid {entity} id specified: {key}")
+                    return find(dict(data))
+
+            Entity.__name__ = entity
+            return Entity
+
+        # job().find_id returns a list of jobs, the other ones a single dict
+        module.job = entity_class('job', lambda: cluster.jobs, lambda data: [data])
+        module.node = entity_class('node', lambda: cluster.nodes, lambda data: data)
+        module.partition = entity_class('partition', lambda: cluster.partitions, lambda data: data)
+        return module
+
+    def install(self, poll:Callable[[str], None] = None) -> types.ModuleType:
+        """
+        Register the module of this cluster as pyslurm (before importing collector)
+        """
+        module = sys.modules['pyslurm'] = self.module(poll)
+        return module
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# Local demo of the sharded collectors: several collector processes share
+# a fake database (bench/fakedb.py served to them) and the same synthetic
+# slurm (bench/fakeslurm.py, one replica per process advanced on a shared
+# clock), split its shards through the leases table, and take over the
+# shards of an instance that is killed
+#
+# Prints the owners of the leases over time and checks at the end that
+# every job of the cluster reached the database in its last state
+#
+# Usage: python -m bench.shard_demo [--instances 3] [--shards 8] [--kill-after 10]
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import subprocess
+from collections import Counter
+
+from bench.fakeslurm import FakeSlurm
+
+
+def worker(config:dict):
+    """
+    Collector instance: run the snapshot collectors of the held shards
+    until config["duration"] seconds after the start
+    """
+    cluster = FakeSlurm(config["jobs"], config["nodes"], config["partitions"], churn=config["churn"],
+                        seed=config["seed"], samples=config["samples"])
+
+    def poll(entity:str):
+        # every replica is at the same tick at the same time
+        while cluster.ticks < int((time.time() - config["start"]) / config["tick"]):
+            cluster.advance()
+
+    cluster.install(poll)
+
+    from bench.fakedb import RemoteSession
+    RemoteSession(config["address"]).connect()
+
+    import collector
+    from scheduler import Scheduler
+    from sharding import LeaseTable, ShardLeases
+    from tables import Jobs, Nodes, Partitions
+
+    # schema management isn't part of the demo
+    collector.sync_table = lambda *args, **kwargs: None
+    logging.disable(logging.INFO)
+
+    leases = ShardLeases(LeaseTable(ttl=config["ttl"]), config["owner"], config["shards"])
+    leases.start()
+
+    scheduler = Scheduler()
+    for model in (Nodes, Partitions, Jobs):
+        snapshot = collector.snapshot_collector('bench', model, leases=leases)
+        scheduler.add(f"{snapshot.name}_collector", snapshot.tick, config["tick"],
+                      setup=snapshot.load, teardown=snapshot.close)
+    scheduler.start()
+
+    time.sleep(max(0.0, config["start"] + config["duration"] - time.time()))
+    scheduler.stop()
+    leases.stop()
+    print(json.dumps({"owner": config["owner"], "ticks": cluster.ticks}), flush=True)
+
+
+def holders_line(session, start:float) -> str:
+    leases = {row["shard"]: row["owner"] for row in session.execute("SELECT shard, owner FROM bench.leases")}
+    owners = Counter(owner for shard, owner in leases.items() if '/members/' not in shard)
+    shards = sum(1 for shard in leases if '/members/' not in shard)
+    return (f"{time.time() - start:6.1f}s  {shards:>3} leased  " +
+            "  ".join(f"{owner}:{count}" for owner, count in sorted(owners.items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=3, help='Collector processes')
+    parser.add_argument('--shards', type=int, default=8, help='Shards of the jobs')
+    parser.add_argument('--jobs', type=int, default=2000, help='Job population')
+    parser.add_argument('--nodes', type=int, default=32, help='Node population')
+    parser.add_argument('--partitions', type=int, default=4, help='Partition population')
+    parser.add_argument('--churn', type=float, default=0.05, help='Fraction of the entities changed per tick')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic cluster')
+    parser.add_argument('--tick', type=float, default=0.5, help='Period of the collectors and the cluster (s)')
+    parser.add_argument('--ttl', type=int, default=3, help='TTL of the leases (s)')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds the instances run')
+    parser.add_argument('--kill-after', type=float, default=8,
+                        help='Kill the first instance (no release of its leases) after these seconds')
+    parser.add_argument('--data', default='test.json', help='Json file with sample rows (backup.py layout)')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(json.loads(args.worker))
+        exit(0)
+
+    from bench.fakedb import FakeSession, serve
+    from tables import TABLES, Jobs, Leases
+
+    session = FakeSession([*TABLES.values(), Leases])
+    address = serve(session)
+
+    start = time.time() + 2
+    config = {"address": address, "shards": args.shards, "jobs": args.jobs, "nodes": args.nodes,
+              "partitions": args.partitions, "churn": args.churn, "seed": args.seed, "samples": args.data,
+              "tick": args.tick, "ttl": args.ttl, "start": start, "duration": args.duration}
+    workers = [subprocess.Popen([sys.executable, '-m', 'bench.shard_demo', '--worker',
+                                 json.dumps(dict(config, owner=f"collector{index}"))],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+               for index in range(args.instances)]
+
+    killed = False
+    while any(process.poll() is None for process in workers):
+        time.sleep(1)
+        print(holders_line(session, start), flush=True)
+        if not killed and time.time() - start >= args.kill_after:
+            workers[0].send_signal(signal.SIGKILL)
+            killed = True
+            print(f"{time.time() - start:6.1f}s  collector0 killed", flush=True)
+
+    results = [json.loads(process.stdout.read().strip().splitlines()[-1])
+               for process in workers[1:] if process.returncode == 0]
+    if not results:
+        print("[-] No instance finished")
+        exit(1)
+
+    # the database holds the states of the last ticks of the survivors
+    ticks = [result["ticks"] for result in results]
+    cluster = FakeSlurm(args.jobs, args.nodes, args.partitions, churn=args.churn, seed=args.seed,
+                        samples=args.data)
+    states = {}
+    for tick in range(max(ticks) + 1):
+        if tick >= min(ticks) - 1:
+            if tick == min(ticks) - 1:
+                expected = set(cluster.jobs)
+            for job_id, data in cluster.jobs.items():
+                states.setdefault(job_id, []).append(Jobs.codec.extract(data))
+        cluster.advance()
+
+    rows = session.tables['jobs']
+    columns = Jobs.codec.columns
+    missing = [job_id for job_id in expected if (job_id,) not in rows]
+    stale = [job_id for job_id in expected if (job_id,) in rows and
+             all(Jobs.codec.diff({name: rows[(job_id,)].get(name) for name in columns}, state)
+                 for state in states[job_id])]
+    print(f"{len(expected)} jobs in slurm at tick {min(ticks) - 1}: {len(missing)} missing, "
+          f"{len(stale)} stale, {session.stats.requests} requests")
+    exit(1 if missing or stale else 0)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# Adaptive cadences of the collectors: a next check time per tracked key,
+# from its state and its recent changes, and a backoff of the period of
+# a collector whose ticks don't see changes
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+from typing import Dict, Iterable, List, Tuple
+
+# state -> (fastest, slowest) seconds between the checks of a key, a
+# change brings a key to the fastest one, each check without changes
+# doubles it up to the slowest one
+JOB_INTERVALS = {
+    'PENDING': (10, 120),
+    'REQUEUE_HOLD': (10, 120),
+    'SUSPENDED': (30, 300),
+    'RUNNING': (1, 30),
+    'COMPLETING': (1, 10),
+    'CONFIGURING': (1, 10),
+}
+
+NODE_INTERVALS = {
+    'DOWN': (60, 600),
+    'DRAIN': (60, 600),
+    'DRAINED': (60, 600),
+    'IDLE': (10, 120),
+}
+
+PARTITION_INTERVALS = {
+    'UP': (10, 300),
+}
+
+
+def base_state(state:str) -> str:
+    """
+    State of a node without its flags, e.g. DOWN for 'DOWN*' or IDLE for 'IDLE+DRAIN'
+    """
+    return (state or '').split('+')[0].rstrip('*~#!%$@^-')
+
+
+class Cadence:
+    """
+    Next check time of each key: a key is checked again after the interval
+    of its state, shortened to the fastest one by a change and doubled by
+    every check that didn't find any (keys never checked are due)
+    """
+    def __init__(self, intervals:Dict[str, Tuple[float, float]] = None, default:Tuple[float, float] = (1, 60),
+                 factor:float = 2):
+        self.intervals = intervals or {}
+        self.default = default
+        self.factor = factor
+
+        # key -> (next check time, interval)
+        self._next = {}
+
+    def __len__(self) -> int:
+        return len(self._next)
+
+    def due(self, keys:Iterable, now:float = None) -> List:
+        """
+        Keys whose check time came
+        """
+        now = now or time.time()
+        scheduled = self._next
+        return [key for key in keys if key not in scheduled or scheduled[key][0] <= now]
+
+    def checked(self, key, state:str, changed:bool, now:float = None):
+        """
+        Schedule the next check of a key
+        """
+        now = now or time.time()
+        fastest, slowest = self.intervals.get(state) or self.intervals.get(base_state(state), self.default)
+        if changed or key not in self._next:
+            interval = fastest
+        else:
+            interval = min(slowest, max(fastest, self._next[key][1] * self.factor))
+        self._next[key] = (now + interval, interval)
+
+    def retain(self, keys:set):
+        """
+        Forget every key but the ones of keys (e.g. the ones still in slurm)
+        """
+        for key in self._next.keys() - keys:
+            del self._next[key]
+
+
+class Backoff:
+    """
+    Period of a collector: the base one while its ticks see changes,
+    doubled after every idle_ticks ticks without any, up to max_period
+    """
+    def __init__(self, period:float, max_period:float, idle_ticks:int = 5):
+        self.base = period
+        self.period = period
+        self.max_period = max(period, max_period)
+        self.idle_ticks = idle_ticks
+        self.idle = 0
+
+    def update(self, changes:int) -> float:
+        """
+        Period after a tick with some changes
+        """
+        if changes:
+            self.idle = 0
+            self.period = self.base
+            return self.period
+
+        self.idle += 1
+        if self.idle >= self.idle_ticks:
+            self.idle = 0
+            self.period = min(self.max_period, self.period * 2)
+        return self.period
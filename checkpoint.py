@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Local checkpoint of the state tracked by a collector, so a restart
+# doesn't need to scan its table in cassandra
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import os
+import gzip
+import json
+import time
+import logging
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+
+def require_numpy(feature:str):
+    """
+    Fail unless numpy is installed, it holds the in-memory state of feature
+    (e.g. the fingerprint index)
+    """
+    if np is None:
+        raise Exception(f"No numpy package installed (needed by {feature})")
+
+
+@contextmanager
+def atomic_write(path:str, opener:Callable = open, mode:str = 'w'):
+    """
+    File replacing path once written: it's written aside and renamed,
+    so a crash never leaves a truncated one
+    """
+    tmp_path = f"{path}.tmp"
+    with opener(tmp_path, mode) as tmp_file:
+        yield tmp_file
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """
+    Compact checkpoint (gzipped json) holding the tracked ids, the
+    fingerprint of their last persisted row, the placement of their rows
+    in the query tables (and the former ones that may still hold rows)
+    and the time of the last tick
+    """
+    VERSION = 3
+
+    def __init__(self, path:str, max_age:float = 24*3600):
+        self.path = path
+        self.max_age = max_age
+
+    def save(self, fingerprints:dict, retired:set, tick_time:float = None, placed:dict = None,
+             stale:dict = None):
+        state = {
+            "version": self.VERSION,
+            "tick_time": tick_time or time.time(),
+            "fingerprints": list(fingerprints.items()),
+            "retired": list(retired),
+            "placed": list((placed or {}).items()),
+            "stale": [(key, list(placements)) for key, placements in (stale or {}).items()],
+        }
+
+        with atomic_write(self.path, gzip.open, 'wt') as checkpoint_file:
+            json.dump(state, checkpoint_file, separators=(',', ':'))
+
+    def load(self) -> Optional[dict]:
+        """
+        State of the checkpoint, None if it's missing, stale or unreadable
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with gzip.open(self.path, 'rt') as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except (OSError, ValueError) as error:
+            logging.error(f"Unable to read checkpoint {self.path}: {error}")
+            return None
+
+        if state.get("version") != self.VERSION:
+            return None
+
+        age = time.time() - state["tick_time"]
+        if age > self.max_age:
+            logging.info(f"Checkpoint {self.path} is stale ({age:.0f}s old)")
+            return None
+
+        return {
+            "tick_time": state["tick_time"],
+            "fingerprints": {key: fingerprint for key, fingerprint in state["fingerprints"]},
+            "retired": set(state["retired"]),
+            "placed": {key: tuple(placement) for key, placement in state["placed"]},
+            "stale": {key: set(map(tuple, placements)) for key, placements in state["stale"]},
+        }
+
+
+def checkpoint_of(keyspace:str, model, checkpoint_dir:str = None, index:bool = False):
+    """
+    Checkpoint of the collector of a table (None if checkpoints are disabled),
+    the one of an indexed collector has a path of its own: it holds hashed keys
+    """
+    if not checkpoint_dir:
+        return None
+
+    name = f"{model.__name__.lower()}.index" if index else model.__name__.lower()
+    return Checkpoint(os.path.join(checkpoint_dir, f"{keyspace}.{name}.ckpt.gz"))
@@ -4,8 +4,10 @@
 #
 # Maintainer: glozanoa <glozanoa@uni.pe>
 
+import os
+import asyncio
 import argparse
-from typing import Any, List
+from typing import Any, Callable, List
 import threading
 import time
 import logging
@@ -20,12 +22,34 @@ from cassandra.auth import PlainTextAuthProvider
 from tables import (
     Jobs,
     Partitions,
-    Nodes
+    Nodes,
+    JobStateHistory,
+    NodeMetrics,
+    Leases,
+    QUERY_TABLES,
+    UsageRollup,
+    NodeTelemetry
 )
+from tables.codec import stamp
+
+from aio import AsyncBatchWriter, AsyncSnapshotCollector, run_collectors
+from cadence import JOB_INTERVALS, NODE_INTERVALS, PARTITION_INTERVALS, Backoff, Cadence
+from checkpoint import checkpoint_of
+from fingerprint import IndexedSnapshotCollector
+from metrics import CollectorMetrics, StageTimer, serve
+from rollup import Rollup
+from scheduler import Scheduler
+from sharding import LeaseTable, ShardLeases, default_owner
+from snapshot import SnapshotCollector, TickStats
+from spool import Spool, SpoolWriter
+from telemetry import Telemetry
+from writebehind import WriteBehindWriter
+from writer import BatchWriter
 
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s')
 
+
 try:
     import pyslurm
 except ModuleNotFoundError as error:
@@ -33,20 +57,141 @@ except ModuleNotFoundError as error:
     exit(1)
 
 
-def nodes_collector(keyspace:str, n:int = 10, verbose:bool = False):
+# append-only history table of each table
+HISTORY = {
+    Jobs: JobStateHistory,
+    Nodes: NodeMetrics,
+}
+
+# ticks of the polling jobs collector between checks of the finished jobs
+# still in slurm, the ones requeued are polled again
+REQUEUE_CHECK_EVERY = 30
+
+
+def snapshot_collector(keyspace:str, model, verbose:bool = False,
+                       max_in_flight:int = 128, checkpoint_dir:str = None,
+                       writer = None, history:bool = False, index:bool = False,
+                       write_behind:bool = False, max_pending:int = 100000,
+                       linger:float = 0, spool_dir:str = None,
+                       spool_budget:int = 1 << 30, leases:ShardLeases = None,
+                       queries:bool = False, rollups:bool = False,
+                       rollup_period:float = 60) -> SnapshotCollector:
+    """
+    Snapshot collector of a table (Nodes, Partitions or Jobs), with history
+    the state transitions of jobs and the metric samples of nodes are kept,
+    with index the rows are tracked by fingerprint (see fingerprint.py),
+    with write_behind the writes are queued and coalesced (see writebehind.py),
+    with spool_dir the writes cassandra fails are spooled (see spool.py),
+    with leases only the shards held by this instance are collected (see sharding.py),
+    with queries the query tables of jobs are kept (see tables/queries.py),
+    with rollups the usage of jobs is counted per hour (see rollup.py)
+    """
+    history_models = []
+    if history and model in HISTORY:
+        history_models.append(HISTORY[model])
+    query_models = list(QUERY_TABLES.values()) if queries and model is Jobs else []
+    rollup_models = [UsageRollup] if rollups and model is Jobs else []
+
+    for table in [model, *history_models, *query_models, *rollup_models]:
+        try:
+            sync_table(table, [keyspace])
+        except Exception as error:
+            # with a spool the collectors start while cassandra is down
+            if not spool_dir:
+                raise
+            logging.error(f"Unable to sync table {table.__name__}: {error}")
+
+    name = model.__name__.lower()
+    writer = writer or BatchWriter(max_in_flight=max_in_flight)
+    if spool_dir:
+        spool = Spool(os.path.join(spool_dir, f"{keyspace}.{name}"), budget=spool_budget)
+        writer = SpoolWriter(spool, writer, name=name)
+    if write_behind:
+        writer = WriteBehindWriter(writer, max_pending, linger, name=name)
+    checkpoint = checkpoint_of(keyspace, model, checkpoint_dir, index)
+
+    rollup = None
+    if rollup_models:
+        # counters aren't idempotent, the rollups have a writer of their own (no spool)
+        state_path = os.path.join(checkpoint_dir, f"{keyspace}.jobs.rollups.json") if checkpoint_dir else None
+        rollup = Rollup(BatchWriter(max_in_flight=max_in_flight), rollup_period, state_path)
+
+    collector_class = IndexedSnapshotCollector if index else SnapshotCollector
+
+    # a single pyslurm call per tick, diffed against the persisted rows
+    source = {Jobs: pyslurm.job, Nodes: pyslurm.node, Partitions: pyslurm.partition}[model]().get
+    if leases:
+        source = leases.source(name, source)
+
+    if model is Jobs:
+        return collector_class(Jobs, source, writer, verbose,
+                               retire=Jobs.is_terminal, state_columns=['job_state'],
+                               checkpoint=checkpoint, history=history_models, queries=query_models,
+                               rollup=rollup)
+
+    return collector_class(model, source, writer, verbose, checkpoint=checkpoint,
+                           history=history_models)
+
+
+def node_telemetry(keyspace:str, window:int = 60, capacity:int = 600, max_in_flight:int = 128,
+                   leases:ShardLeases = None) -> Telemetry:
+    """
+    Telemetry sampler of the nodes (see telemetry.py), with leases only
+    the instance holding the nodes samples them
+    """
+    sync_table(NodeTelemetry, [keyspace])
+
+    source = pyslurm.node().get
+    if leases:
+        source = leases.source('nodes', source)
+    return Telemetry(source, BatchWriter(max_in_flight=max_in_flight), window, capacity)
+
+
+async def async_collectors(keyspace:str, freqs:dict, verbose:bool = False,
+                           max_in_flight:int = 1024, checkpoint_dir:str = None,
+                           history:bool = False, index:bool = False, queries:bool = False):
+    """
+    Run the snapshot collectors of the tables of freqs in a single event loop,
+    sharing a cap of in-flight writes
+    """
+    slots = asyncio.Semaphore(max_in_flight)
+
+    collectors = []
+    for model, freq in freqs.items():
+        writer = AsyncBatchWriter(max_in_flight=max_in_flight, slots=slots)
+        collector = snapshot_collector(keyspace, model, verbose, checkpoint_dir=checkpoint_dir,
+                                       writer=writer, history=history, index=index, queries=queries)
+        collectors.append((AsyncSnapshotCollector(collector), freq))
+
+    logging.info("Start collecting information (asyncio engine)")
+    await run_collectors(collectors)
+
+
+def nodes_collector(keyspace:str, n:int = 10, verbose:bool = False,
+                    adaptive:bool = False) -> Callable[[], TickStats]:
     """
-    Collect information of nodes of a cluster with a frequency n
+    Tick collecting information of nodes of a cluster, to be run with a
+    frequency n (see Scheduler), with adaptive each node is checked on a
+    cadence of its own (see cadence.py)
     """
     #import pdb; pdb.set_trace()
     nodes = pyslurm.node()
 
     sync_table(Nodes, [keyspace])
-    nodes_ids = set(node.name for node in Nodes.objects.all())
-
-    time.sleep(2)
 
-    while True:
-        update_nodes_ids = set(nodes.ids())
+    # key-only scan (cqlengine queries are limited to 10000 rows unless told otherwise)
+    nodes_ids = set(node.name for node in Nodes.objects.only(['name']).limit(None).fetch_size(5000))
+    metrics = CollectorMetrics('nodes')
+    cadence = Cadence(NODE_INTERVALS, default=(n, 6 * n)) if adaptive else None
+
+    def tick() -> TickStats:
+        nonlocal nodes_ids
+        start = time.monotonic()
+        now = time.time()
+        inserted, updated = 0, 0
+        timer = StageTimer()
+        with timer('fetch'):
+            update_nodes_ids = set(nodes.ids())
         
         if verbose:
             logging.info("Checking for new nodes")
@@ -54,7 +199,8 @@ def nodes_collector(keyspace:str, n:int = 10, verbose:bool = False):
         #new nodes was found
         for node_id in update_nodes_ids - nodes_ids:
             try:
-                node_data  = nodes.find_id(node_id)
+                with timer('fetch'):
+                    node_data  = nodes.find_id(node_id)
 
             except Exception as error:
                 logging.error(error)
@@ -64,7 +210,12 @@ def nodes_collector(keyspace:str, n:int = 10, verbose:bool = False):
             purged_data = Nodes.purge_args(**node_data)
             logging.info(f"New node was found {node_id}")
             logging.info(f"Collecting data of node {node_id}")
-            new_node = Nodes.create(**purged_data)
+            with timer('write'):
+                new_node = Nodes.create(**purged_data, last_modified=stamp())
+            metrics.inserted.inc()
+            inserted += 1
+            if cadence is not None:
+                cadence.checked(node_id, purged_data.get('state'), True, now)
 
             if verbose:
                 logging.info(f"Node data: {purged_data}")
@@ -74,57 +225,86 @@ def nodes_collector(keyspace:str, n:int = 10, verbose:bool = False):
             logging.info("Checking if any node was updated")
 
         # check if a node was changed
-        for node_id in nodes_ids:
+        for node_id in (cadence.due(nodes_ids, now) if cadence is not None else nodes_ids):
             try:
-                node_data  = nodes.find_id(node_id)
+                with timer('fetch'):
+                    node_data  = nodes.find_id(node_id)
 
             except Exception as error:
                 logging.error(error)
                 logging.info(f"Unable to get information of node {node_id}")
                 continue
             
-            purged_data = Nodes.purge_args(**node_data)
-            old_node_model = Nodes.objects.filter(name = node_id)
-            old_node = old_node_model.get()
-            updated_node = Nodes(**purged_data)
+            # the persisted row is read by the compare
+            with timer('diff'):
+                purged_data = Nodes.purge_args(**node_data)
+                old_node_model = Nodes.objects.filter(name = node_id)
+                old_node = old_node_model.get()
+                updated_cols = Nodes.updated_columns(old_node, purged_data)
 
 
-            if old_node != updated_node: #check if data of old job was changed
-                #import pdb; pdb.set_trace()
-                updated_cols = Nodes.updated_columns(old_node, updated_node)
+            if updated_cols: #check if data of old node was changed
                 logging.info(f"Node {node_id} was updated")
                 logging.info(f"Updating data of node {node_id}")
                 
-                old_node_model.update(**updated_cols)
+                with timer('write'):
+                    old_node_model.update(**updated_cols, last_modified=stamp())
+                metrics.updated.inc()
+                updated += 1
 
                 if verbose:
                     logging.info(f"Updated data: {updated_cols}")
+            else:
+                metrics.skipped.inc()
+
+            if cadence is not None:
+                cadence.checked(node_id, purged_data.get('state'), bool(updated_cols), now)
 
 
         if verbose:
             logging.info(f"Defined nodes: {update_nodes_ids}")
 
         nodes_ids = update_nodes_ids
-        time.sleep(n)
+        if cadence is not None:
+            cadence.retain(nodes_ids)
+        metrics.tracked.set(len(nodes_ids))
+        timer.observe(metrics)
+        metrics.tick.observe(time.monotonic() - start)
+        return TickStats(inserted, updated, len(nodes_ids), 0, time.monotonic() - start)
+
+    return tick
 
     # except KeyboardInterrupt:
     #     logging.info("Stop collecting information of nodes.")
 
 
-def partitions_collector(keyspace:str, n:int = 10, verbose:bool = False):
+def partitions_collector(keyspace:str, n:int = 10, verbose:bool = False,
+                         adaptive:bool = False) -> Callable[[], TickStats]:
     """
-    Collect information of partitions of a cluster with a frequency n
+    Tick collecting information of partitions of a cluster, to be run with
+    a frequency n (see Scheduler), with adaptive each partition is checked
+    on a cadence of its own (see cadence.py)
     """
     #import pdb; pdb.set_trace()
     partitions = pyslurm.partition()
 
     sync_table(Partitions, [keyspace])
-    partitions_ids = set(partition.name for partition in Partitions.objects.all())
 
-    time.sleep(5)
+    # key-only scan (cqlengine queries are limited to 10000 rows unless told otherwise)
+    partitions_ids = set(partition.name for partition in
+                         Partitions.objects.only(['name']).limit(None).fetch_size(5000))
+    metrics = CollectorMetrics('partitions')
+    cadence = Cadence(PARTITION_INTERVALS, default=(n, 6 * n)) if adaptive else None
+
     #import pdb; pdb.set_trace()
-    while True:
-        update_partitions_ids = set(partitions.ids())
+    def tick() -> TickStats:
+        nonlocal partitions_ids
+        start = time.monotonic()
+        now = time.time()
+        inserted, updated = 0, 0
+        timer = StageTimer()
+        with timer('fetch'):
+            update_partitions_ids = set(partitions.ids())
         
         if verbose:
             logging.info("Checking for new partitions")
@@ -132,15 +312,22 @@ def partitions_collector(keyspace:str, n:int = 10, verbose:bool = False):
         #new partition was created
         for partition_id in update_partitions_ids - partitions_ids:
             try:
-                partition_data  = partitions.find_id(partition_id)
+                with timer('fetch'):
+                    partition_data  = partitions.find_id(partition_id)
             except Exception as error:
                 logging.error(error)
                 logging.info(f"Unable to get information of partition {partition_id}")
+                continue
             
             purged_data = Partitions.purge_args(**partition_data)
             logging.info(f"New partition was found {partition_id}")
             logging.info(f"Collecting data of partition {partition_id}")
-            new_partition = Partitions.create(**purged_data)
+            with timer('write'):
+                new_partition = Partitions.create(**purged_data, last_modified=stamp())
+            metrics.inserted.inc()
+            inserted += 1
+            if cadence is not None:
+                cadence.checked(partition_id, purged_data.get('state'), True, now)
 
             if verbose:
                 logging.info(f"Partition data: {purged_data}")
@@ -150,53 +337,108 @@ def partitions_collector(keyspace:str, n:int = 10, verbose:bool = False):
             logging.info("Checking if any partition was updated")
 
         # check if a partition was changed
-        for partition_id in partitions_ids:
+        for partition_id in (cadence.due(partitions_ids, now) if cadence is not None else partitions_ids):
             try:
-                partition_data  = partitions.find_id(partition_id)
+                with timer('fetch'):
+                    partition_data  = partitions.find_id(partition_id)
             except Exception as error:
                 logging.error(error)
                 logging.info(f"Unable to get information of partition {partition_id}")
+                continue
 
-            purged_data = Partitions.purge_args(**partition_data)
-            old_partition_model = Partitions.objects.filter(name = partition_id)
-            old_partition = old_partition_model.get()
-            updated_partition = Partitions(**purged_data)
+            # the persisted row is read by the compare
+            with timer('diff'):
+                purged_data = Partitions.purge_args(**partition_data)
+                old_partition_model = Partitions.objects.filter(name = partition_id)
+                old_partition = old_partition_model.get()
+                updated_cols = Partitions.updated_columns(old_partition, purged_data)
 
 
-            if old_partition != updated_partition: #check if data of old job was changed
-                #import pdb; pdb.set_trace()
-                updated_cols = Jobs.updated_columns(old_job, updated_job)
+            if updated_cols: #check if data of old partition was changed
                 logging.info(f"Partition {partition_id} was updated")
                 logging.info(f"Updating data of partition {partition_id}")
                 
-                old_partition_model.update(**updated_cols)
+                with timer('write'):
+                    old_partition_model.update(**updated_cols, last_modified=stamp())
+                metrics.updated.inc()
+                updated += 1
 
                 if verbose:
                     logging.info(f"Updated data: {updated_cols}")
+            else:
+                metrics.skipped.inc()
+
+            if cadence is not None:
+                cadence.checked(partition_id, purged_data.get('state'), bool(updated_cols), now)
 
 
         if verbose:
             logging.info(f"Defined partitions: {update_partitions_ids}")
 
         partitions_ids = update_partitions_ids
-        time.sleep(n)
+        if cadence is not None:
+            cadence.retain(partitions_ids)
+        metrics.tracked.set(len(partitions_ids))
+        timer.observe(metrics)
+        metrics.tick.observe(time.monotonic() - start)
+        return TickStats(inserted, updated, len(partitions_ids), 0, time.monotonic() - start)
+
+    return tick
 
     # except KeyboardInterrupt:
     #     logging.info("Stop collecting information of partitions.")
 
 
-def jobs_collector(keyspace:str, n:int = 1, verbose:bool = False):
+def jobs_collector(keyspace:str, n:int = 1, verbose:bool = False,
+                   adaptive:bool = False) -> Callable[[], TickStats]:
     """
-    Collect information of jobs submitted in a cluster with a frequency n
+    Tick collecting information of jobs submitted in a cluster, to be run
+    with a frequency n (see Scheduler), with adaptive each job is checked
+    on a cadence of its own (see cadence.py). Finished jobs aren't polled,
+    but every REQUEUE_CHECK_EVERY ticks the requeued ones are found and
+    polled again
     """
     #import pdb; pdb.set_trace()
     sync_table(Jobs, [keyspace])
 
     jobs = pyslurm.job()
 
-    job_ids = set(job.job_id for job in Jobs.objects.all())
-    while True:
-        updated_job_ids = set(jobs.ids())
+    # jobs whose final row was persisted aren't polled anymore
+    finished_job_ids = set()
+    job_ids = set()
+    # scan of the keys and the state read by is_terminal, not every column
+    for job in Jobs.objects.only(['job_id', 'job_state']).limit(None).fetch_size(5000):
+        (finished_job_ids if Jobs.is_terminal(job) else job_ids).add(job.job_id)
+    metrics = CollectorMetrics('jobs')
+    cadence = Cadence(JOB_INTERVALS, default=(n, 60 * n)) if adaptive else None
+    ticks = 0
+
+    def tick() -> TickStats:
+        nonlocal finished_job_ids, job_ids, ticks
+        start = time.monotonic()
+        now = time.time()
+        inserted, updated = 0, 0
+        timer = StageTimer()
+        ticks += 1
+        if ticks % REQUEUE_CHECK_EVERY == 0 and finished_job_ids:
+            # a single load of every job, rather than a lookup per finished one
+            try:
+                with timer('fetch'):
+                    slurm_jobs = jobs.get()
+            except Exception as error:
+                logging.error(error)
+                logging.info("Unable to check the finished jobs")
+                slurm_jobs = {}
+            for job_id in finished_job_ids & slurm_jobs.keys():
+                if not Jobs.is_terminal(slurm_jobs[job_id]):
+                    logging.info(f"Job {job_id} was requeued")
+                    finished_job_ids.discard(job_id)
+                    job_ids.add(job_id)
+
+        with timer('fetch'):
+            slurm_job_ids = set(jobs.ids())
+        finished_job_ids &= slurm_job_ids
+        updated_job_ids = slurm_job_ids - finished_job_ids
         
         if verbose:
             logging.info("Checking for new submitted jobs")
@@ -204,7 +446,8 @@ def jobs_collector(keyspace:str, n:int = 1, verbose:bool = False):
         # new jobs was submmited
         for new_job_id in updated_job_ids - job_ids:
             try:
-                job_data = jobs.find_id(new_job_id)[0]
+                with timer('fetch'):
+                    job_data = jobs.find_id(new_job_id)[0]
 
             except Exception as error:
                 logging.error(error)
@@ -218,42 +461,68 @@ def jobs_collector(keyspace:str, n:int = 1, verbose:bool = False):
             if verbose:
                 logging.info(f"Job data: {purged_data}")
 
-            new_job = Jobs.create(**purged_data)
+            with timer('write'):
+                new_job = Jobs.create(**purged_data, last_modified=stamp())
+            metrics.inserted.inc()
+            inserted += 1
+            if cadence is not None:
+                cadence.checked(new_job_id, purged_data.get('job_state'), True, now)
 
-            
+            if Jobs.is_terminal(purged_data):
+                finished_job_ids.add(new_job_id)
 
         if verbose:
             logging.info("Checking if any job was updated")
 
         # check if data of old job was changed
-        for job_id in job_ids:
+        for job_id in (cadence.due(job_ids, now) if cadence is not None else job_ids):
             try:
-                job_data = jobs.find_id(job_id)[0]
+                with timer('fetch'):
+                    job_data = jobs.find_id(job_id)[0]
 
             except Exception as error:
                 logging.error(error)
                 logging.info(f"Unable to get information of job {job_id}")
                 continue
 
-            purged_data = Jobs.purge_args(**job_data)
-            old_job_model = Jobs.objects.filter(job_id = job_id)
-            old_job = old_job_model.get()
-            updated_job = Jobs(**purged_data)
+            # the persisted row is read by the compare
+            with timer('diff'):
+                purged_data = Jobs.purge_args(**job_data)
+                old_job_model = Jobs.objects.filter(job_id = job_id)
+                old_job = old_job_model.get()
+                updated_cols = Jobs.updated_columns(old_job, purged_data)
 
 
-            if old_job != updated_job: #check if data of old job was changed
-                #import pdb; pdb.set_trace()
-                updated_cols = Jobs.updated_columns(old_job, updated_job)
+            if updated_cols: #check if data of old job was changed
                 logging.info(f"Job {job_id} was updated")
                 logging.info(f"Updating data of job {job_id}")
                 
-                old_job_model.update(**updated_cols)
+                with timer('write'):
+                    old_job_model.update(**updated_cols, last_modified=stamp())
+                metrics.updated.inc()
+                updated += 1
+            else:
+                metrics.skipped.inc()
+
+            if cadence is not None:
+                cadence.checked(job_id, purged_data.get('job_state'), bool(updated_cols), now)
+
+            if Jobs.is_terminal(purged_data):
+                finished_job_ids.add(job_id)
 
         if verbose:
             logging.info(f"Submitted jobs: {updated_job_ids}")
 
-        job_ids = updated_job_ids
-        time.sleep(n)
+        job_ids = updated_job_ids - finished_job_ids
+        if cadence is not None:
+            cadence.retain(job_ids)
+        metrics.tracked.set(len(job_ids))
+        metrics.retired.set(len(finished_job_ids))
+        timer.observe(metrics)
+        metrics.tick.observe(time.monotonic() - start)
+        return TickStats(inserted, updated, len(job_ids), len(finished_job_ids), time.monotonic() - start)
+
+    return tick
 
     # except Exception as error:
     #     logging.error(error)
@@ -268,10 +537,99 @@ if __name__=="__main__":
                         help='Hostname or IP4 of cassandra DB server')
     parser.add_argument('-v', '--verbose', action='store_true', 
                         help='Show collected data')
-    parser.add_argument('-f', '--freq', nargs=3, default=[10, 10, 1],
-                        help='Collection frequency (NODES, PARTITIONS, JOBS)')
+    parser.add_argument('-f', '--freq', nargs=3, type=float, default=[10, 10, 1],
+                        help='Collection frequency in seconds (NODES, PARTITIONS, JOBS)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Back off the frequency of a collector while it sees no changes (threads engine), '
+                        'in polling mode each job, node and partition is also checked on a cadence of its own '
+                        'state and changes (see cadence.py)')
+    parser.add_argument('--max-freq', nargs=3, type=float, default=[60, 300, 30],
+                        help='Longest period of the collectors backing off in seconds (NODES, PARTITIONS, JOBS)')
+    parser.add_argument('-s', '--snapshot', action='store_true',
+                        help='Pull a full snapshot of slurm per tick instead of querying each id')
+    parser.add_argument('--max-in-flight', type=int, default=128,
+                        help='Maximum number of concurrent writes to cassandra (snapshot mode)')
+    parser.add_argument('--checkpoint-dir',
+                        help='Directory of the checkpoints used to warm-start the collectors (snapshot mode)')
+    parser.add_argument('--overrun', choices=['skip', 'merge'], default='skip',
+                        help='Skip or merge the ticks missed by a collector that overran its period')
+    parser.add_argument('--history', action='store_true',
+                        help='Keep the state transitions of jobs and the metric samples of nodes (snapshot mode)')
+    parser.add_argument('--queries', action='store_true',
+                        help='Keep the query tables of jobs (by user, by partition and state, by node), '
+                        'read by reader.py (snapshot mode)')
+    parser.add_argument('--rollups', action='store_true',
+                        help='Count the core-hours, started and ended jobs and queue wait per user, account '
+                        'and partition and hour (snapshot mode, threads engine)')
+    parser.add_argument('--rollup-period', type=float, default=60,
+                        help='Seconds between the flushes of the rollups')
+    parser.add_argument('--telemetry', type=float, metavar='SECONDS',
+                        help='Sample the metrics of the nodes every SECONDS, only their aggregates per window '
+                        'are written; the recent samples are served on /telemetry of the metrics endpoint '
+                        '(snapshot mode, threads engine)')
+    parser.add_argument('--telemetry-window', type=int, default=60,
+                        help='Seconds of the windows of the telemetry aggregates')
+    parser.add_argument('--telemetry-samples', type=int, default=600,
+                        help='Samples of each node kept in memory by the telemetry')
+    parser.add_argument('--index', action='store_true',
+                        help='Track the persisted rows by fingerprint instead of keeping a copy of them (snapshot mode)')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='Queue the writes and coalesce them per key, so a slow cassandra '
+                        'doesn\'t delay the ticks (snapshot mode, threads engine)')
+    parser.add_argument('--max-pending', type=int, default=100000,
+                        help='Keys queued per table before the collectors wait for the writes (write-behind)')
+    parser.add_argument('--linger', type=float, default=0,
+                        help='Seconds a queued write waits for others of its key (write-behind)')
+    parser.add_argument('--spool-dir',
+                        help='Directory of a local spool of the writes made while cassandra is down or failing, '
+                        'replayed once it recovers (snapshot mode, threads engine)')
+    parser.add_argument('--spool-budget', type=int, default=1024,
+                        help='Disk budget of the spool of each table (MB)')
+    parser.add_argument('--shards', type=int,
+                        help='Split the jobs in this many shards (job_id %% shards), shared with the other '
+                        'instances of the cluster through leases (snapshot mode, threads engine)')
+    parser.add_argument('--cluster',
+                        help='Name of the slurm cluster of the leases, one instance at a time collects '
+                        'each shard of it (snapshot mode, threads engine)')
+    parser.add_argument('--owner', default=default_owner(),
+                        help='Name of this instance in the leases')
+    parser.add_argument('--lease-ttl', type=int, default=30,
+                        help='Seconds a lease outlives its last renewal (takeover delay of a dead instance)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve the metrics of the collectors (Prometheus text format) on this port')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='Address of the metrics endpoint')
+    parser.add_argument('-e', '--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Run the snapshot collectors in threads or in an asyncio event loop (snapshot mode)')
 
     args = parser.parse_args()
+    if args.write_behind and args.engine == 'asyncio':
+        parser.error("--write-behind is only supported by the threads engine")
+    if args.spool_dir and args.engine == 'asyncio':
+        parser.error("--spool-dir is only supported by the threads engine")
+    if args.rollups and args.engine == 'asyncio':
+        parser.error("--rollups is only supported by the threads engine")
+    if args.adaptive and args.snapshot and args.engine == 'asyncio':
+        parser.error("--adaptive is only supported by the threads engine")
+    if args.telemetry and (not args.snapshot or args.engine == 'asyncio'):
+        parser.error("--telemetry needs the snapshot mode and the threads engine")
+    sharded = args.shards is not None or args.cluster is not None
+    if sharded and (not args.snapshot or args.engine == 'asyncio'):
+        parser.error("--shards and --cluster need the snapshot mode and the threads engine")
+    if args.spool_dir and not args.snapshot:
+        parser.error("--spool-dir needs the snapshot mode")
+    if args.checkpoint_dir and not args.snapshot:
+        parser.error("--checkpoint-dir needs the snapshot mode")
+    if args.history and not args.snapshot:
+        parser.error("--history needs the snapshot mode")
+    if args.index and not args.snapshot:
+        parser.error("--index needs the snapshot mode")
+    if args.write_behind and not args.snapshot:
+        parser.error("--write-behind needs the snapshot mode")
+    if args.queries and not args.snapshot:
+        parser.error("--queries needs the snapshot mode")
+    if args.rollups and not args.snapshot:
+        parser.error("--rollups needs the snapshot mode")
 
     auth_provider = None
     try:
@@ -281,7 +639,9 @@ if __name__=="__main__":
         auth_provider = PlainTextAuthProvider(username=args.user, password=password)
         del password
 
-        connection.setup(args.hosts, args.keyspace, protocol_version=3, auth_provider=auth_provider)
+        # with a spool, connect on first use (retried), so the collectors start while cassandra is down
+        connection.setup(args.hosts, args.keyspace, protocol_version=3, auth_provider=auth_provider,
+                         lazy_connect=bool(args.spool_dir), retry_connect=bool(args.spool_dir))
         # cluster = Cluster(auth_provider=auth_provider)
         # session = cluster.connect(args.keyspace)
     except Exception as error:
@@ -290,27 +650,70 @@ if __name__=="__main__":
         print(error)
         exit(1)
 
-    collector = []
     try:
-        jobs_collector(args.keyspace, 1, args.verbose)
-        # collector_func = [nodes_collector, partitions_collector, jobs_collector]
-        # collector_args = [(args.keyspace, fc, args.verbose) for fc in args.freq]
+        freqs = dict(zip([Nodes, Partitions, Jobs], args.freq))
+        max_freqs = dict(zip([Nodes, Partitions, Jobs], args.max_freq))
 
-        # for func, args in zip(collector_func, collector_args):
-        #     collector.append(threading.Thread(target=func, args=args, name=func.__name__, daemon=True))
-
-        # logging.info("Start collecting information")
-        # for thread_collector in collector:
-        #     logging.info(f"Start {thread_collector.name} thread")
-        #     thread_collector.start()
-
-        # try:
-        #     while True:
-        #         time.sleep(0.1)
-        # except KeyboardInterrupt:
-        #     logging.info("Stop collecting information.")
-        #     exit(0)
+        # json routes of the metrics endpoint, added by the collectors
+        routes = {}
+        if args.metrics_port:
+            serve(args.metrics_port, args.metrics_host, routes=routes)
+            logging.info(f"Serving metrics on http://{args.metrics_host}:{args.metrics_port}/metrics")
 
+        if args.snapshot and args.engine == 'asyncio':
+            try:
+                asyncio.run(async_collectors(args.keyspace, freqs, args.verbose,
+                                             args.max_in_flight, args.checkpoint_dir,
+                                             args.history, args.index, args.queries))
+            except KeyboardInterrupt:
+                logging.info("Stop collecting information.")
+
+        elif args.snapshot:
+            leases = None
+            if sharded:
+                sync_table(Leases, [args.keyspace])
+                leases = ShardLeases(LeaseTable(ttl=args.lease_ttl), args.owner,
+                                     args.shards or 1, args.cluster or 'default')
+                leases.start()
+                logging.info(f"Collecting the shards of {leases.cluster} leased by {leases.owner}")
+
+            scheduler = Scheduler(args.overrun)
+            for model, freq in freqs.items():
+                collector = snapshot_collector(args.keyspace, model, args.verbose,
+                                               args.max_in_flight, args.checkpoint_dir,
+                                               history=args.history, index=args.index, queries=args.queries,
+                                               write_behind=args.write_behind, max_pending=args.max_pending,
+                                               linger=args.linger, spool_dir=args.spool_dir,
+                                               spool_budget=args.spool_budget << 20, leases=leases,
+                                               rollups=args.rollups, rollup_period=args.rollup_period)
+                backoff = Backoff(freq, max_freqs[model]) if args.adaptive else None
+                scheduler.add(f"{collector.name}_collector", collector.tick, freq,
+                              setup=collector.load, teardown=collector.close, backoff=backoff)
+
+            if args.telemetry:
+                telemetry = node_telemetry(args.keyspace, args.telemetry_window, args.telemetry_samples,
+                                           args.max_in_flight, leases)
+                scheduler.add("nodes_telemetry", telemetry.tick, args.telemetry, teardown=telemetry.close)
+                routes['/telemetry'] = telemetry.handle
+
+            logging.info("Start collecting information")
+            try:
+                scheduler.run()
+            finally:
+                if leases:
+                    leases.stop()
+
+        else:
+            collector_func = {Nodes: nodes_collector, Partitions: partitions_collector, Jobs: jobs_collector}
+            scheduler = Scheduler(args.overrun)
+            for model, freq in freqs.items():
+                func = collector_func[model]
+                backoff = Backoff(freq, max_freqs[model]) if args.adaptive else None
+                scheduler.add(func.__name__, func(args.keyspace, freq, args.verbose, adaptive=args.adaptive),
+                              freq, backoff=backoff)
+
+            logging.info("Start collecting information")
+            scheduler.run()
 
     except Exception as error:
         logging.error(error)
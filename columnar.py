@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#
+# Columnar export (Arrow IPC or Parquet) of the tables, typed from the
+# columns of tables/*.py, for whole-history analytics
+#
+# Text columns are dictionary encoded (int32 indices), List columns are
+# Arrow list<value> and Map columns are Arrow map<key, value>
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import os
+import argparse
+from typing import Dict, Iterator, Tuple
+
+# THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
+from cassandra.cqlengine import columns
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ModuleNotFoundError:
+    pa = pq = None
+
+# importing tables
+from tables import TABLES
+
+FORMATS = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+
+def require_pyarrow():
+    if pa is None:
+        raise Exception("No pyarrow package installed (needed by the columnar export)")
+
+
+def value_type(column):
+    """
+    Arrow type of the values of a column (inside a collection)
+    """
+    if isinstance(column, (columns.Text, columns.Ascii)):
+        return pa.string()
+    if isinstance(column, columns.Boolean):
+        return pa.bool_()
+    if isinstance(column, (columns.Integer, columns.SmallInt, columns.TinyInt)):
+        return pa.int32()
+    if isinstance(column, (columns.BigInt, columns.Counter)):
+        return pa.int64()
+    if isinstance(column, (columns.Float, columns.Double)):
+        return pa.float64()
+    if isinstance(column, columns.List):
+        return pa.list_(value_type(column.value_col))
+    if isinstance(column, columns.Set):
+        return pa.list_(value_type(column.value_col))
+    if isinstance(column, columns.Map):
+        return pa.map_(value_type(column.key_col), value_type(column.value_col))
+    raise TypeError(f"No columnar encoding for {type(column).__name__} columns")
+
+
+def arrow_type(column):
+    """
+    Arrow type of a column of a table, text columns are dictionary encoded
+    """
+    if isinstance(column, (columns.Text, columns.Ascii)):
+        return pa.dictionary(pa.int32(), pa.string())
+    return value_type(column)
+
+
+def arrow_schema(model):
+    return pa.schema([pa.field(name, arrow_type(column)) for name, column in model._columns.items()])
+
+
+class ColumnarWriter:
+    """
+    Write the rows of a table to an Arrow IPC (memory-mappable) or Parquet
+    file in record batches.
+
+    The dictionaries of the text columns are kept for the whole file (each
+    batch only extends them), so the Arrow file holds dictionary deltas
+    """
+    def __init__(self, model, path:str, fmt:str = 'arrow', batch_rows:int = 65536):
+        require_pyarrow()
+
+        self.model = model
+        self.codec = model.codec
+        self.path = path
+        self.batch_rows = batch_rows
+        self.schema = arrow_schema(model)
+        self.rows = 0
+
+        self._text = {name for name, column in model._columns.items()
+                      if isinstance(column, (columns.Text, columns.Ascii))}
+        self._maps = {name for name, column in model._columns.items() if isinstance(column, columns.Map)}
+        # text column -> {value: index} and its values in index order
+        self._indices = {name: {} for name in self._text}
+        self._values = {name: [] for name in self._text}
+        self._batch = {name: [] for name in self.codec.columns}
+        self._size = 0
+
+        if fmt == 'arrow':
+            options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+            self._writer = pa.ipc.new_file(path, self.schema, options=options)
+        elif fmt == 'parquet':
+            self._writer = pq.ParquetWriter(path, self.schema)
+        else:
+            raise ValueError(f"Unknown columnar format: {fmt}")
+
+    def write(self, row:dict):
+        batch = self._batch
+        for name in self.codec.columns:
+            value = row.get(name)
+            if name in self._text:
+                if value is not None:
+                    indices = self._indices[name]
+                    index = indices.get(value)
+                    if index is None:
+                        index = indices[value] = len(indices)
+                        self._values[name].append(value)
+                    value = index
+            elif name in self._maps and value is not None:
+                value = list(value.items())
+            batch[name].append(value)
+
+        self._size += 1
+        if self._size >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._size:
+            return
+
+        arrays = []
+        for field in self.schema:
+            values = self._batch[field.name]
+            if field.name in self._text:
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(values, pa.int32()),
+                                                             pa.array(self._values[field.name], pa.string())))
+            else:
+                arrays.append(pa.array(values, field.type))
+
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.rows += self._size
+        self._batch = {name: [] for name in self.codec.columns}
+        self._size = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+def export_columnar(records:Iterator[Tuple[str, dict]], models:Dict[str, object], directory:str,
+                    fmt:str = 'arrow', batch_rows:int = 65536) -> Dict[str, int]:
+    """
+    Write the (table, row) records of a backup to one columnar file per table,
+    return the number of rows of each one
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    writers = {}
+    try:
+        for table, data in records:
+            model = models.get(table)
+            if model is None:
+                continue
+
+            writer = writers.get(table)
+            if writer is None:
+                path = os.path.join(directory, f"{table}{FORMATS[fmt]}")
+                writer = writers[table] = ColumnarWriter(model, path, fmt, batch_rows)
+
+            writer.write(model.codec.extract(data))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return {table: writer.rows for table, writer in writers.items()}
+
+
+def open_columnar(path:str, names:list = None, where = None):
+    """
+    Read a columnar export as a pyarrow Table, memory-mapped (no copy of
+    the Arrow file is made), optionally a subset of columns and a filter
+    (a pyarrow.compute expression, e.g. pc.field('partition') == 'debug')
+    """
+    require_pyarrow()
+
+    if path.endswith(FORMATS['parquet']):
+        return pq.read_table(path, columns=names, filters=where, memory_map=True)
+
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    if names:
+        table = table.select(names)
+    if where is not None:
+        table = table.filter(where)
+    return table
+
+
+if __name__ == "__main__":
+    from loader import read_backup
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data', help='Backup to convert (json, line-delimited json or directory of a parallel export)')
+    parser.add_argument('output', help='Directory of the columnar files (one per table)')
+    parser.add_argument('--format', choices=list(FORMATS), default='arrow', help='Columnar format')
+    parser.add_argument('--batch-rows', type=int, default=65536, help='Rows per record batch (row group)')
+
+    args = parser.parse_args()
+
+    try:
+        counts = export_columnar(read_backup(args.data), TABLES, args.output, args.format, args.batch_rows)
+        for table, rows in counts.items():
+            print(f"[+] {rows} rows of {table} table exported")
+    except Exception as error:
+        print(error)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+#
+# Streaming export of the tables of a keyspace: the rows are paged from
+# cassandra and written one json record per line as they arrive, either
+# to a single file or to shard files of token ranges scanned in parallel
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import io
+import os
+import json
+import gzip
+import time
+import uuid
+import datetime
+import multiprocessing
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List
+
+# THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
+from cassandra.query import SimpleStatement
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+
+def compression_of(path:str) -> str:
+    """
+    Compression of a file, given by its extension
+    """
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return 'none'
+
+
+def open_text(path:str, mode:str = 'r', compression:str = None):
+    """
+    Open a (maybe compressed) text file, mode is 'r' or 'w'
+    """
+    compression = compression or compression_of(path)
+
+    if compression == 'gzip':
+        return gzip.open(path, f'{mode}t', encoding='utf-8')
+
+    if compression == 'zstd':
+        if zstandard is None:
+            raise Exception("No zstandard package installed (needed by zstd compression)")
+
+        raw = open(path, f'{mode}b')
+        if mode == 'w':
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+
+    return open(path, mode, encoding='utf-8')
+
+
+def to_json(value):
+    """
+    json.dumps default for the cassandra types that json doesn't know
+    """
+    if hasattr(value, 'items'):   # OrderedMapSerializedKey
+        return dict(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (uuid.UUID, Decimal)):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def record_of(table:str, row) -> str:
+    """
+    Json line of a row of table
+    """
+    return json.dumps({"table": table, "data": row._asdict()}, default=to_json, separators=(',', ':'))
+
+
+def keyspace_tables(session, keyspace:str) -> List[str]:
+    return list(session.cluster.metadata.keyspaces[keyspace].tables)
+
+
+def export_query(session, table:str, query:str, out, params:tuple = None, fetch_size:int = 1000) -> int:
+    """
+    Write the rows of a query to out as they are paged, return the number of rows
+    """
+    statement = SimpleStatement(query, fetch_size=fetch_size)
+
+    rows = 0
+    # the result set fetches the next page only once the current one was consumed
+    for row in session.execute(statement, params):
+        out.write(record_of(table, row))
+        out.write('\n')
+        rows += 1
+
+    return rows
+
+
+def export_table(session, keyspace:str, table:str, out, fetch_size:int = 1000) -> int:
+    return export_query(session, table, f"SELECT * FROM {keyspace}.{table}", out, fetch_size=fetch_size)
+
+
+def export_keyspace(session, keyspace:str, path:str, tables:List[str] = None,
+                    fetch_size:int = 1000, compression:str = None) -> dict:
+    """
+    Export the tables of a keyspace to a line-delimited json file,
+    return the number of exported rows of each table
+    """
+    counts = {}
+    with open_text(path, 'w', compression) as out:
+        for table in tables or keyspace_tables(session, keyspace):
+            print(f"[*] Performing a backup to {table} table")
+            counts[table] = export_table(session, keyspace, table, out, fetch_size)
+
+    return counts
+
+
+def read_records(path:str, compression:str = None) -> Iterator[tuple]:
+    """
+    (table, row) records of an exported file, read line by line
+    """
+    with open_text(path, 'r', compression) as data_file:
+        for line in data_file:
+            if line.strip():
+                record = json.loads(line)
+                yield record["table"], record["data"]
+
+
+# Parallel export: the token ring of each table is split in subranges that
+# are scanned concurrently by a process pool, one shard file per subrange
+
+MIN_TOKEN = -2**63
+MAX_TOKEN = 2**63 - 1
+
+MANIFEST = "manifest.json"
+
+# seconds subtracted from the start of a backup to get its watermark
+WATERMARK_SKEW = 60
+
+# cassandra session of a worker process of the pool
+_worker_session = None
+
+
+def token_ranges(n:int) -> List[tuple]:
+    """
+    Split the Murmur3 token ring in n (start, end] ranges
+    """
+    step = (MAX_TOKEN - MIN_TOKEN) // n
+    bounds = [MIN_TOKEN + i*step for i in range(n)] + [MAX_TOKEN]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def partition_key_of(session, keyspace:str, table:str) -> List[str]:
+    return [column.name for column in session.cluster.metadata.keyspaces[keyspace].tables[table].partition_key]
+
+
+def connect_worker(hosts:List[str], keyspace:str, user:str, password:str):
+    """
+    Initializer of the worker processes: each one opens its own session
+    """
+    global _worker_session
+
+    # imported here so the parent process doesn't need to open a cluster
+    from cassandra.cluster import Cluster
+    from cassandra.auth import PlainTextAuthProvider
+
+    auth_provider = PlainTextAuthProvider(username=user, password=password) if user else None
+    _worker_session = Cluster(hosts, auth_provider=auth_provider).connect(keyspace)
+
+
+def export_range(shard:dict, retries:int = 2) -> dict:
+    """
+    Export the rows of a table in a token range to the file of its shard,
+    return the shard updated with its status
+    """
+    pk = ', '.join(shard["partition_key"])
+    query = (f"SELECT * FROM {shard['keyspace']}.{shard['table']} "
+             f"WHERE token({pk}) > %s AND token({pk}) <= %s")
+    params = (shard["start"], shard["end"])
+
+    # incremental export: only the rows stamped after the watermark of the parent
+    if shard.get("since") is not None:
+        query += " AND last_modified > %s ALLOW FILTERING"
+        params += (shard["since"],)
+
+    tmp_path = f"{shard['path']}.tmp"
+    error = None
+    for attempt in range(retries + 1):
+        try:
+            with open_text(tmp_path, 'w', shard["compression"]) as out:
+                rows = export_query(_worker_session, shard["table"], query, out,
+                                    params, shard["fetch_size"])
+            os.replace(tmp_path, shard["path"])
+            return dict(shard, status="done", rows=rows, error=None)
+        except Exception as exc:
+            error = exc
+
+    return dict(shard, status="failed", rows=0, error=str(error))
+
+
+def write_manifest(directory:str, manifest:dict):
+    tmp_path = os.path.join(directory, f"{MANIFEST}.tmp")
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST))
+
+
+def read_manifest(directory:str) -> dict:
+    with open(os.path.join(directory, MANIFEST), 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def plan_shards(session, keyspace:str, directory:str, ranges:int, tables:List[str] = None,
+                fetch_size:int = 1000, compression:str = 'gzip', since:int = None) -> List[dict]:
+    """
+    Shards (table, token range, file) of a parallel export, with since only
+    the rows modified after it (ms) are exported
+    """
+    extension = {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '')
+    keyspace_meta = session.cluster.metadata.keyspaces[keyspace]
+
+    shards = []
+    for table in tables or keyspace_tables(session, keyspace):
+        if since is not None and "last_modified" not in keyspace_meta.tables[table].columns:
+            print(f"[-] {table} table has no last_modified column, exporting it in full")
+
+        partition_key = partition_key_of(session, keyspace, table)
+        for index, (start, end) in enumerate(token_ranges(ranges)):
+            shards.append({
+                "keyspace": keyspace,
+                "table": table,
+                "index": index,
+                "start": start,
+                "end": end,
+                "partition_key": partition_key,
+                "path": os.path.join(directory, f"{table}.{index:04d}.jsonl{extension}"),
+                "compression": compression,
+                "fetch_size": fetch_size,
+                "since": since if "last_modified" in keyspace_meta.tables[table].columns else None,
+                "status": "pending",
+            })
+    return shards
+
+
+def run_shards(manifest:dict, directory:str, hosts:List[str], user:str, password:str,
+               processes:int) -> dict:
+    """
+    Export the shards of a manifest that aren't done yet with a process pool,
+    the manifest is rewritten as shards complete
+    """
+    keyspace = manifest["keyspace"]
+    shards = manifest["shards"]
+    todo = [index for index, shard in enumerate(shards) if shard["status"] != "done"]
+
+    # workers are spawned, not forked: the driver threads of the session of
+    # the parent (and its sockets) don't survive a fork
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=connect_worker, initargs=(hosts, keyspace, user, password)) as pool:
+        futures = {pool.submit(export_range, shards[index]): index for index in todo}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                shards[index] = future.result()
+            except Exception as error:
+                shards[index] = dict(shards[index], status="failed", rows=0, error=str(error))
+
+            shard = shards[index]
+            print(f"[{'+' if shard['status'] == 'done' else '-'}] {shard['table']} range {shard['index']}: "
+                  f"{shard['status']} ({shard['rows']} rows)")
+            write_manifest(directory, manifest)
+
+    return manifest
+
+
+def export_parallel(session, keyspace:str, directory:str, hosts:List[str], user:str, password:str,
+                    processes:int = None, ranges:int = None, tables:List[str] = None,
+                    fetch_size:int = 1000, compression:str = 'gzip', parent:str = None,
+                    skew:float = WATERMARK_SKEW) -> dict:
+    """
+    Export the tables of a keyspace to a directory of shards plus a manifest.
+
+    With a parent (directory of a previous backup) the export is incremental:
+    only the rows modified after the watermark of the parent are exported
+    """
+    processes = processes or os.cpu_count()
+    os.makedirs(directory, exist_ok=True)
+
+    created = time.time()
+    since = read_manifest(parent)["watermark"] if parent else None
+
+    manifest = {
+        "keyspace": keyspace,
+        "created": created,
+        "kind": "incremental" if parent else "full",
+        # rows stamped after the watermark belong to the next incremental backup
+        # (the skew covers the clocks of the collectors, rows may be exported twice)
+        "watermark": int((created - skew) * 1000),
+        "since": since,
+        "parent": os.path.relpath(parent, directory) if parent else None,
+        "ranges": ranges or 4*processes,
+        "shards": [],
+    }
+    manifest["shards"] = plan_shards(session, keyspace, directory, manifest["ranges"],
+                                     tables, fetch_size, compression, since)
+    write_manifest(directory, manifest)
+
+    return run_shards(manifest, directory, hosts, user, password, processes)
+
+
+def retry_parallel(directory:str, hosts:List[str], user:str, password:str, processes:int = None) -> dict:
+    """
+    Export again the failed (or never finished) shards of a parallel export
+    """
+    manifest = read_manifest(directory)
+    return run_shards(manifest, directory, hosts, user, password, processes or os.cpu_count())
+
+
+def backup_chain(directory:str) -> List[str]:
+    """
+    Directories of the backups to restore, in order, to get the state of
+    the (maybe incremental) backup of directory: its full backup first
+    """
+    chain = [directory]
+    manifest = read_manifest(directory)
+    while manifest.get("parent"):
+        directory = os.path.normpath(os.path.join(directory, manifest["parent"]))
+        chain.append(directory)
+        manifest = read_manifest(directory)
+
+    return chain[::-1]
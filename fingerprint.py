@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+#
+# Compact index of the rows tracked by a collector: key -> fingerprint of
+# its last persisted row plus a hash per column group, kept in numpy
+# arrays (open addressing) instead of dicts of rows
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+from hashlib import blake2b
+from typing import Any, Dict, Iterator, List, Tuple
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+from checkpoint import require_numpy
+from snapshot import Change, SnapshotCollector
+from tables.policy import Delta, RateLimited, window_due
+
+# keys of free and deleted slots (job ids and hashed names are >= 0)
+EMPTY = -1
+DELETED = -2
+
+# fingerprint of the rows whose last persisted value is unknown
+UNKNOWN = 0
+
+# fibonacci hashing of the keys to their first slot
+GOLDEN = 0x9E3779B97F4A7C15
+
+
+def key_of(key) -> int:
+    """
+    64-bit key of the index: job ids as they are, names hashed
+    """
+    if isinstance(key, int):
+        return key
+    return int.from_bytes(blake2b(str(key).encode(), digest_size=8).digest(), 'little') >> 1
+
+
+class FingerprintIndex:
+    """
+    Open-addressing (linear probing) table of int64 keys, with the uint64
+    fingerprint, the uint32 column group hashes and the persisted values
+    of the delta columns (float64, see tables/policy.py) of each one.
+
+    Every operation works on arrays of keys, a tick is a few vectorized
+    passes. Deleted slots are reclaimed when the table is rebuilt, which
+    happens once used (live plus deleted) slots reach max_load.
+
+    About 16 + 4*groups + 8*deltas bytes per slot (68 for jobs), and the
+    slots are a power of two up to max_load full: ~90 bytes per tracked
+    job when full, up to twice that right after the table grows
+    """
+    def __init__(self, groups:int = 0, capacity:int = 1024, max_load:float = 0.7, deltas:int = 0):
+        require_numpy("the fingerprint index")
+
+        self.groups = groups
+        self.deltas = deltas
+        self.max_load = max_load
+        self._allocate(max(capacity, 8))
+
+    def _allocate(self, capacity:int):
+        bits = max(3, (capacity - 1).bit_length())
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.keys = np.full(1 << bits, EMPTY, dtype=np.int64)
+        self.fingerprints = np.zeros(1 << bits, dtype=np.uint64)
+        self.hashes = np.zeros((1 << bits, self.groups), dtype=np.uint32)
+        self.values = np.zeros((1 << bits, self.deltas))
+        self.live = 0
+        self.used = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.keys)
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.fingerprints.nbytes + self.hashes.nbytes + self.values.nbytes
+
+    def __len__(self) -> int:
+        return self.live
+
+    def _home(self, keys:'np.ndarray') -> 'np.ndarray':
+        with np.errstate(over='ignore'):
+            return ((keys.astype(np.uint64) * np.uint64(GOLDEN)) >> np.uint64(64 - self.bits)).astype(np.int64)
+
+    def lookup(self, keys:'np.ndarray') -> 'np.ndarray':
+        """
+        Slot of each key, -1 for the missing ones
+        """
+        slots = np.full(len(keys), -1, dtype=np.int64)
+        position = self._home(keys)
+        pending = np.arange(len(keys))
+        while pending.size:
+            probe = position[pending]
+            found = self.keys[probe]
+            hit = found == keys[pending]
+            slots[pending[hit]] = probe[hit]
+
+            pending = pending[~hit & (found != EMPTY)]
+            position[pending] = (position[pending] + 1) & self.mask
+        return slots
+
+    def _insert(self, keys:'np.ndarray', fingerprints:'np.ndarray', hashes:'np.ndarray', values:'np.ndarray'):
+        # keys are distinct and not in the table
+        position = self._home(keys)
+        pending = np.arange(len(keys))
+        while pending.size:
+            probe = position[pending]
+            free = self.keys[probe] == EMPTY
+
+            # a single key claims each free slot per pass
+            slots, first = np.unique(probe[free], return_index=True)
+            winners = pending[free][first]
+            self.keys[slots] = keys[winners]
+            self.fingerprints[slots] = fingerprints[winners]
+            self.hashes[slots] = hashes[winners]
+            self.values[slots] = values[winners]
+
+            placed = np.zeros(len(keys), dtype=bool)
+            placed[winners] = True
+            pending = pending[~placed[pending]]
+            position[pending] = (position[pending] + 1) & self.mask
+
+        self.live += len(keys)
+        self.used += len(keys)
+
+    def _rebuild(self, capacity:int):
+        live = self.keys >= 0
+        keys, fingerprints = self.keys[live], self.fingerprints[live]
+        hashes, values = self.hashes[live], self.values[live]
+        self._allocate(capacity)
+        self._insert(keys, fingerprints, hashes, values)
+
+    def put(self, keys:'np.ndarray', fingerprints:'np.ndarray', hashes:'np.ndarray' = None,
+            values:'np.ndarray' = None):
+        """
+        Set the fingerprint (and group hashes and delta values) of distinct keys
+        """
+        if hashes is None:
+            hashes = np.zeros((len(keys), self.groups), dtype=np.uint32)
+        if values is None:
+            values = np.zeros((len(keys), self.deltas))
+
+        slots = self.lookup(keys)
+        found = slots >= 0
+        self.fingerprints[slots[found]] = fingerprints[found]
+        self.hashes[slots[found]] = hashes[found]
+        self.values[slots[found]] = values[found]
+
+        new = ~found
+        count = int(new.sum())
+        if not count:
+            return
+
+        if self.used + count > self.max_load * self.capacity:
+            needed = (self.live + count) / self.max_load
+            self._rebuild(int(needed * 1.25))
+        self._insert(keys[new], fingerprints[new], hashes[new], values[new])
+
+    def _delete(self, slots:'np.ndarray'):
+        slots = slots[self.keys[slots] >= 0]
+        self.keys[slots] = DELETED
+        self.live -= len(slots)
+
+    def remove(self, keys:'np.ndarray'):
+        slots = self.lookup(keys)
+        self._delete(slots[slots >= 0])
+
+    def retain(self, slots:'np.ndarray'):
+        """
+        Remove every key but the ones of slots (e.g. the ones found in a snapshot)
+        """
+        keep = np.zeros(self.capacity, dtype=bool)
+        keep[slots[slots >= 0]] = True
+        self._delete(np.flatnonzero(~keep))
+
+    def items(self) -> Iterator[Tuple[int, int]]:
+        """
+        (key, fingerprint) pairs, e.g. to save a checkpoint
+        """
+        live = self.keys >= 0
+        return zip(self.keys[live].tolist(), self.fingerprints[live].tolist())
+
+
+class IndexedSnapshotCollector(SnapshotCollector):
+    """
+    SnapshotCollector tracking its rows in a FingerprintIndex instead of
+    shadow rows: unchanged rows are skipped comparing fingerprints, and
+    an update writes the columns of the groups whose hash changed (every
+    column when they are unknown, e.g. after a restart).
+
+    The state columns and the columns read by the history models are
+    groups of their own, so they are only written when they changed.
+
+    So is each volatile column (see tables/policy.py): they aren't part of
+    the fingerprints, the index keeps the persisted values of the delta
+    ones, and the rows are checked for changes of the rate-limited ones
+    when their refresh window ends
+    """
+    def __init__(self, model, source, *args, group_size:int = 16, **kwargs):
+        super().__init__(model, source, *args, **kwargs)
+
+        isolate = list(self.state_columns)
+        for history_model in self.history:
+            isolate.extend(name for name in history_model.TRIGGERS if name in self.codec.columns)
+        volatile = {name: rule for name, rule in self.codec.volatile.items() if name in self.codec.columns}
+        isolate.extend(volatile)
+        self.bounds = self.codec.group_bounds(tuple(isolate), group_size)
+        self.group_columns = [self.codec.columns[start:end] for start, end in self.bounds]
+
+        self.volatile_columns = list(volatile)
+        self.deltas = [name for name, rule in volatile.items() if isinstance(rule, Delta)]
+        self.thresholds = np.array([volatile[name].threshold for name in self.deltas])
+        # (group, seconds) of each rate-limited column
+        self.limited = [(self.group_columns.index((name,)), rule.seconds)
+                        for name, rule in volatile.items() if isinstance(rule, RateLimited)]
+
+        self.fingerprints = FingerprintIndex(len(self.bounds), deltas=len(self.deltas))
+        self._pending = None
+
+    def load(self):
+        super().load()
+
+        # the fingerprints of the checkpoint (or the scanned keys) move to the index
+        fingerprints = self.fingerprints
+        self.fingerprints = FingerprintIndex(len(self.bounds), capacity=int(2 * len(fingerprints)),
+                                             deltas=len(self.deltas))
+        if fingerprints:
+            keys = np.fromiter((key_of(key) for key in fingerprints), np.int64, len(fingerprints))
+            values = np.array([fingerprint or UNKNOWN for fingerprint in fingerprints.values()], dtype=np.uint64)
+            self.fingerprints.put(keys, values)
+
+    def diff(self, snapshot:Dict[Any, dict]) -> List[Change]:
+        """
+        Compute the rows of a snapshot that should be inserted or updated
+        """
+        extract, fingerprint = self.codec.extract, self.codec.fingerprint
+        retired, retire = self.retired, self.retire
+        index, deltas = self.fingerprints, self.deltas
+        last, now = self.last_diff, time.time()
+        self.last_diff = now
+
+        # rows aren't kept, the changed ones are extracted again
+        keys, fingerprints, values = [], [], []
+        for key, data in snapshot.items():
+            if key in retired:
+                if retire(data):
+                    continue
+                # e.g. a requeued job, its row is written again
+                retired.discard(key)
+
+            row = extract(data)
+            row[self.key] = key
+            keys.append(key)
+            fingerprints.append(fingerprint(row))
+            if deltas:
+                values.append([row.get(name) for name in deltas])
+
+        index_keys = np.fromiter((key_of(key) for key in keys), np.int64, len(keys))
+        fingerprints = np.array(fingerprints, dtype=np.uint64)
+        # nulls are nan
+        values = np.array(values, dtype=float).reshape(len(keys), len(deltas))
+        slots = index.lookup(index_keys)
+        found = slots >= 0
+        old = np.where(found, index.fingerprints[slots], UNKNOWN)
+        stale = ~found | (old == UNKNOWN) | (old != fingerprints)
+
+        # rows whose volatile columns are tracked (known group hashes), the
+        # ones adopted by fingerprint write theirs once
+        hashed = index.hashes[slots].any(axis=1)
+        known = found & ~stale & hashed
+        adopted = found & ~stale & ~hashed if self.volatile_columns else np.zeros(len(keys), dtype=bool)
+        significant = np.zeros(len(keys), dtype=bool)
+        if deltas:
+            persisted = index.values[slots]
+            moved = (np.abs(values - persisted) >= self.thresholds) | (np.isnan(values) != np.isnan(persisted))
+            significant = known & moved.any(axis=1)
+        due = np.zeros((len(keys), len(self.limited)), dtype=bool)
+        for column, (group, seconds) in enumerate(self.limited):
+            due[:, column] = known & window_due(seconds, index_keys, last, now)
+
+        candidates = np.flatnonzero(stale | significant | due.any(axis=1) | adopted)
+        rows = [self.row_of(snapshot, keys[position]) for position in candidates.tolist()]
+        hashes = np.array([self.codec.group_hashes(row, self.bounds) for row in rows],
+                          dtype=np.uint32).reshape(len(candidates), len(self.bounds))
+        limited_groups = [group for group, seconds in self.limited]
+
+        changes, emitted = [], []
+        rewrites = self._rewrites = set()
+        for number, (position, row, group_hashes) in enumerate(zip(candidates.tolist(), rows, hashes)):
+            key = keys[position]
+            if old[position] == UNKNOWN:
+                if found[position]:
+                    rewrites.add(key)
+                changes.append(Change(key, row, None))
+                emitted.append(number)
+                continue
+            if adopted[position]:
+                changes.append(Change(key, row, {name: row.get(name) for name in self.volatile_columns}))
+                emitted.append(number)
+                continue
+
+            old_hashes = index.hashes[slots[position]]
+            differs = group_hashes != old_hashes
+            if not stale[position] and not significant[position] and \
+                    not differs[limited_groups][due[position]].any():
+                # the due rate-limited columns didn't change
+                continue
+
+            groups = np.flatnonzero(differs) if old_hashes.any() else ()
+            if len(groups):
+                cols = {name: row.get(name) for group in groups for name in self.group_columns[group]}
+            elif stale[position]:
+                # unknown group hashes (or a collision of them)
+                cols = {name: value for name, value in row.items() if name != self.key}
+            else:
+                continue
+            changes.append(Change(key, row, cols))
+            emitted.append(number)
+
+        changed, hashes = candidates[emitted], hashes[emitted]
+        self._pending = (keys, index_keys, fingerprints, values, slots, changed, hashes)
+        return changes
+
+    def row_of(self, snapshot:Dict[Any, dict], key) -> dict:
+        row = self.codec.extract(snapshot[key])
+        row[self.key] = key
+        return row
+
+    def commit(self, snapshot:Dict[Any, dict], changes:List[Change], failed:set = frozenset()):
+        """
+        Update the index once the changes of a tick were persisted,
+        failed changes are retried on the next tick
+        """
+        index = self.fingerprints
+        keys, index_keys, fingerprints, values, slots, changed, hashes = self._pending
+        self._pending = None
+
+        # rows adopted by fingerprint get their group hashes once
+        # (found before the index changes, a rebuild moves the slots)
+        unchanged = np.ones(len(index_keys), dtype=bool)
+        unchanged[changed] = False
+        adopted = np.flatnonzero(unchanged & ~index.hashes[slots].any(axis=1)) if len(self.bounds) else []
+
+        # entities that left slurm are no longer tracked (their rows are kept)
+        index.retain(slots)
+
+        done, retired = [], []
+        for position, change in zip(changed.tolist(), changes):
+            if change.key in failed:
+                continue
+            self.states.pop(change.key, None)
+            if self.retire and self.retire(change.row):
+                retired.append(position)
+                self.retired.add(change.key)
+            else:
+                done.append(position)
+
+        index.remove(index_keys[retired])
+        index.put(index_keys[done], fingerprints[done], hashes[np.searchsorted(changed, done)], values[done])
+
+        if len(adopted):
+            adopted_hashes = np.array([self.codec.group_hashes(self.row_of(snapshot, keys[position]), self.bounds)
+                                       for position in adopted],
+                                      dtype=np.uint32).reshape(len(adopted), len(self.bounds))
+            index.put(index_keys[adopted], fingerprints[adopted], adopted_hashes, values[adopted])
+
+        self.forget(failed, changes)
+        self.end_tick(snapshot)
+
+    def forget(self, keys:set, changes:List[Change] = ()):
+        if keys:
+            index_keys = np.fromiter((key_of(key) for key in keys), np.int64, len(keys))
+            self.fingerprints.put(index_keys, np.full(len(keys), UNKNOWN, dtype=np.uint64))
+        self.retired -= set(keys)
+        self.forget_states(keys, changes)
+        self.forget_placements(keys)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+#
+# Bulk restore of backups: the input is streamed and its rows are bound
+# to prepared statements sent with bounded concurrency
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import os
+import re
+import json
+import time
+from typing import Dict, Iterator, Tuple
+
+# THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
+from cassandra.concurrent import execute_concurrent
+
+from exporter import backup_chain, open_text, read_manifest, read_records
+from statements import StatementCache
+
+
+# first value of a backup: '[' for the {"table": [rows]} layout (test.json),
+# anything else for the line-delimited {"table": ..., "data": ...} records
+LAYOUT = re.compile(r'\s*\{\s*"(?:[^"\\]|\\.)*"\s*:\s*(\S)')
+
+
+class JsonLayoutReader:
+    """
+    Incremental reader of the {"table": [row, ...], ...} layout,
+    rows are decoded one at a time without loading the whole file
+    """
+    def __init__(self, data_file, chunk_size:int = 1 << 16):
+        self.data_file = data_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.data_file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop what was already consumed
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of backup file")
+
+    def _expect(self, char:str):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos} of the backup file")
+        self.pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # the value may continue in the next chunk
+                if not self._fill():
+                    raise
+                continue
+            # a number may also continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def __iter__(self) -> Iterator[Tuple[str, dict]]:
+        self._expect('{')
+        if self._peek() == '}':
+            return
+
+        while True:
+            table = self._value()
+            self._expect(':')
+            self._expect('[')
+            if self._peek() != ']':
+                while True:
+                    yield table, self._value()
+                    if self._peek() == ',':
+                        self.pos += 1
+                        continue
+                    break
+            self._expect(']')
+
+            if self._peek() == ',':
+                self.pos += 1
+                continue
+            self._expect('}')
+            return
+
+
+def read_restore(path:str, compression:str = None) -> Iterator[Tuple[str, dict, bool]]:
+    """
+    (table, row, incremental) records of a backup: a json file with the
+    test.json layout, a line-delimited file or a directory of shards of a
+    parallel export (restored after the backups of its chain when it's
+    incremental, whose rows have incremental set)
+    """
+    if os.path.isdir(path):
+        # a full backup followed by its incremental backups
+        for directory in backup_chain(path):
+            manifest = read_manifest(directory)
+            incremental = manifest.get('kind') == 'incremental'
+            print(f"[*] Reading {manifest.get('kind', 'full')} backup {directory}")
+            for shard in manifest["shards"]:
+                if shard["status"] != "done":
+                    print(f"[-] Skipping unfinished shard {shard['path']}")
+                    continue
+                shard_path = os.path.join(directory, os.path.basename(shard["path"]))
+                for table, row in read_records(shard_path, shard["compression"]):
+                    yield table, row, incremental
+        return
+
+    with open_text(path, 'r', compression) as data_file:
+        head = data_file.read(4096)
+
+    match = LAYOUT.match(head)
+    if match and match.group(1) == '[':
+        with open_text(path, 'r', compression) as data_file:
+            for table, row in JsonLayoutReader(data_file):
+                yield table, row, False
+    else:
+        for table, row in read_records(path, compression):
+            yield table, row, False
+
+
+def read_backup(path:str, compression:str = None) -> Iterator[Tuple[str, dict]]:
+    """
+    (table, row) records of a backup (see read_restore)
+    """
+    for table, row, incremental in read_restore(path, compression):
+        yield table, row
+
+
+class BulkLoader:
+    """
+    Insert the rows of a backup binding them to prepared statements,
+    sent with execute_concurrent in chunks of rows
+    """
+    def __init__(self, session, models:Dict[str, object], concurrency:int = 100,
+                 chunk_size:int = 5000, report_every:float = 5):
+        self.session = session
+        self.models = models
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.report_every = report_every
+
+        self.statements = {name: StatementCache(session, model) for name, model in models.items()}
+        self.loaded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def _send(self, chunk:dict):
+        # a single call for the whole chunk, the rows bound to different
+        # statements (e.g. other null cells) are sent concurrently too
+        owners = [number for number, writes in enumerate(chunk.values()) for write in writes]
+        results = execute_concurrent(self.session, [write for writes in chunk.values() for write in writes],
+                                     concurrency=self.concurrency, raise_on_first_error=False)
+        failed = set()
+        for number, (success, result) in zip(owners, results):
+            if not success:
+                failed.add(number)
+                print(f"[-] {result}")
+        self.loaded += len(chunk) - len(failed)
+        self.failed += len(failed)
+
+    def load(self, records:Iterator[Tuple[str, dict, bool]]) -> int:
+        """
+        Insert every (table, row, incremental) record, return the number of
+        inserted rows. Inserts skip the null cells, so the null columns of
+        the rows of an incremental backup (maybe cleared since its parent)
+        are cleared by an update
+        """
+        start = last_report = time.monotonic()
+
+        # (table, primary key) -> bound writes, the rows of a chunk are sent
+        # concurrently so only the last record of a row (e.g. the one of an
+        # incremental backup) is kept, chunks are sent one after the other
+        chunk = {}
+        for table, data, incremental in records:
+            model = self.models.get(table)
+            if model is None:
+                self.skipped += 1
+                continue
+
+            row = model.codec.extract(data)
+            keys = model.codec.keys
+            writes = [self.statements[table].insert(row)]
+            cleared = {name: None for name, value in row.items() if value is None and name not in keys}
+            if incremental and cleared:
+                writes.append(self.statements[table].update({name: row[name] for name in keys}, cleared))
+            chunk[(table, tuple(row.get(name) for name in keys))] = writes
+
+            if len(chunk) >= self.chunk_size:
+                self._send(chunk)
+                chunk = {}
+
+                now = time.monotonic()
+                if now - last_report >= self.report_every:
+                    print(f"[*] {self.loaded} rows loaded ({self.loaded / (now - start):.0f} rows/s)")
+                    last_report = now
+
+        self._send(chunk)
+
+        elapsed = time.monotonic() - start
+        print(f"[*] {self.loaded} rows loaded in {elapsed:.1f}s "
+              f"({self.loaded / max(elapsed, 1e-9):.0f} rows/s, {self.failed} failed, {self.skipped} skipped)")
+        return self.loaded
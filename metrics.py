@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+#
+# In-process metrics of the collectors (counters, gauges and latency
+# histograms) exposed in the Prometheus text format on a local endpoint
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+# seconds, from a millisecond write to a tick of a minute
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount:float = 1):
+        self.value += amount
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value:float):
+        self.value = value
+
+    def inc(self, amount:float = 1):
+        self.value += amount
+
+
+class HistogramChild:
+    def __init__(self, buckets:Tuple[float]):
+        self.buckets = buckets
+        # one count per bucket plus the +Inf one (not cumulative)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """
+    Family of series of a metric, one per value of its labels.
+
+    The hot loops keep the child of their labels (see labels()), so an
+    update is an attribute increment. Children aren't locked: each series
+    is updated by a single thread (the one of its collector)
+    """
+    kind = None
+
+    def __init__(self, name:str, help:str, labels:List[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        child = self.children.get(key)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(key, self._new_child())
+        return child
+
+    def samples(self) -> List[Tuple[str, dict, float]]:
+        """
+        (name, labels, value) samples of every series
+        """
+        return [(self.name, dict(zip(self.label_names, key)), child.value)
+                for key, child in list(self.children.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name:str, help:str, labels:List[str] = (), buckets:Tuple[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def samples(self) -> List[Tuple[str, dict, float]]:
+        samples = []
+        for key, child in list(self.children.items()):
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), list(child.counts)):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", dict(labels, le=format_value(bound)), cumulative))
+            samples.append((f"{self.name}_sum", labels, child.sum))
+            samples.append((f"{self.name}_count", labels, child.count))
+        return samples
+
+
+def format_value(value:float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value:str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Registry:
+    """
+    Metrics of a process, created once by name
+    """
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name:str, help:str, labels:List[str], **kwargs) -> Metric:
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError(f"Metric {name} was already registered with other type or labels")
+            return metric
+
+    def counter(self, name:str, help:str, labels:List[str] = ()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name:str, help:str, labels:List[str] = ()) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name:str, help:str, labels:List[str] = (),
+                  buckets:Tuple[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def collect(self) -> Dict[str, Dict[tuple, float]]:
+        """
+        Current samples: sample name -> {sorted (label, value) pairs: value}
+        """
+        collected = {}
+        for metric in list(self.metrics.values()):
+            for name, labels, value in metric.samples():
+                collected.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+        return collected
+
+    def value(self, name:str, **labels) -> float:
+        """
+        Value of a sample (e.g. registry.value('collector_rows_total', collector='jobs', op='inserted'))
+        """
+        return self.collect().get(name, {}).get(tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+    def render(self) -> str:
+        """
+        Samples in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    pairs = ','.join(f'{label}="{escape(label_value)}"' for label, label_value in labels.items())
+                    lines.append(f"{name}{{{pairs}}} {format_value(value)}")
+                else:
+                    lines.append(f"{name} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+# registry of the collectors of this process
+REGISTRY = Registry()
+
+
+class CollectorMetrics:
+    """
+    Series of a collector (jobs, nodes or partitions)
+    """
+    def __init__(self, name:str, registry:Registry = REGISTRY):
+        labels = {'collector': name}
+        self.fetch = registry.histogram('collector_fetch_seconds', 'Time spent fetching slurm data per tick',
+                                        ['collector']).labels(**labels)
+        self.diff = registry.histogram('collector_diff_seconds', 'Time spent diffing slurm data per tick',
+                                       ['collector']).labels(**labels)
+        self.write = registry.histogram('collector_write_seconds', 'Time spent persisting the changes of a tick',
+                                        ['collector']).labels(**labels)
+        self.tick = registry.histogram('collector_tick_seconds', 'Duration of the ticks',
+                                       ['collector']).labels(**labels)
+
+        rows = registry.counter('collector_rows_total', 'Rows inserted, updated, skipped (unchanged) '
+                                'or failed', ['collector', 'op'])
+        self.inserted = rows.labels(op='inserted', **labels)
+        self.updated = rows.labels(op='updated', **labels)
+        self.skipped = rows.labels(op='skipped', **labels)
+        self.failed = rows.labels(op='failed', **labels)
+
+        self.tracked = registry.gauge('collector_tracked_rows', 'Rows of the working set',
+                                      ['collector']).labels(**labels)
+        self.retired = registry.gauge('collector_retired_rows', 'Rows in a terminal state out of the working set',
+                                      ['collector']).labels(**labels)
+
+
+class StageTimer:
+    """
+    Time spent in the fetch, diff and write stages of a tick whose stages
+    are interleaved (e.g. a polling tick, row by row)
+    """
+    def __init__(self):
+        self.elapsed = {'fetch': 0.0, 'diff': 0.0, 'write': 0.0}
+
+    @contextmanager
+    def __call__(self, stage:str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.elapsed[stage] += time.monotonic() - start
+
+    def observe(self, metrics:CollectorMetrics):
+        for stage, elapsed in self.elapsed.items():
+            getattr(metrics, stage).observe(elapsed)
+
+
+class TaskMetrics:
+    """
+    Series of a task of the scheduler
+    """
+    def __init__(self, name:str, registry:Registry = REGISTRY):
+        labels = {'task': name}
+        self.overruns = registry.counter('scheduler_overruns_total', 'Ticks that overran their period',
+                                         ['task']).labels(**labels)
+        self.skipped = registry.counter('scheduler_skipped_ticks_total', 'Ticks skipped or merged by overruns',
+                                        ['task']).labels(**labels)
+        self.errors = registry.counter('scheduler_errors_total', 'Ticks that raised an error',
+                                       ['task']).labels(**labels)
+        self.lag = registry.gauge('scheduler_tick_lag_seconds', 'Delay of the start of the last tick',
+                                  ['task']).labels(**labels)
+        self.period = registry.gauge('scheduler_period_seconds', 'Period of the task (adapted by its backoff)',
+                                     ['task']).labels(**labels)
+
+
+class QueueMetrics:
+    """
+    Series of a write-behind queue (see writebehind.py)
+    """
+    def __init__(self, name:str, registry:Registry = REGISTRY):
+        labels = {'queue': name}
+        self.depth = registry.gauge('writebehind_queue_depth', 'Keys waiting to be written',
+                                    ['queue']).labels(**labels)
+        self.in_flight = registry.gauge('writebehind_in_flight', 'Keys being written',
+                                        ['queue']).labels(**labels)
+        self.coalesced = registry.counter('writebehind_coalesced_total', 'Writes merged into a queued write '
+                                          'of the same key', ['queue']).labels(**labels)
+        self.written = registry.counter('writebehind_written_total', 'Keys written',
+                                        ['queue']).labels(**labels)
+        self.failed = registry.counter('writebehind_failed_total', 'Partitions whose writes failed',
+                                       ['queue']).labels(**labels)
+        self.blocked = registry.counter('writebehind_blocked_seconds_total', 'Time the producers waited '
+                                        'for room in the queue (backpressure)', ['queue']).labels(**labels)
+        self.flush = registry.histogram('writebehind_flush_seconds', 'Duration of the writes of a batch of keys',
+                                        ['queue']).labels(**labels)
+
+
+class SpoolMetrics:
+    """
+    Series of the local spool of a collector (see spool.py)
+    """
+    def __init__(self, name:str, registry:Registry = REGISTRY):
+        labels = {'spool': name}
+        self.spooled = registry.counter('spool_records_total', 'Writes appended to the spool',
+                                        ['spool']).labels(**labels)
+        self.replayed = registry.counter('spool_replayed_total', 'Spooled writes replayed to cassandra',
+                                         ['spool']).labels(**labels)
+        self.rejected = registry.counter('spool_rejected_total', 'Writes rejected by a full spool',
+                                         ['spool']).labels(**labels)
+        self.bytes = registry.gauge('spool_bytes', 'Disk used by the segments of the spool',
+                                    ['spool']).labels(**labels)
+        self.degraded = registry.gauge('spool_degraded', 'Whether the writes are being spooled (1) '
+                                       'or sent to cassandra (0)', ['spool']).labels(**labels)
+
+
+class ReaderMetrics:
+    """
+    Series of the read API of the query tables (see reader.py)
+    """
+    def __init__(self, name:str, registry:Registry = REGISTRY):
+        labels = {'reader': name}
+        reads = registry.counter('reader_partitions_total', 'Partitions read, from the cache (hit) '
+                                 'or from cassandra (miss)', ['reader', 'result'])
+        self.hits = reads.labels(result='hit', **labels)
+        self.misses = reads.labels(result='miss', **labels)
+        self.entries = registry.gauge('reader_cache_entries', 'Partitions held by the cache',
+                                      ['reader']).labels(**labels)
+        self.read = registry.histogram('reader_read_seconds', 'Duration of the reads of a query',
+                                       ['reader']).labels(**labels)
+
+
+class RollupMetrics:
+    """
+    Series of the usage rollups of a collector (see rollup.py)
+    """
+    def __init__(self, name:str, registry:Registry = REGISTRY):
+        labels = {'rollup': name}
+        self.running = registry.gauge('rollup_running_jobs', 'Running jobs accounted by the rollups',
+                                      ['rollup']).labels(**labels)
+        self.flushed = registry.counter('rollup_rows_flushed_total', 'Rollup rows incremented',
+                                        ['rollup']).labels(**labels)
+        self.failed = registry.counter('rollup_failed_total', 'Partitions whose increments failed '
+                                       '(kept for the next flush)', ['rollup']).labels(**labels)
+        self.flush = registry.histogram('rollup_flush_seconds', 'Duration of the flushes of the rollups',
+                                        ['rollup']).labels(**labels)
+
+
+class TelemetryMetrics:
+    """
+    Series of the telemetry sampler of the nodes (see telemetry.py)
+    """
+    def __init__(self, name:str, registry:Registry = REGISTRY):
+        labels = {'telemetry': name}
+        self.samples = registry.counter('telemetry_samples_total', 'Samples taken of every node',
+                                        ['telemetry']).labels(**labels)
+        self.nodes = registry.gauge('telemetry_nodes', 'Nodes of the last sample',
+                                    ['telemetry']).labels(**labels)
+        self.written = registry.counter('telemetry_rows_written_total', 'Rows of window aggregates written',
+                                        ['telemetry']).labels(**labels)
+        self.failed = registry.counter('telemetry_failed_total', 'Rows of window aggregates whose write '
+                                       'failed (sent again on the next flush)', ['telemetry']).labels(**labels)
+        self.flush = registry.histogram('telemetry_flush_seconds', 'Duration of the writes of the aggregates',
+                                        ['telemetry']).labels(**labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+    # path -> callable(query parameters) returning a json value (e.g. the
+    # recent samples of telemetry.py), served along with the metrics
+    routes = {}
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        route = self.routes.get(path)
+        if route is not None:
+            try:
+                body = json.dumps(route(parse_qs(query))).encode('utf-8')
+            except ValueError as error:
+                self.send_error(400, str(error))
+                return
+            content_type = 'application/json'
+        elif path in ('/', '/metrics'):
+            body = self.registry.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes aren't logged
+        pass
+
+
+def serve(port:int, host:str = '127.0.0.1', registry:Registry = REGISTRY,
+          routes:Dict[str, Callable[[dict], object]] = None) -> ThreadingHTTPServer:
+    """
+    Serve the metrics of registry on http://host:port/metrics from a daemon thread,
+    and the json of routes on their paths (routes may be added after the start)
+    """
+    handler = type('Handler', (MetricsHandler,), {'registry': registry,
+                                                  'routes': {} if routes is None else routes})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
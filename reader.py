@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#
+# Read API of the query tables (tables/queries.py): the common dashboard
+# queries of jobs as single-partition reads, with a TTL/LRU result cache
+#
+# Usage: python reader.py -u USER -k KEYSPACE user 1000 [--days 1] [--state RUNNING]
+#        python reader.py -u USER -k KEYSPACE partition batch --state PENDING
+#        python reader.py -u USER -k KEYSPACE node cn001 --days 2
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import json
+import time
+import argparse
+import threading
+from getpass import getpass
+from collections import OrderedDict
+from typing import Callable, Iterable, List
+
+# THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
+from cassandra.cqlengine import connection
+
+from metrics import REGISTRY, ReaderMetrics, Registry
+from tables import JobsByNode, JobsByPartitionState, JobsByUser
+from tables.history import bucket_of
+from tables.jobs import TERMINAL_STATES
+from tables.queries import LIVE_BUCKET
+
+
+class QueryCache:
+    """
+    LRU cache of read results, an entry expires ttl seconds after it was read
+    """
+    def __init__(self, max_entries:int = 1024, ttl:float = 10.0, clock:Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+
+        # key -> (expires at, value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Cached value of key, None if it's missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class JobReader:
+    """
+    Queries of jobs over the query tables. A query reads the live bucket
+    and the buckets of the last days (ended jobs) of its partitions in
+    parallel, each partition being cached for ttl seconds.
+
+    Rows are dicts of the columns of the query table, sorted by job_id
+    (newest first); rows of the cache are shared, so they must not be modified
+    """
+    def __init__(self, session = None, cache_size:int = 1024, ttl:float = 10.0,
+                 name:str = 'default', registry:Registry = REGISTRY):
+        self._session = session
+        self.cache = QueryCache(cache_size, ttl)
+        self.metrics = ReaderMetrics(name, registry)
+        self._statements = {}
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = connection.get_session()
+        return self._session
+
+    def _statement(self, model):
+        prepared = self._statements.get(model)
+        if prepared is None:
+            where = ' AND '.join(f"{name} = ?" for name in model._partition_keys)
+            prepared = self._statements[model] = self.session.prepare(
+                f"SELECT * FROM {model.column_family_name()} WHERE {where}")
+        return prepared
+
+    def read(self, model, partitions:Iterable[tuple]) -> List[dict]:
+        """
+        Rows of some partitions of a query table
+        """
+        start = time.monotonic()
+        rows, futures = [], []
+        for partition in partitions:
+            cached = self.cache.get((model, partition))
+            if cached is not None:
+                self.metrics.hits.inc()
+                rows.extend(cached)
+            else:
+                self.metrics.misses.inc()
+                futures.append((partition, self.session.execute_async(self._statement(model), partition)))
+
+        for partition, future in futures:
+            # rows are dicts with the session of cqlengine, named tuples otherwise
+            result = [row if isinstance(row, dict) else row._asdict() for row in future.result()]
+            self.cache.put((model, partition), result)
+            rows.extend(result)
+
+        self.metrics.entries.set(len(self.cache))
+        self.metrics.read.observe(time.monotonic() - start)
+        return sorted(rows, key=lambda row: row['job_id'], reverse=True)
+
+    @staticmethod
+    def buckets(days:int, now:float = None) -> List[int]:
+        """
+        Live bucket and the buckets of the last days (today included)
+        """
+        today = bucket_of(now or time.time())
+        return [LIVE_BUCKET, *range(today, today - days, -1)]
+
+    @staticmethod
+    def _filter(rows:List[dict], states) -> List[dict]:
+        if states is None:
+            return rows
+        states = {states} if isinstance(states, str) else set(states)
+        return [row for row in rows if row['job_state'] in states]
+
+    def jobs_of_user(self, user_id:int, states = None, days:int = 0) -> List[dict]:
+        """
+        Live jobs of a user and the ones that ended in the last days,
+        e.g. jobs_of_user(1000, 'RUNNING')
+        """
+        rows = self.read(JobsByUser, [(user_id, bucket) for bucket in self.buckets(days)])
+        return self._filter(rows, states)
+
+    def jobs_in_partition(self, partition:str, states, days:int = 1) -> List[dict]:
+        """
+        Jobs of a partition in some states: the live ones, and for terminal
+        states the ones that ended in the last days (at least today)
+        """
+        states = [states] if isinstance(states, str) else list(states)
+        keys = []
+        for state in states:
+            if state in TERMINAL_STATES:
+                keys.extend((partition, state, bucket) for bucket in self.buckets(max(days, 1))[1:])
+            else:
+                keys.append((partition, state, LIVE_BUCKET))
+        return self.read(JobsByPartitionState, keys)
+
+    def jobs_on_node(self, node:str, states = None, days:int = 0) -> List[dict]:
+        """
+        Live jobs allocated to a node and the ones that ended in the last days
+        """
+        rows = self.read(JobsByNode, [(node, bucket) for bucket in self.buckets(days)])
+        return self._filter(rows, states)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--user', help='Role of cassandra DB')
+    parser.add_argument('-k', '--keyspace', required=True, help='Cassandra keyspace')
+    parser.add_argument('--hosts', default=["127.0.0.1"], nargs='+',
+                        help='Cassandra hosts')
+    parser.add_argument('--days', type=int, default=0,
+                        help='Days of ended jobs to add to the live ones (today included)')
+    parser.add_argument('-s', '--state', action='append',
+                        help='Only jobs in this state (required by partition queries), can be repeated')
+    parser.add_argument('query', choices=['user', 'partition', 'node'], help='Query table to read')
+    parser.add_argument('value', help='User id, partition or node name')
+
+    args = parser.parse_args()
+
+    from cassandra.auth import PlainTextAuthProvider
+
+    auth_provider = None
+    if args.user:
+        password = getpass(prompt=f"Password for {args.user} role: ")
+        auth_provider = PlainTextAuthProvider(username=args.user, password=password)
+    connection.setup(args.hosts, args.keyspace, protocol_version=3, auth_provider=auth_provider)
+
+    reader = JobReader()
+    if args.query == 'user':
+        jobs = reader.jobs_of_user(int(args.value), args.state, args.days)
+    elif args.query == 'partition':
+        if not args.state:
+            parser.error("partition queries need at least a --state")
+        jobs = reader.jobs_in_partition(args.value, args.state, args.days)
+    else:
+        jobs = reader.jobs_on_node(args.value, args.state, args.days)
+
+    for job in jobs:
+        print(json.dumps(job, default=str))
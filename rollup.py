@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+#
+# Incremental usage rollups of the jobs (tables/rollups.py): core-seconds,
+# started and ended jobs and queue wait per user, account and partition
+# and hour, accumulated in numpy arrays as jobs start, end or change
+# allocation, and flushed as counter increments every period
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import os
+import json
+import time
+import logging
+from typing import Any, Dict
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+from checkpoint import atomic_write, require_numpy
+from metrics import REGISTRY, Registry, RollupMetrics
+from tables.jobs import TERMINAL_STATES
+from tables.rollups import COUNTERS, DIMENSIONS, HOUR_SECONDS, UsageRollup, hour_of
+from writer import BatchWriter, WriteError
+
+CORE_SECONDS, JOBS_STARTED, JOBS_ENDED, WAIT_SECONDS = range(len(COUNTERS))
+
+# live states whose jobs don't hold cpus
+WAITING_STATES = frozenset(['PENDING', 'REQUEUED', 'REQUEUE_HOLD', 'REQUEUE_FED', 'SUSPENDED'])
+
+
+def cpus_of(data:dict) -> int:
+    allocated = data.get('cpus_allocated')
+    if allocated:
+        return sum(allocated.values())
+    return data.get('num_cpus') or 0
+
+
+class Rollup:
+    """
+    Usage rollups of the jobs seen by a collector (changed rows, and the
+    whole snapshot on the first tick), held as increments in one array
+    (keys x counters) per hour until they're flushed.
+
+    The running jobs are slots of arrays (cpus, time accounted until,
+    rows of their user, account and partition), so the core-seconds of a
+    tick are added with a few vectorized passes over the hours it spans.
+
+    A start or end is counted once, when it happened after the watermark
+    (the last tick, or the last flush on restart). The state of the running
+    jobs is saved to state_path after each flush, so a restart carries on
+    from there. Increments of a flush that failed are kept for the next
+    one (a timed out increment may have been applied by cassandra though)
+    """
+    def __init__(self, writer:BatchWriter = None, period:float = 60, state_path:str = None,
+                 capacity:int = 1024, name:str = 'jobs', registry:Registry = REGISTRY):
+        require_numpy("the rollups")
+
+        self.writer = writer or BatchWriter()
+        self.period = period
+        self.state_path = state_path
+        self.metrics = RollupMetrics(name, registry)
+
+        # (dimension, name) -> row of the accumulators
+        self.keys = {}
+        self.names = []
+        # hour -> increments (keys x counters) not flushed yet
+        self.pending = {}
+
+        # job_id -> slot of the running jobs
+        self.slots = {}
+        self.free = []
+        self.cpus = np.zeros(capacity)
+        self.accounted = np.zeros(capacity)
+        self.job_keys = np.zeros((capacity, len(DIMENSIONS)), dtype=np.int64)
+        self.running = np.zeros(capacity, dtype=bool)
+
+        # jobs whose end was counted, while they're in slurm
+        self.ended = set()
+        self.watermark = time.time()
+        self.primed = False
+        self.last_flush = time.monotonic()
+
+    def _key(self, dimension:str, name:str) -> int:
+        row = self.keys.get((dimension, name))
+        if row is None:
+            row = self.keys[(dimension, name)] = len(self.names)
+            self.names.append((dimension, name))
+        return row
+
+    def _keys_of(self, data:dict) -> list:
+        keys = []
+        for dimension, column in DIMENSIONS.items():
+            value = data.get(column)
+            keys.append(self._key(dimension, '' if value is None else str(value)))
+        return keys
+
+    def _hour(self, hour:int) -> 'np.ndarray':
+        increments = self.pending.get(hour)
+        if increments is None or len(increments) < len(self.names):
+            grown = np.zeros((max(2 * len(self.names), 64), len(COUNTERS)))
+            if increments is not None:
+                grown[:len(increments)] = increments
+            increments = self.pending[hour] = grown
+        return increments
+
+    def _count(self, timestamp:float, keys:list, counter:int, value:float):
+        self._hour(hour_of(timestamp))[keys, counter] += value
+
+    def _acquire(self, job_id, cpus:int, since:float, keys:list) -> int:
+        if not self.free:
+            capacity = len(self.cpus)
+            self.cpus = np.resize(self.cpus, 2 * capacity)
+            self.accounted = np.resize(self.accounted, 2 * capacity)
+            self.job_keys = np.resize(self.job_keys, (2 * capacity, len(DIMENSIONS)))
+            self.running = np.concatenate([self.running, np.zeros(capacity, dtype=bool)])
+            self.free = list(range(2 * capacity - 1, capacity - 1, -1))
+
+        slot = self.slots[job_id] = self.free.pop()
+        self.cpus[slot], self.accounted[slot], self.job_keys[slot] = cpus, since, keys
+        self.running[slot] = True
+        return slot
+
+    def _release(self, job_id):
+        slot = self.slots.pop(job_id)
+        self.running[slot] = False
+        self.free.append(slot)
+
+    def _accrue(self, slots:'np.ndarray', until:float):
+        """
+        Add the core-seconds of running jobs until a time
+        """
+        if not len(slots):
+            return
+
+        since = self.accounted[slots]
+        cpus = self.cpus[slots]
+        for hour in range(hour_of(since.min()), hour_of(until) + 1):
+            start, end = hour * HOUR_SECONDS, (hour + 1) * HOUR_SECONDS
+            seconds = np.clip(np.minimum(until, end) - np.maximum(since, start), 0, None) * cpus
+            if not seconds.any():
+                continue
+
+            increments = self._hour(hour)
+            for dimension in range(len(DIMENSIONS)):
+                np.add.at(increments[:, CORE_SECONDS], self.job_keys[slots, dimension], seconds)
+        self.accounted[slots] = np.maximum(since, until)
+
+    def observe(self, job_id, data:dict, now:float = None):
+        """
+        Count the changes of a job (a row or the slurm data of it)
+        """
+        now = now or time.time()
+        state = data.get('job_state')
+        slot = self.slots.get(job_id)
+
+        if state in TERMINAL_STATES:
+            end = data.get('end_time') or now
+            if job_id in self.ended:
+                return
+            if slot is not None:
+                self._accrue(np.array([slot]), end)
+                self._release(job_id)
+            elif end < self.watermark:
+                return
+            self.ended.add(job_id)
+            self._count(end, self._keys_of(data), JOBS_ENDED, 1)
+            return
+
+        # e.g. a requeued job, its next end is counted too
+        self.ended.discard(job_id)
+
+        start = data.get('start_time') or 0
+        if state in WAITING_STATES or not start:
+            if slot is not None:
+                # e.g. requeued, its next start is counted again
+                self._accrue(np.array([slot]), now)
+                self._release(job_id)
+            return
+
+        keys, cpus = self._keys_of(data), cpus_of(data)
+        if slot is None:
+            if start >= self.watermark:
+                self._count(start, keys, JOBS_STARTED, 1)
+                submit = data.get('submit_time') or start
+                self._count(start, keys, WAIT_SECONDS, max(start - submit, 0))
+            self._acquire(job_id, cpus, max(start, self.watermark), keys)
+
+        elif cpus != self.cpus[slot] or keys != self.job_keys[slot].tolist():
+            # allocation changed, the core-seconds so far are the ones of the old one
+            self._accrue(np.array([slot]), now)
+            self.cpus[slot], self.job_keys[slot] = cpus, keys
+
+    def tick(self, snapshot:Dict[Any, dict], now:float = None):
+        """
+        Add the core-seconds of the running jobs until now, flushing the
+        increments once per period
+        """
+        now = now or time.time()
+        if not self.primed:
+            # jobs that didn't change since a restart are only in the snapshot
+            for job_id, data in snapshot.items():
+                self.observe(job_id, data, now)
+            self.primed = True
+
+        # jobs that left slurm (or the shards of this instance) aren't accounted anymore
+        for job_id in self.slots.keys() - snapshot.keys():
+            self._release(job_id)
+        self.ended &= snapshot.keys()
+
+        self._accrue(np.flatnonzero(self.running), now)
+        self.watermark = now
+        self.metrics.running.set(len(self.slots))
+
+        if time.monotonic() - self.last_flush >= self.period:
+            self.flush(now)
+
+    def flush(self, now:float = None):
+        """
+        Send the whole part of the increments as counter updates
+        """
+        now = now or time.time()
+        self.last_flush = time.monotonic()
+
+        sent = []
+        for hour, increments in self.pending.items():
+            whole = np.trunc(increments)
+            rows = np.flatnonzero(whole.any(axis=1))
+            for row in rows.tolist():
+                dimension, name = self.names[row]
+                cols = {COUNTERS[counter]: int(value) for counter, value in enumerate(whole[row]) if value}
+                self.writer.increment(UsageRollup, {'dimension': dimension, 'day': hour // 24,
+                                                    'hour': hour, 'name': name}, cols)
+            increments -= whole
+            sent.append((hour, rows, whole[rows]))
+
+        failed = set()
+        start = time.monotonic()
+        try:
+            self.writer.flush()
+        except WriteError as error:
+            logging.error(f"Rollups: {error}")
+            failed = {key for model, key in error.failed}
+        self.metrics.flush.observe(time.monotonic() - start)
+
+        for hour, rows, values in sent:
+            for row, value in zip(rows.tolist(), values):
+                if (self.names[row][0], hour // 24) in failed:
+                    self.pending[hour][row] += value
+            self.metrics.flushed.inc(len(rows))
+
+        # the fractions of core-seconds of the former hours are dropped
+        current = hour_of(now)
+        for hour in [hour for hour in self.pending if hour < current]:
+            if not np.trunc(self.pending[hour]).any():
+                del self.pending[hour]
+
+        if failed:
+            self.metrics.failed.inc(len(failed))
+        elif self.state_path:
+            self.save(now)
+
+    def save(self, now:float):
+        running = [[job_id, float(self.cpus[slot]), float(self.accounted[slot]),
+                    [self.names[row][1] for row in self.job_keys[slot].tolist()]]
+                   for job_id, slot in self.slots.items()]
+        state = {"flushed_at": now, "running": running}
+
+        try:
+            with atomic_write(self.state_path) as state_file:
+                json.dump(state, state_file, separators=(',', ':'))
+        except OSError as error:
+            logging.error(f"Unable to save the rollups state {self.state_path}: {error}")
+
+    def load(self):
+        """
+        Resume the running jobs of the last flush (from state_path)
+        """
+        self.watermark = time.time()
+        self.primed = False
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+
+        try:
+            with open(self.state_path, 'r') as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError) as error:
+            logging.error(f"Unable to read the rollups state {self.state_path}: {error}")
+            return
+
+        self.watermark = state["flushed_at"]
+        for job_id, cpus, accounted, names in state["running"]:
+            keys = [self._key(dimension, name) for dimension, name in zip(DIMENSIONS, names)]
+            self._acquire(job_id, cpus, accounted, keys)
+        logging.info(f"Rollups of {len(self.slots)} running jobs resumed from {self.state_path}")
+
+    def close(self):
+        now = time.time()
+        self._accrue(np.flatnonzero(self.running), now)
+        self.flush(now)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# Run several collectors concurrently on fixed-rate ticks
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+import logging
+import threading
+from typing import Callable, Dict
+
+from cadence import Backoff
+from metrics import REGISTRY, Registry, TaskMetrics
+
+
+class TaskStats:
+    """
+    Tick counters of a scheduled task
+    """
+    def __init__(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_elapsed = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def asdict(self) -> dict:
+        return dict(vars(self))
+
+
+class Task:
+    """
+    A collector scheduled with a period (seconds), adapted by backoff
+    from the changes seen by its ticks when given
+    """
+    def __init__(self, name:str, tick:Callable, period:float,
+                 setup:Callable = None, teardown:Callable = None, registry:Registry = REGISTRY,
+                 backoff:Backoff = None):
+        self.name = name
+        self.tick = tick
+        self.period = period
+        self.setup = setup
+        self.teardown = teardown
+        self.backoff = backoff
+        self.stats = TaskStats()
+        self.metrics = TaskMetrics(name, registry)
+        self.metrics.period.set(period)
+        self.thread = None
+
+
+class Scheduler:
+    """
+    Run each task in its own thread on a fixed-rate grid of ticks
+    (start + k*period), so the period doesn't drift with the tick duration
+    and a slow task can't delay the others.
+
+    When a tick overruns its period, the missed ticks are skipped (the next
+    tick waits for the next slot of the grid) or merged (a single tick runs
+    right away), the lag is logged and counted in the stats of the task
+    """
+    def __init__(self, overrun:str = 'skip', registry:Registry = REGISTRY):
+        if overrun not in ('skip', 'merge'):
+            raise ValueError(f"Unknown overrun policy: {overrun}")
+
+        self.overrun = overrun
+        self.registry = registry
+        self.tasks = []
+        self._stop = threading.Event()
+
+    def add(self, name:str, tick:Callable, period:float,
+            setup:Callable = None, teardown:Callable = None, backoff:Backoff = None) -> Task:
+        task = Task(name, tick, period, setup, teardown, self.registry, backoff)
+        self.tasks.append(task)
+        return task
+
+    def stats(self) -> Dict[str, dict]:
+        return {task.name: task.stats.asdict() for task in self.tasks}
+
+    def _run_task(self, task:Task):
+        stats, metrics = task.stats, task.metrics
+        try:
+            if task.setup:
+                task.setup()
+
+            next_tick = time.monotonic()
+            while not self._stop.is_set():
+                start = time.monotonic()
+                stats.last_lag = start - next_tick
+                stats.max_lag = max(stats.max_lag, stats.last_lag)
+                metrics.lag.set(stats.last_lag)
+
+                try:
+                    result = task.tick()
+                    if task.backoff is not None:
+                        # ticks of the collectors return their TickStats
+                        task.period = task.backoff.update(result.inserted + result.updated)
+                        metrics.period.set(task.period)
+                except Exception as error:
+                    stats.errors += 1
+                    metrics.errors.inc()
+                    logging.error(f"{task.name}: {error}")
+
+                now = time.monotonic()
+                stats.ticks += 1
+                stats.last_elapsed = now - start
+
+                next_tick += task.period
+                if now > next_tick:
+                    overrun = now - next_tick
+                    missed = int(overrun // task.period) + 1
+                    stats.overruns += 1
+                    stats.skipped += missed
+                    metrics.overruns.inc()
+                    metrics.skipped.inc(missed)
+                    logging.warning(f"{task.name} overran its period ({task.period}s) by {overrun:.3f}s, "
+                                    f"{missed} ticks {'skipped' if self.overrun == 'skip' else 'merged'}")
+                    if self.overrun == 'skip':
+                        next_tick += missed * task.period
+                    else:
+                        next_tick = now
+
+                self._stop.wait(max(0.0, next_tick - time.monotonic()))
+        finally:
+            if task.teardown:
+                task.teardown()
+
+    def start(self):
+        self._stop.clear()
+        for task in self.tasks:
+            task.thread = threading.Thread(target=self._run_task, args=(task,), name=task.name, daemon=True)
+            logging.info(f"Start {task.name} thread (period: {task.period}s)")
+            task.thread.start()
+
+    def stop(self, timeout:float = None):
+        self._stop.set()
+        for task in self.tasks:
+            if task.thread:
+                task.thread.join(timeout)
+
+    def run(self):
+        """
+        Start every task and block until KeyboardInterrupt
+        """
+        self.start()
+        try:
+            while any(task.thread.is_alive() for task in self.tasks):
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            logging.info("Stop collecting information.")
+        finally:
+            self.stop()
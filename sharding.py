@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+# Sharded collectors: several instances split the jobs of a cluster
+# (job_id % shards) and elect the collectors of its nodes and partitions,
+# owning them through leases in cassandra (tables/leases.py)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import os
+import math
+import time
+import socket
+import logging
+import threading
+from typing import Any, Callable, Dict, List
+
+# THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
+from cassandra.cqlengine import connection
+
+from tables import Leases
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseTable:
+    """
+    Lightweight transactions on the leases table, the rows expire with
+    their TTL (seconds)
+    """
+    def __init__(self, session = None, ttl:int = 30, model = Leases):
+        self._session = session
+        self.ttl = ttl
+        self.table = model.column_family_name()
+        self._prepared = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = connection.get_session()
+        return self._session
+
+    def _statements(self) -> dict:
+        if self._prepared is None:
+            prepare = self.session.prepare
+            self._prepared = {
+                "acquire": prepare(f"INSERT INTO {self.table} (shard, owner, renewed) VALUES (?, ?, ?) "
+                                   f"IF NOT EXISTS USING TTL ?"),
+                "renew": prepare(f"UPDATE {self.table} USING TTL ? SET owner = ?, renewed = ? "
+                                 f"WHERE shard = ? IF owner = ?"),
+                "release": prepare(f"DELETE FROM {self.table} WHERE shard = ? IF owner = ?"),
+                "heartbeat": prepare(f"INSERT INTO {self.table} (shard, owner, renewed) VALUES (?, ?, ?) "
+                                     f"USING TTL ?"),
+                "holders": prepare(f"SELECT shard, owner FROM {self.table}"),
+            }
+        return self._prepared
+
+    def acquire(self, shard:str, owner:str) -> bool:
+        result = self.session.execute(self._statements()["acquire"],
+                                      (shard, owner, int(time.time() * 1000), self.ttl))
+        return result.was_applied
+
+    def renew(self, shard:str, owner:str) -> bool:
+        result = self.session.execute(self._statements()["renew"],
+                                      (self.ttl, owner, int(time.time() * 1000), shard, owner))
+        return result.was_applied
+
+    def release(self, shard:str, owner:str) -> bool:
+        result = self.session.execute(self._statements()["release"], (shard, owner))
+        return result.was_applied
+
+    def heartbeat(self, shard:str, owner:str):
+        self.session.execute(self._statements()["heartbeat"], (shard, owner, int(time.time() * 1000), self.ttl))
+
+    def holders(self) -> Dict[str, str]:
+        """
+        Live leases: shard -> owner
+        """
+        # rows are dicts (row factory of cqlengine)
+        rows = self.session.execute(self._statements()["holders"])
+        return {row["shard"]: row["owner"] for row in rows}
+
+
+class ShardLeases:
+    """
+    Leases of the shards of a slurm cluster held by this instance: one
+    per slice of the jobs (job_id % shards), one for the nodes and one
+    for the partitions.
+
+    Every instance renews its leases and a heartbeat (its membership) each
+    period, and takes or releases shards so it holds ceil(shards/members)
+    of them. The leases of a dead instance expire after ttl seconds and
+    are taken over by the others. A lease is only trusted until ttl minus
+    a period after its last renewal, so an instance that can't renew it
+    stops collecting before someone else takes it
+    """
+    def __init__(self, table:LeaseTable, owner:str = None, shards:int = 1, cluster:str = 'default',
+                 period:float = None):
+        self.table = table
+        self.owner = owner or default_owner()
+        self.shards = shards
+        self.cluster = cluster
+        self.period = period or table.ttl / 3
+
+        self.names = [self.name('nodes'), self.name('partitions')]
+        self.names += [self.name('jobs', index) for index in range(shards)]
+        self.member = self.name('members', self.owner)
+
+        # shard -> monotonic time its lease is trusted until
+        self.valid_until = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def name(self, *parts) -> str:
+        return '/'.join([self.cluster, *map(str, parts)])
+
+    def holds(self, name:str) -> bool:
+        return self.valid_until.get(name, 0) > time.monotonic()
+
+    def held(self) -> List[str]:
+        now = time.monotonic()
+        return [name for name, deadline in list(self.valid_until.items()) if deadline > now]
+
+    def job_shards(self) -> set:
+        """
+        Slices of the jobs (job_id % shards) held now
+        """
+        prefix = self.name('jobs', '')
+        return {int(name[len(prefix):]) for name in self.held() if name.startswith(prefix)}
+
+    def source(self, kind:str, source:Callable[[], Dict[Any, dict]]) -> Callable[[], Dict[Any, dict]]:
+        """
+        Source of a collector (jobs, nodes or partitions) restricted to the held shards
+        """
+        if kind == 'jobs':
+            def sharded():
+                shards = self.job_shards()
+                if not shards:
+                    return {}
+                return {job_id: data for job_id, data in source().items() if job_id % self.shards in shards}
+        else:
+            name = self.name(kind)
+
+            def sharded():
+                return source() if self.holds(name) else {}
+        return sharded
+
+    def _keep(self, name:str, start:float):
+        self.valid_until[name] = start + self.table.ttl - self.period
+
+    def _drop(self, name:str):
+        if self.valid_until.pop(name, None) is not None:
+            logging.info(f"Lease of {name} released by {self.owner}")
+
+    def rebalance(self):
+        """
+        Renew the held leases and take or release shards for an even share
+        """
+        with self._lock:
+            start = time.monotonic()
+            table, owner = self.table, self.owner
+            table.heartbeat(self.member, owner)
+
+            holders = table.holders()
+            members = {holder for name, holder in holders.items() if name.startswith(self.name('members', ''))}
+            members.add(owner)
+            target = math.ceil(len(self.names) / len(members))
+
+            mine = [name for name in self.names if holders.get(name) == owner or name in self.valid_until]
+            for name in mine:
+                if table.renew(name, owner):
+                    self._keep(name, start)
+                else:
+                    logging.warning(f"Lease of {name} lost by {owner}")
+                    self.valid_until.pop(name, None)
+
+            held = [name for name in self.names if name in self.valid_until]
+            # extra shards are released from the last ones, so an instance
+            # that joins gets its share
+            for name in reversed(held[target:]):
+                table.release(name, owner)
+                self._drop(name)
+
+            free = [name for name in self.names if name not in holders and name not in self.valid_until]
+            for name in free[:max(0, target - len(held))]:
+                if table.acquire(name, owner):
+                    self._keep(name, start)
+                    logging.info(f"Lease of {name} acquired by {owner}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.rebalance()
+            except Exception as error:
+                logging.error(f"Unable to renew the leases of {self.owner}: {error}")
+            self._stop.wait(self.period)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='leases', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop renewing and release the held leases (so they're taken over right away)
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            for name in list(self.valid_until):
+                try:
+                    self.table.release(name, self.owner)
+                except Exception as error:
+                    logging.error(f"Unable to release the lease of {name}: {error}")
+                self._drop(name)
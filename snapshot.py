@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+#
+# Snapshot engine: pull one full snapshot of slurm entities per tick
+# and diff it against an in-memory shadow copy of the persisted rows
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+import logging
+from collections import namedtuple
+from typing import Any, Callable, Dict, List
+
+from checkpoint import Checkpoint
+from metrics import CollectorMetrics
+from tables.policy import phase_of, window_due
+from tables.queries import LIVE_BUCKET, PLACEMENT_COLUMNS, PROJECTED, placement_of, project
+from writebehind import WriteBehindWriter
+from writer import ModelWriter, WriteError, partition_key
+
+
+# cols is None when the row wasn't persisted before (new entity)
+Change = namedtuple('Change', ['key', 'row', 'cols'])
+
+TickStats = namedtuple('TickStats', ['inserted', 'updated', 'tracked', 'retired', 'elapsed'])
+
+
+class SnapshotCollector:
+    """
+    Collect a table (jobs, nodes or partitions) diffing a full snapshot
+    of slurm against a shadow copy of the last persisted rows,
+    so steady-state ticks don't read from cassandra.
+
+    Rows accepted by retire (e.g. jobs in a terminal state) leave the
+    working set once persisted and aren't diffed anymore. On restart the
+    tracked state is resumed from a checkpoint: rows known only by their
+    fingerprint are rewritten when they differ from the slurm data (their
+    volatile columns, left out of the fingerprints, are written once).
+
+    The rows of the history models (see tables/history.py) derived from
+    each change are written along with it, and so are the ones of the query
+    tables (see tables/queries.py): the placement of the live rows in them
+    is tracked, so a row is moved (deleted and inserted) when it changes.
+    Failed writes of these rows are mapped back to their key, which is
+    written again in full (so its history row is derived again, and its
+    rows are deleted from every placement it may have). Rows written in
+    full over a persisted one (e.g. after a restart) only derive history
+    rows when their state differs from the persisted one.
+    Changes are also counted by the usage rollups (see rollup.py).
+
+    The policy of the volatile columns (see tables/policy.py) is honored:
+    the shadow rows keep their persisted values, so small deltas don't add
+    up unnoticed, and rate-limited columns are refreshed in windows
+    staggered by key
+    """
+    # ticks between prunes of the retired keys that left slurm
+    PRUNE_EVERY = 60
+
+    def __init__(self, model, source:Callable[[], Dict[Any, dict]],
+                 writer = None, verbose:bool = False,
+                 retire:Callable[[dict], bool] = None, state_columns:tuple = (),
+                 checkpoint:Checkpoint = None, checkpoint_every:float = 60,
+                 history:list = (), queries:list = (), rollup = None,
+                 metrics:CollectorMetrics = None):
+        self.model = model
+        self.source = source
+        self.writer = writer or ModelWriter()
+        self.verbose = verbose
+        self.retire = retire
+        # columns read by retire, fetched by the key-only scan
+        self.state_columns = tuple(state_columns)
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.history = list(history)
+        self.queries = list(queries)
+        self.rollup = rollup
+
+        self.name = model.__name__.lower()
+        self.metrics = metrics or CollectorMetrics(self.name)
+        self.codec = model.codec
+        self.key = self.codec.key
+        self.shadow = {}
+        # key -> fingerprint of its last persisted row (None if unknown)
+        self.fingerprints = {}
+        self.retired = set()
+        # key -> placement of its rows in the query tables (live rows only)
+        self.placed = {}
+        self._placing = {}
+        # key -> placements that may still hold live rows of it (failed moves)
+        self.stale = {}
+        # (model, partition key) -> {key: tick} of the history and query
+        # rows staged, and key -> [tick, placements] of the moves staged,
+        # to map failures back
+        self._owners = {}
+        self._moved = {}
+        # keys of the tick written in full over a row that may be persisted
+        self._rewrites = set()
+        # key -> persisted values of the state columns of the rows written
+        # in full again, key -> [tick, state] of the history rows staged,
+        # and keys whose history rows failed
+        self.states = {}
+        self._logged = {}
+        self._unlogged = set()
+        self.ticks = 0
+        self.last_diff = None
+        self.last_checkpoint = time.monotonic()
+
+    def load(self):
+        """
+        Resume the tracked state from the checkpoint, falling back to
+        a paged scan of the keys persisted in cassandra
+        """
+        self.shadow, self.fingerprints, self.retired, self.placed = {}, {}, set(), {}
+        self.stale, self.states = {}, {}
+        if self.rollup:
+            self.rollup.load()
+
+        state = self.checkpoint.load() if self.checkpoint else None
+        if state:
+            self.fingerprints, self.retired = state["fingerprints"], state["retired"]
+            self.placed, self.stale = state["placed"], state["stale"]
+            logging.info(f"{len(self.fingerprints)} {self.name} resumed from {self.checkpoint.path} "
+                         f"({len(self.retired)} retired)")
+            return
+
+        columns = [self.key, *self.state_columns]
+        if self.queries:
+            # the live rows are placed by their persisted values
+            columns += [name for name in PLACEMENT_COLUMNS if name not in columns]
+
+        # cqlengine queries are limited to 10000 rows unless told otherwise
+        query = self.model.objects.only(columns).limit(None).fetch_size(5000)
+        now = time.time()
+        try:
+            for row in query:
+                key = getattr(row, self.key)
+                if self.retire and self.retire(row):
+                    self.retired.add(key)
+                else:
+                    self.fingerprints[key] = None
+                    if self.history and self.state_columns:
+                        self.states[key] = tuple(row[name] for name in self.state_columns)
+                    if self.queries:
+                        self.placed[key] = placement_of({name: row[name] for name in columns}, now)
+        except Exception as error:
+            # e.g. cassandra is down and the writes are spooled
+            logging.error(f"Unable to scan {self.name}, every row will be written again: {error}")
+            self.fingerprints, self.retired, self.placed, self.states = {}, set(), {}, {}
+            return
+
+        logging.info(f"{len(self.fingerprints)} {self.name} loaded from cassandra "
+                     f"({len(self.retired)} retired)")
+
+    def diff(self, snapshot:Dict[Any, dict]) -> List[Change]:
+        """
+        Compute the rows of a snapshot that should be inserted or updated
+        """
+        extract, diff = self.codec.extract, self.codec.diff
+        retired, retire = self.retired, self.retire
+        shadow, fingerprints = self.shadow, self.fingerprints
+        volatile = self.codec.volatile
+        last, now = self.last_diff, time.time()
+        self.last_diff = now
+        rewrites = self._rewrites = set()
+
+        changes = []
+        for key, data in snapshot.items():
+            if key in retired:
+                if retire(data):
+                    continue
+                # e.g. a requeued job, its row is written again
+                retired.discard(key)
+
+            row = extract(data)
+            row[self.key] = key
+
+            old_row = shadow.get(key)
+            if old_row is None:
+                # rows only known by fingerprint (resumed state) are adopted
+                # as shadow when unchanged, otherwise written again in full
+                fingerprint = fingerprints.get(key)
+                if fingerprint is not None and fingerprint == self.codec.fingerprint(row):
+                    shadow[key] = row
+                    self.states.pop(key, None)
+                    # the persisted values of its volatile columns are unknown
+                    cols = {name: row[name] for name in volatile if name in row}
+                    if cols:
+                        changes.append(Change(key, row, cols))
+                else:
+                    if key in fingerprints:
+                        rewrites.add(key)
+                    changes.append(Change(key, row, None))
+                continue
+
+            if not volatile:
+                updated_cols = diff(old_row, row)
+            else:
+                updated_cols = diff(old_row, row, lambda seconds: window_due(seconds, phase_of(key), last, now))
+                # the volatile columns that weren't written keep their persisted value
+                for name in volatile:
+                    if name in old_row and name not in updated_cols:
+                        row[name] = old_row[name]
+            if updated_cols:
+                changes.append(Change(key, row, updated_cols))
+
+        return changes
+
+    def stage(self, changes:List[Change]):
+        """
+        Queue the changes of a tick (and their history and query rows) in the writer
+        """
+        now = time.time()
+        # the rows of the shadow copy aren't stamped, so fingerprints only
+        # depend on the slurm data
+        last_modified = int(now * 1000)
+        for change in changes:
+            if change.cols is None:
+                self.writer.insert(self.model, dict(change.row, last_modified=last_modified))
+                cleared = self.cleared(change, change.row)
+                if cleared:
+                    self.writer.update(self.model, {self.key: change.key}, cleared)
+            else:
+                self.writer.update(self.model, {self.key: change.key},
+                                   dict(change.cols, last_modified=last_modified))
+
+            # a row written again in its persisted state isn't a transition
+            history = self.history
+            if change.cols is None and self.states.get(change.key) == self.state_of(change.row):
+                history = ()
+
+            for model in history:
+                for row in model.derive(change.row, change.cols, now):
+                    row['last_modified'] = last_modified
+                    self.writer.insert(model, row)
+                    self.owns(model, row, change.key)
+                    self._logged[change.key] = [self.ticks, self.state_of(change.row)]
+
+            if self.queries:
+                self.place(change, now, last_modified)
+            if self.rollup:
+                self.rollup.observe(change.key, change.row, now)
+
+    def place(self, change:Change, now:float, last_modified:int):
+        """
+        Write the rows of a change in the query tables, deleting the ones
+        of its former placement
+        """
+        placement = placement_of(change.row, now)
+        former = self.stale.pop(change.key, set())
+        old = self.placed.get(change.key)
+        if old is not None:
+            former.add(old)
+        if former == {placement} and change.cols is not None and not any(name in change.cols for name in PROJECTED):
+            return
+
+        values = project(change.row)
+        values['last_modified'] = last_modified
+        cleared = self.cleared(change, values)
+
+        former.discard(placement)
+        for model in self.queries:
+            keys = model.keys_of(change.key, placement)
+            stale = []
+            for other in former:
+                stale += [key for key in model.keys_of(change.key, other) if key not in keys and key not in stale]
+            for key in stale:
+                self.writer.delete(model, key)
+                self.owns(model, key, change.key)
+            for key in keys:
+                self.writer.insert(model, dict(values, **key))
+                if cleared:
+                    self.writer.update(model, key, cleared)
+                self.owns(model, key, change.key)
+
+        self._placing[change.key] = placement
+        if former:
+            moved = self._moved.setdefault(change.key, [self.ticks, set()])
+            moved[0] = self.ticks
+            moved[1] |= former
+
+    def cleared(self, change:Change, values:dict) -> dict:
+        """
+        Null columns of values a change has to clear: inserts skip the null
+        cells, so the ones cleared by the change (all of them when a row that
+        may be persisted is written in full) are updated
+        """
+        if change.cols is None:
+            if change.key not in self._rewrites:
+                return {}
+            return {name: None for name, value in values.items() if value is None}
+        return {name: None for name, value in values.items() if value is None and name in change.cols}
+
+    def state_of(self, row:dict) -> tuple:
+        return tuple(row.get(name) for name in self.state_columns)
+
+    def owns(self, model, values:dict, key):
+        """
+        Record that a write of model (a history or query row) belongs to key
+        """
+        self._owners.setdefault((model, partition_key(model, values)), {})[key] = self.ticks
+
+    def failed_keys(self, error:WriteError) -> set:
+        logging.error(f"{self.name}: {error}")
+        keys = set()
+        for model, key in error.failed:
+            if model is self.model:
+                keys.add(key[0])
+            else:
+                owners = self._owners.get((model, key), ())
+                keys.update(owners)
+                if model in self.history:
+                    self._unlogged.update(owners)
+        return keys
+
+    def persist(self, changes:List[Change]) -> set:
+        """
+        Send the changes of a tick to cassandra, return the keys that failed
+        """
+        self.stage(changes)
+        try:
+            self.writer.flush()
+        except WriteError as error:
+            return self.failed_keys(error)
+
+        return set()
+
+    def commit(self, snapshot:Dict[Any, dict], changes:List[Change], failed:set = frozenset()):
+        """
+        Update the shadow copy once the changes of a tick were persisted,
+        failed changes are retried on the next tick
+        """
+        for change in changes:
+            if change.key in failed:
+                continue
+
+            self.states.pop(change.key, None)
+            if self.retire and self.retire(change.row):
+                self.shadow.pop(change.key, None)
+                self.fingerprints.pop(change.key, None)
+                self.retired.add(change.key)
+            else:
+                self.shadow[change.key] = change.row
+                self.fingerprints[change.key] = self.codec.fingerprint(change.row)
+
+        # entities that left slurm are no longer tracked (their rows are kept)
+        for key in self.fingerprints.keys() - snapshot.keys():
+            del self.fingerprints[key]
+            self.shadow.pop(key, None)
+
+        # failures of a write-behind writer can be of the writes of former ticks
+        self.forget(failed, changes)
+        self.end_tick(snapshot)
+
+    def forget(self, keys:set, changes:List[Change] = ()):
+        """
+        Stop tracking the rows of keys whose writes failed, they're written again in full
+        """
+        for key in keys:
+            self.shadow.pop(key, None)
+            self.fingerprints[key] = None
+            self.retired.discard(key)
+        self.forget_states(keys, changes)
+        self.forget_placements(keys)
+
+    def forget_states(self, keys:set, changes:List[Change]):
+        # the history holds the state of a failed change unless its history
+        # rows failed (a change without history rows doesn't change the
+        # state), or else the state of the last history rows staged
+        if self.history and self.state_columns:
+            logged = {key: state for key, (tick, state) in self._logged.items() if key in keys}
+            logged.update((change.key, self.state_of(change.row)) for change in changes if change.key in keys)
+            for key in keys:
+                if key in logged and key not in self._unlogged:
+                    self.states[key] = logged[key]
+                else:
+                    self.states.pop(key, None)
+        self._unlogged = set()
+
+    def forget_placements(self, keys:set):
+        # whether their query rows were moved is unknown, the rows of every
+        # placement they may have are deleted when they're written again
+        for key in keys:
+            former = {placement for placement in (self.placed.pop(key, None), self._placing.pop(key, None))
+                      if placement is not None}
+            former |= self._moved.pop(key, (None, set()))[1]
+            former |= self.stale.get(key, set())
+            if former:
+                self.stale[key] = former
+
+    def end_tick(self, snapshot:Dict[Any, dict]):
+        # the rows of ended jobs aren't moved anymore
+        for key, placement in self._placing.items():
+            if placement[0] == LIVE_BUCKET:
+                self.placed[key] = placement
+            else:
+                self.placed.pop(key, None)
+        self._placing = {}
+        for key in self.placed.keys() - snapshot.keys():
+            del self.placed[key]
+        for key in self.stale.keys() - snapshot.keys():
+            del self.stale[key]
+        for key in self.states.keys() - snapshot.keys():
+            del self.states[key]
+
+        if self.rollup:
+            self.rollup.tick(snapshot)
+
+        self.ticks += 1
+        if self.ticks % self.PRUNE_EVERY == 0:
+            self.retired &= snapshot.keys()
+
+        if not isinstance(self.writer, WriteBehindWriter):
+            self._owners, self._moved, self._logged = {}, {}, {}
+        elif self.ticks % self.PRUNE_EVERY == 0:
+            # failures of write-behind writes come in later ticks, but not that late
+            oldest = self.ticks - self.PRUNE_EVERY
+            for owners in self._owners.values():
+                for key in [key for key, tick in owners.items() if tick < oldest]:
+                    del owners[key]
+            self._owners = {write: owners for write, owners in self._owners.items() if owners}
+            self._moved = {key: moved for key, moved in self._moved.items() if moved[0] >= oldest}
+            self._logged = {key: logged for key, logged in self._logged.items() if logged[0] >= oldest}
+
+        if self.checkpoint and time.monotonic() - self.last_checkpoint >= self.checkpoint_every:
+            self.save_checkpoint()
+
+    def close(self):
+        if self.checkpoint:
+            self.save_checkpoint()
+        if self.rollup:
+            self.rollup.close()
+        self.writer.close()
+
+    def save_checkpoint(self):
+        if isinstance(self.writer, WriteBehindWriter):
+            # fingerprints are only saved for rows that reached cassandra
+            try:
+                self.writer.join()
+            except WriteError as error:
+                self.forget(self.failed_keys(error))
+
+        try:
+            self.checkpoint.save(self.fingerprints, self.retired, placed=self.placed, stale=self.stale)
+        except OSError as error:
+            logging.error(f"Unable to save checkpoint {self.checkpoint.path}: {error}")
+        self.last_checkpoint = time.monotonic()
+
+    def tick(self) -> TickStats:
+        """
+        Perform a single collection: fetch, diff, persist and commit
+        """
+        metrics = self.metrics
+
+        start = time.monotonic()
+        snapshot = self.source()
+        fetched = time.monotonic()
+        changes = self.diff(snapshot)
+        diffed = time.monotonic()
+        failed = self.persist(changes)
+        metrics.write.observe(time.monotonic() - diffed)
+        self.commit(snapshot, changes, failed)
+
+        metrics.fetch.observe(fetched - start)
+        metrics.diff.observe(diffed - fetched)
+        return self.report(snapshot, changes, failed, start)
+
+    def report(self, snapshot:Dict[Any, dict], changes:List[Change], failed:set, start:float) -> TickStats:
+        inserted = sum(1 for change in changes if change.cols is None)
+        updated = len(changes) - inserted
+        stats = TickStats(inserted, updated, len(self.fingerprints), len(self.retired),
+                          time.monotonic() - start)
+
+        metrics = self.metrics
+        metrics.tick.observe(stats.elapsed)
+        metrics.inserted.inc(inserted)
+        metrics.updated.inc(updated)
+        metrics.skipped.inc(len(snapshot) - len(changes))
+        metrics.failed.inc(len(failed))
+        metrics.tracked.set(stats.tracked)
+        metrics.retired.set(stats.retired)
+
+        if changes:
+            logging.info(f"{self.name}: {inserted} new, {updated} updated")
+
+        if self.verbose:
+            for change in changes:
+                logging.info(f"{self.name} {change.key}: {change.row if change.cols is None else change.cols}")
+
+        return stats
+
+    def run(self, n:float):
+        """
+        Collect with a frequency n (seconds)
+        """
+        self.load()
+        try:
+            while True:
+                self.tick()
+                time.sleep(n)
+        finally:
+            self.close()
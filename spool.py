@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+#
+# Durable local spool of the writes of a collector while cassandra is
+# unreachable or failing them: records are appended to memory-mapped
+# segment files and replayed in order once cassandra is back
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import os
+import mmap
+import time
+import zlib
+import pickle
+import struct
+import logging
+from typing import Dict, List, Tuple
+
+from checkpoint import atomic_write
+from metrics import REGISTRY, Registry, SpoolMetrics
+from tables import QUERY_TABLES, TABLES
+from writebehind import merge, primary_key, send
+from writer import BatchWriter, WriteError, partition_key
+
+# length and crc32 of the payload of a record (a zero length ends a segment)
+HEADER = struct.Struct('<II')
+
+# writes of the first chunk replayed after a failure (probing cassandra)
+PROBE_CHUNK = 16
+
+# table name -> model, of every table a collector writes
+SPOOLED = {**TABLES, **QUERY_TABLES}
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Segment:
+    """
+    Memory-mapped segment file of records, preallocated to its size
+    """
+    def __init__(self, path:str, size:int = None):
+        self.path = path
+        self.seq = int(os.path.basename(path).split('.')[0])
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if size is not None:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+
+        self.end = 0 if size is not None else self._scan()
+
+    def _record(self, offset:int):
+        """
+        Payload of the record at offset, None at the end of the segment
+        (or at a record torn by a crash)
+        """
+        if offset + HEADER.size > self.size:
+            return None
+        length, crc = HEADER.unpack_from(self.map, offset)
+        start = offset + HEADER.size
+        if length == 0 or start + length > self.size:
+            return None
+        payload = self.map[start:start + length]
+        return payload if zlib.crc32(payload) == crc else None
+
+    def _scan(self) -> int:
+        offset = 0
+        while True:
+            payload = self._record(offset)
+            if payload is None:
+                return offset
+            offset += HEADER.size + len(payload)
+
+    def append(self, payload:bytes) -> bool:
+        end = self.end + HEADER.size + len(payload)
+        if end > self.size:
+            return False
+
+        HEADER.pack_into(self.map, self.end, len(payload), zlib.crc32(payload))
+        self.map[self.end + HEADER.size:end] = payload
+        # the next header is cleared, so stale bytes are never read as a record
+        if end + HEADER.size <= self.size:
+            self.map[end:end + HEADER.size] = bytes(HEADER.size)
+        self.end = end
+        return True
+
+    def records(self, offset:int):
+        """
+        (offset after it, payload) of the records from offset
+        """
+        while offset < self.end:
+            payload = self._record(offset)
+            offset += HEADER.size + len(payload)
+            yield offset, payload
+
+    def sync(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+
+
+class Spool:
+    """
+    Append-only spool of writes: a directory of segment files
+    (<seq>.seg) and the position replayed so far (position file).
+
+    An append fails with SpoolFull when a new segment would exceed the
+    disk budget (bytes). Segments are deleted once they were replayed.
+    A spool is used by a single thread
+    """
+    def __init__(self, directory:str, budget:int = 1 << 30, segment_size:int = 16 << 20,
+                 models:Dict[str, object] = SPOOLED):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.budget = budget
+        self.segment_size = segment_size
+        self.models = models
+        self.tables = {model: name for name, model in models.items()}
+
+        self.position = self._read_position()
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.seg'):
+                continue
+            path = os.path.join(directory, name)
+            if int(name.split('.')[0]) < self.position[0]:
+                # replayed before a crash removed it
+                os.remove(path)
+            else:
+                self.segments.append(Segment(path))
+
+        if self.segments and self.position[0] < self.segments[0].seq:
+            self.position = (self.segments[0].seq, 0)
+
+    @property
+    def _position_path(self) -> str:
+        return os.path.join(self.directory, 'position')
+
+    def _read_position(self) -> Tuple[int, int]:
+        try:
+            with open(self._position_path, 'r') as position_file:
+                seq, offset = position_file.read().split()
+            return int(seq), int(offset)
+        except (OSError, ValueError):
+            return 1, 0
+
+    def _write_position(self):
+        with atomic_write(self._position_path) as position_file:
+            position_file.write(f"{self.position[0]} {self.position[1]}\n")
+
+    @property
+    def nbytes(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def empty(self) -> bool:
+        if not self.segments:
+            return True
+        tail = self.segments[-1]
+        return self.position == (tail.seq, tail.end)
+
+    def append(self, kind:str, model, values:dict):
+        payload = pickle.dumps((kind, self.tables[model], values), pickle.HIGHEST_PROTOCOL)
+        if self.segments and self.segments[-1].append(payload):
+            return
+
+        size = max(self.segment_size, HEADER.size + len(payload))
+        if self.nbytes + size > self.budget:
+            raise SpoolFull(f"Spool {self.directory} is full ({self.nbytes} bytes)")
+
+        if self.segments:
+            self.segments[-1].sync()
+        seq = self.segments[-1].seq + 1 if self.segments else self.position[0]
+        segment = Segment(os.path.join(self.directory, f"{seq:08d}.seg"), size)
+        self.segments.append(segment)
+        segment.append(payload)
+
+    def sync(self):
+        """
+        Flush the appended records to disk
+        """
+        if self.segments:
+            self.segments[-1].sync()
+
+    def read(self, count:int) -> Tuple[List[tuple], Tuple[int, int]]:
+        """
+        Up to count (kind, model, values) writes from the replayed
+        position, and the position after them
+        """
+        writes = []
+        seq, offset = self.position
+        for segment in self.segments:
+            if segment.seq < seq:
+                continue
+            if segment.seq > seq:
+                seq, offset = segment.seq, 0
+
+            for offset, payload in segment.records(offset):
+                kind, table, values = pickle.loads(payload)
+                writes.append((kind, self.models[table], values))
+                if len(writes) == count:
+                    return writes, (seq, offset)
+        return writes, (seq, offset)
+
+    def ack(self, position:Tuple[int, int]):
+        """
+        Mark the writes before position as replayed
+        """
+        self.position = position
+        if self.empty():
+            # fully replayed, the next append starts a new segment
+            seq = self.segments[-1].seq + 1 if self.segments else position[0]
+            replayed, self.segments = self.segments, []
+            self.position = (seq, 0)
+        else:
+            replayed = [segment for segment in self.segments if segment.seq < position[0]]
+            self.segments = self.segments[len(replayed):]
+
+        self._write_position()
+        for segment in replayed:
+            segment.close()
+            os.remove(segment.path)
+
+    def close(self):
+        for segment in self.segments:
+            segment.sync()
+            segment.close()
+
+
+def coalesce(writes:List[tuple]) -> List[tuple]:
+    """
+    Merge the writes of a same row (in order), so each one is sent once
+    """
+    merged = {}
+    for kind, model, values in writes:
+        key = (model, primary_key(model, values))
+        entry = merged.get(key)
+        if entry is None:
+            merged[key] = [kind, dict(values)]
+        else:
+            merge(entry, kind, values)
+    return [(kind, model, values) for (model, _primary), (kind, values) in merged.items()]
+
+
+class SpoolWriter:
+    """
+    Writer with the API of BatchWriter that spools the writes cassandra
+    failed, and every write after them until the spool was replayed,
+    so rows reach cassandra in the order they were written.
+
+    Replay is made by flush (at most every retry seconds while cassandra
+    keeps failing) through the BatchWriter, in chunks of coalesced writes,
+    for up to replay_budget seconds per flush. The first chunk after a
+    failure is a small one, probing cassandra. Replaying a chunk again
+    (e.g. after a crash) is idempotent. Writes rejected by a full spool
+    are reported as failed (WriteError), like the ones of a BatchWriter
+    """
+    def __init__(self, spool:Spool, writer:BatchWriter = None, retry:float = 5,
+                 replay_budget:float = 1.0, replay_chunk:int = 5000,
+                 name:str = 'default', registry:Registry = REGISTRY):
+        self.spool = spool
+        self.writer = writer or BatchWriter()
+        self.retry = retry
+        self.replay_budget = replay_budget
+        self.replay_chunk = replay_chunk
+        self.name = name
+        self.metrics = SpoolMetrics(name, registry)
+
+        self._staged = []
+        self._next_retry = 0.0
+        self._probe = True
+        # writes of a previous run may be waiting in the spool
+        self.degraded = not spool.empty()
+        self.metrics.degraded.set(int(self.degraded))
+        self.metrics.bytes.set(spool.nbytes)
+
+    def insert(self, model, row:dict):
+        self._staged.append(('insert', model, row))
+
+    def update(self, model, key:dict, cols:dict):
+        self._staged.append(('update', model, dict(key, **cols)))
+
+    def delete(self, model, key:dict):
+        self._staged.append(('delete', model, dict(key)))
+
+    def _send(self, writes:List[tuple]) -> set:
+        """
+        Write through the BatchWriter, return the partitions that failed
+        """
+        failed = set()
+        for kind, model, values in writes:
+            try:
+                send(self.writer, kind, model, values)
+            except Exception as error:
+                logging.error(f"Unable to write {model.__name__} {primary_key(model, values)}: {error}")
+                failed.add((model, partition_key(model, values)))
+
+        try:
+            self.writer.flush()
+        except WriteError as error:
+            failed.update(error.failed)
+        return failed
+
+    def _spool(self, writes:List[tuple]) -> list:
+        rejected = []
+        for kind, model, values in writes:
+            try:
+                self.spool.append(kind, model, values)
+            except SpoolFull:
+                rejected.append((model, partition_key(model, values)))
+        self.spool.sync()
+
+        self.metrics.spooled.inc(len(writes) - len(rejected))
+        self.metrics.rejected.inc(len(rejected))
+        self.metrics.bytes.set(self.spool.nbytes)
+        return rejected
+
+    def _degrade(self, reason:str):
+        if not self.degraded:
+            logging.warning(f"{self.name}: {reason}, spooling writes to {self.spool.directory}")
+        self.degraded = True
+        self.metrics.degraded.set(1)
+        self._next_retry = time.monotonic() + self.retry
+        self._probe = True
+
+    def flush(self):
+        """
+        Send the staged writes to cassandra, or to the spool while it
+        holds writes, then replay the spool
+        """
+        staged, self._staged = self._staged, []
+        if not self.degraded:
+            failed = self._send(staged)
+            if not failed:
+                return
+            # only the writes of the failed partitions are spooled
+            staged = [write for write in staged if (write[1], partition_key(write[1], write[2])) in failed]
+            self._degrade(f"{len(failed)} writes failed")
+
+        rejected = self._spool(staged)
+        self.replay()
+        if rejected:
+            raise WriteError(f"{len(rejected)} writes rejected by the spool", rejected)
+
+    def replay(self):
+        """
+        Send the spooled writes to cassandra (in order), back to
+        direct writes once the spool is empty
+        """
+        if not self.degraded or time.monotonic() < self._next_retry:
+            return
+
+        deadline = time.monotonic() + self.replay_budget
+        while time.monotonic() < deadline:
+            writes, position = self.spool.read(PROBE_CHUNK if self._probe else self.replay_chunk)
+            if not writes:
+                self.spool.ack(position)
+                self.degraded = False
+                self.metrics.degraded.set(0)
+                self.metrics.bytes.set(self.spool.nbytes)
+                logging.info(f"{self.name}: spool replayed, writing to cassandra")
+                return
+
+            if self._send(coalesce(writes)):
+                self._degrade("replay failed")
+                return
+
+            self.spool.ack(position)
+            self._probe = False
+            self.metrics.replayed.inc(len(writes))
+            self.metrics.bytes.set(self.spool.nbytes)
+
+    def close(self):
+        self.spool.close()
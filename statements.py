@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#
+# Prepared statements of the tables, bound with plain tuples
+# (no cqlengine model is instantiated per row)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+from typing import Tuple
+
+
+class StatementCache:
+    """
+    Prepared INSERT/UPDATE/DELETE statements of a table cached per column subset,
+    the columns of tables/*.py are still the source of truth of the schema
+    """
+    def __init__(self, session, model):
+        self.session = session
+        self.model = model
+        self.table = model.column_family_name()
+
+        # frozenset of columns -> (prepared statement, order of its bind markers)
+        self._inserts = {}
+        self._updates = {}
+        self._deletes = {}
+        self._increments = {}
+
+    def _field(self, name:str) -> str:
+        return self.model._columns[name].db_field_name
+
+    def insert(self, row:dict) -> Tuple:
+        """
+        Statement and values to insert a row, without its null cells: they
+        would be tombstones (protocol v3 has no unset values), a column is
+        cleared by an update
+        """
+        row = {name: value for name, value in row.items() if value is not None}
+        cols = frozenset(row)
+        prepared = self._inserts.get(cols)
+        if prepared is None:
+            names = tuple(row)
+            fields = ', '.join(self._field(name) for name in names)
+            marks = ', '.join(['?'] * len(names))
+            query = f"INSERT INTO {self.table} ({fields}) VALUES ({marks})"
+            prepared = self._inserts[cols] = (self.session.prepare(query), names)
+
+        statement, names = prepared
+        return statement, tuple(row[name] for name in names)
+
+    def update(self, key:dict, cols:dict) -> Tuple:
+        """
+        Statement and values to update some columns of the row with primary key key
+        """
+        subset = (frozenset(cols), frozenset(key))
+        prepared = self._updates.get(subset)
+        if prepared is None:
+            names, key_names = tuple(cols), tuple(key)
+            assignments = ', '.join(f"{self._field(name)} = ?" for name in names)
+            where = ' AND '.join(f"{self._field(name)} = ?" for name in key_names)
+            query = f"UPDATE {self.table} SET {assignments} WHERE {where}"
+            prepared = self._updates[subset] = (self.session.prepare(query), names, key_names)
+
+        statement, names, key_names = prepared
+        return statement, tuple(cols[name] for name in names) + tuple(key[name] for name in key_names)
+
+    def delete(self, key:dict) -> Tuple:
+        """
+        Statement and values to delete the row with primary key key
+        """
+        key_names = frozenset(key)
+        prepared = self._deletes.get(key_names)
+        if prepared is None:
+            names = tuple(key)
+            where = ' AND '.join(f"{self._field(name)} = ?" for name in names)
+            query = f"DELETE FROM {self.table} WHERE {where}"
+            prepared = self._deletes[key_names] = (self.session.prepare(query), names)
+
+        statement, names = prepared
+        return statement, tuple(key[name] for name in names)
+
+    def increment(self, key:dict, cols:dict) -> Tuple:
+        """
+        Statement and values to add cols to the counters of the row with primary key key
+        """
+        subset = (frozenset(cols), frozenset(key))
+        prepared = self._increments.get(subset)
+        if prepared is None:
+            names, key_names = tuple(cols), tuple(key)
+            assignments = ', '.join(f"{self._field(name)} = {self._field(name)} + ?" for name in names)
+            where = ' AND '.join(f"{self._field(name)} = ?" for name in key_names)
+            query = f"UPDATE {self.table} SET {assignments} WHERE {where}"
+            prepared = self._increments[subset] = (self.session.prepare(query), names, key_names)
+
+        statement, names, key_names = prepared
+        return statement, tuple(cols[name] for name in names) + tuple(key[name] for name in key_names)
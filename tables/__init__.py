@@ -1,3 +1,27 @@
 from .jobs import Jobs
 from .partitions import Partitions
-from .nodes import Nodes
\ No newline at end of file
+from .nodes import Nodes
+from .history import JobStateHistory, NodeMetrics
+from .leases import Leases
+from .queries import JobsByUser, JobsByPartitionState, JobsByNode
+from .rollups import UsageRollup
+from .telemetry import NodeTelemetry
+
+# table name -> model, of every table of collected data in a keyspace
+# (leases are state of the collectors and the counters of the rollups
+# can't be loaded back with inserts, so neither is backed up)
+TABLES = {
+    "partitions": Partitions,
+    "nodes": Nodes,
+    "jobs": Jobs,
+    "job_state_history": JobStateHistory,
+    "node_metrics": NodeMetrics,
+    "node_telemetry": NodeTelemetry
+}
+
+# query tables (see tables/queries.py), derived from the rows of Jobs
+QUERY_TABLES = {
+    "jobs_by_user": JobsByUser,
+    "jobs_by_partition_state": JobsByPartitionState,
+    "jobs_by_node": JobsByNode
+}
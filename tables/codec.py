@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Row codecs: the columns of a table compiled once at import
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+import zlib
+from hashlib import blake2b
+from typing import Callable, Dict, Tuple
+
+from cassandra.cqlengine.columns import List, Map, Set
+
+from .policy import Derived, RateLimited
+
+
+def stamp() -> int:
+    """
+    Value of the last_modified column of a write (epoch milliseconds)
+    """
+    return int(time.time() * 1000)
+
+
+def as_row(data) -> dict:
+    """
+    Plain dict of a row (model instances are converted)
+    """
+    return data if isinstance(data, dict) else dict(data)
+
+
+def _empty_list(value):
+    return [] if value is None else value
+
+
+def _empty_map(value):
+    return {} if value is None else value
+
+
+def _empty_set(value):
+    return set() if value is None else value
+
+
+class RowCodec:
+    """
+    Fixed column order, coercion table and extract-and-diff routines
+    of a table, compiled once from its model.
+
+    The policy of a column (see tables/policy.py) is honored by extract
+    (derived columns are dropped) and by diff; volatile (rate-limited or
+    delta) columns aren't part of the fingerprint, so a change of them
+    alone doesn't make a row stale
+    """
+    def __init__(self, model, coerce:Dict[str, Callable] = None, policy:dict = None):
+        self.model = model
+        self.columns = tuple(model._columns)
+        self.keys = tuple(model._primary_keys)
+        self.key = self.keys[0]
+
+        self.policy = policy or {}
+        self.volatile = {name: rule for name, rule in self.policy.items() if not isinstance(rule, Derived)}
+        # positions of the columns hashed by fingerprint()
+        self._stable = [index for index, name in enumerate(self.columns) if name not in self.volatile]
+
+        # positions of the map columns, sorted when hashed
+        self._maps = [index for index, column in enumerate(model._columns.values()) if isinstance(column, Map)]
+
+        coerce = coerce or {}
+        # column name -> converter (None when the value is stored as is)
+        self.coercion = {}
+        for name, column in model._columns.items():
+            if isinstance(self.policy.get(name), Derived):
+                continue
+            convert = coerce.get(name)
+            if convert is None:
+                # cassandra returns empty collections instead of null,
+                # so both sides of a diff use the same representation
+                if isinstance(column, List):
+                    convert = _empty_list
+                elif isinstance(column, Map):
+                    convert = _empty_map
+                elif isinstance(column, Set):
+                    convert = _empty_set
+            self.coercion[name] = convert
+
+    def extract(self, data:dict) -> dict:
+        """
+        Columns of the table found in data (e.g. a pyslurm dict), coerced
+        """
+        coercion = self.coercion
+        row = {}
+        for name, value in data.items():
+            if name in coercion:
+                convert = coercion[name]
+                row[name] = value if convert is None else convert(value)
+        return row
+
+    def diff(self, old:dict, new:dict, due:Callable[[float], bool] = None) -> dict:
+        """
+        Columns of new whose value differs from old. Volatile columns are
+        written along with other changes, on their own only when a delta
+        column moved enough or a rate-limited one is due (due(seconds),
+        never when it's None)
+        """
+        volatile = self.volatile
+        cols, riders = {}, {}
+        for name, value in new.items():
+            if name in old and old[name] != value:
+                rule = volatile.get(name)
+                if rule is None or rule.significant(old[name], value):
+                    cols[name] = value
+                else:
+                    riders[name] = value
+
+        if riders and (cols or (due is not None and
+                                any(isinstance(volatile[name], RateLimited) and due(volatile[name].seconds)
+                                    for name in riders))):
+            cols.update(riders)
+        return cols
+
+    def due_since(self, old:dict, now:int = None) -> Callable[[float], bool]:
+        """
+        Due test of the rate-limited columns of a row read from cassandra:
+        they're due once its last write is older than their period
+        """
+        elapsed = (now or stamp()) - (old.get('last_modified') or 0)
+        return lambda seconds: elapsed >= seconds * 1000
+
+    def values(self, row:dict) -> tuple:
+        """
+        Values of a row in the column order of the table
+        """
+        return tuple(row.get(name) for name in self.columns)
+
+    def _hashed_values(self, row:dict) -> list:
+        values = [row.get(name) for name in self.columns]
+        for index in self._maps:
+            value = values[index]
+            if value is not None:
+                values[index] = sorted(value.items())
+        return values
+
+    def fingerprint(self, row:dict) -> int:
+        """
+        Stable 64-bit hash of a row (missing columns count as null),
+        volatile columns left out
+        """
+        values = self._hashed_values(row)
+        if self.volatile:
+            values = [values[index] for index in self._stable]
+        return int.from_bytes(blake2b(repr(values).encode(), digest_size=8).digest(), 'little')
+
+    def group_bounds(self, isolate:tuple = (), size:int = 16) -> Tuple[Tuple[int, int]]:
+        """
+        Column groups of group_hashes(): (start, end) slices of the column order,
+        each column of isolate is a group of its own (e.g. the columns read
+        by the history models), the other ones are cut every size columns
+        """
+        cuts = set(range(0, len(self.columns), size)) | {len(self.columns)}
+        for name in isolate:
+            index = self.columns.index(name)
+            cuts |= {index, index + 1}
+        cuts = sorted(cuts)
+        return tuple(zip(cuts[:-1], cuts[1:]))
+
+    def group_hashes(self, row:dict, bounds:Tuple[Tuple[int, int]]) -> tuple:
+        """
+        32-bit hash of each column group of a row (see group_bounds())
+        """
+        values = self._hashed_values(row)
+        return tuple(zlib.crc32(repr(values[start:end]).encode()) for start, end in bounds)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Append-only history tables (job state transitions, node metric samples)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+from cassandra.cqlengine.models import Model
+from cassandra.cqlengine.columns import *
+
+from .codec import RowCodec
+
+# rows are partitioned by entity plus a day bucket, so partitions stay
+# bounded and the writes of a day spread over every entity of the ring
+BUCKET_SECONDS = 24*3600
+
+
+def bucket_of(timestamp:float) -> int:
+    return int(timestamp // BUCKET_SECONDS)
+
+
+class JobStateHistory(Model):
+    __table_name__          = "job_state_history"
+
+    job_id                  = Integer(partition_key=True)
+    bucket                  = Integer(partition_key=True)
+    change_time             = BigInt(primary_key=True, clustering_order="ASC")
+    job_state               = Text(primary_key=True)
+    state_reason            = Text()
+    partition               = Text()
+    nodes                   = Text()
+    exit_code               = Text()
+    last_modified           = BigInt()
+
+    # columns of Jobs whose update derives a row
+    TRIGGERS = ('job_state',)
+
+    @staticmethod
+    def derive(row:dict, cols:dict, now:float) -> list:
+        """
+        History rows of a change of Jobs (cols is None for new rows)
+        """
+        if cols is not None and 'job_state' not in cols:
+            return []
+
+        return [{
+            'job_id': row['job_id'],
+            'bucket': bucket_of(now),
+            'change_time': int(now),
+            'job_state': row.get('job_state'),
+            'state_reason': row.get('state_reason'),
+            'partition': row.get('partition'),
+            'nodes': row.get('nodes'),
+            'exit_code': row.get('exit_code'),
+        }]
+
+
+JobStateHistory.codec = RowCodec(JobStateHistory)
+
+
+class NodeMetrics(Model):
+    __table_name__          = "node_metrics"
+
+    name                    = Text(partition_key=True)
+    bucket                  = Integer(partition_key=True)
+    sample_time             = BigInt(primary_key=True, clustering_order="ASC")
+    state                   = Text()
+    cpu_load                = Integer()
+    free_mem                = Integer()
+    alloc_cpus              = Integer()
+    alloc_mem               = Integer()
+    energy                  = Map(key_type=Text(), value_type=Integer())
+    last_modified           = BigInt()
+
+    METRICS = ('state', 'cpu_load', 'free_mem', 'alloc_cpus', 'alloc_mem', 'energy')
+    TRIGGERS = METRICS
+
+    @staticmethod
+    def derive(row:dict, cols:dict, now:float) -> list:
+        """
+        Metric sample of a change of Nodes (cols is None for new rows)
+        """
+        if cols is not None and not any(name in cols for name in NodeMetrics.METRICS):
+            return []
+
+        sample = {name: row.get(name) for name in NodeMetrics.METRICS}
+        sample.update(name=row['name'], bucket=bucket_of(now), sample_time=int(now))
+        return [sample]
+
+
+NodeMetrics.codec = RowCodec(NodeMetrics)
@@ -8,6 +8,9 @@ import uuid
 from cassandra.cqlengine.models import Model
 from cassandra.cqlengine.columns import *
 
+from .codec import RowCodec, as_row
+from .policy import Derived, RateLimited
+
 # UNDEFINED = [
 #     "threads_per_core",
 #     "tres_alloc_str",
@@ -39,6 +42,31 @@ from cassandra.cqlengine.columns import *
 #     "cpus_alloc_layout" # reason: map<text, Any>
 # ]
 
+# columns stored as the string representation of the slurm value
+STR_COLUMNS = ['time_limit', 'priority', 'profile', 'billable_tres', 'bitflags']
+
+# write policy of the columns slurm changes on nearly every poll
+POLICY = {
+    'run_time': Derived(),
+    'run_time_str': Derived(),
+    'last_sched_eval': RateLimited(300),
+    'priority': RateLimited(300),
+    'accrue_time': RateLimited(300),
+}
+
+# states of a job that won't change anymore (unless it's requeued)
+TERMINAL_STATES = frozenset([
+    "BOOT_FAIL",
+    "CANCELLED",
+    "COMPLETED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+])
+
 class Jobs(Model):
     job_id                  = Integer(primary_key=True)
     name                    = Text()
@@ -118,33 +146,21 @@ class Jobs(Model):
     wait4switch             = Integer()
     work_dir                = Text()
     cpus_allocated          = Map(key_type=Text(), value_type=Integer())
+    last_modified           = BigInt()
 
 
     @staticmethod
     def purge_args(**kwargs):
-        cols = Jobs().keys()
-        purged_args = {}
-        for name, value in kwargs.items():
-            if name in cols:
-                if name in ['time_limit', 'priority', 'profile', 'billable_tres', 'bitflags']:
-                    value = str(value)
-                
-                purged_args[name] = value
-
-                
-        
-        return purged_args
+        return Jobs.codec.extract(kwargs)
 
     @staticmethod
     def updated_columns(old_job, updated_job):
-        dict_old_job = dict(old_job)
-        dict_updated_job = dict(updated_job)
+        old_job = as_row(old_job)
+        return Jobs.codec.diff(old_job, as_row(updated_job), Jobs.codec.due_since(old_job))
+
+    @staticmethod
+    def is_terminal(job):
+        return job['job_state'] in TERMINAL_STATES
 
-        common_keys = set(dict_old_job.keys()).intersection(set(dict_updated_job))
 
-        updated_cols = {}
-        for key in common_keys:
-            if dict_old_job[key] != dict_updated_job[key]:
-                updated_cols[key] = dict_updated_job[key]
-            
-        return updated_cols
+Jobs.codec = RowCodec(Jobs, coerce={name: str for name in STR_COLUMNS}, policy=POLICY)
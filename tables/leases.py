@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+#
+# Table leases: owners of the shards of the collectors (see sharding.py)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+from cassandra.cqlengine.models import Model
+from cassandra.cqlengine.columns import *
+
+
+class Leases(Model):
+    """
+    Rows are written with a TTL and taken with lightweight transactions,
+    a lease whose owner stopped renewing it expires
+    """
+    shard               = Text(primary_key=True)
+    owner               = Text()
+    renewed             = BigInt()
@@ -8,6 +8,9 @@ import uuid
 from cassandra.cqlengine.models import Model
 from cassandra.cqlengine.columns import *
 
+from .codec import RowCodec, as_row
+from .policy import Delta
+
 # UNDEFINED = [
 #     "gres_used",
 #     "mcs_label",
@@ -17,6 +20,13 @@ from cassandra.cqlengine.columns import *
 #     "power_mgmt"
 # ]
 
+# write policy of the columns slurm changes on nearly every poll:
+# cpu_load is in hundredths, free_mem in MB
+POLICY = {
+    'cpu_load': Delta(50),
+    'free_mem': Delta(1024),
+}
+
 class Nodes(Model):
     name                = Text(primary_key=True)
     state               = Text()
@@ -53,30 +63,17 @@ class Nodes(Model):
     alloc_cpus          = Integer()
     err_cpus            = Integer()
     alloc_mem           = Integer()
+    last_modified       = BigInt()
 
 
     @staticmethod
     def purge_args(**kwargs):
-        cols = Nodes().keys()
-        purged_args = {}
-        for name, value in kwargs.items():
-            if name in cols:
-                purged_args[name] = value
-
-                
-        
-        return purged_args
+        return Nodes.codec.extract(kwargs)
 
     @staticmethod
     def updated_columns(old_node, updated_node):
-        dict_old_node = dict(old_node)
-        dict_updated_node = dict(updated_node)
+        old_node = as_row(old_node)
+        return Nodes.codec.diff(old_node, as_row(updated_node), Nodes.codec.due_since(old_node))
 
-        common_keys = set(dict_old_node.keys()).intersection(set(dict_updated_node))
 
-        updated_cols = {}
-        for key in common_keys:
-            if dict_old_node[key] != dict_updated_node[key]:
-                updated_cols[key] = dict_updated_node[key]
-            
-        return updated_cols
+Nodes.codec = RowCodec(Nodes, policy=POLICY)
@@ -8,6 +8,8 @@ import uuid
 from cassandra.cqlengine.models import Model
 from cassandra.cqlengine.columns import *
 
+from .codec import RowCodec, as_row
+
 # UNDEFINED = [
 #     "deny_accounts",
 #     "deny_qos",
@@ -46,29 +48,15 @@ class Partitions(Model):
     total_cpus          = Integer()
     total_nodes         = Integer()
     tres_fmt_str        = Text()
+    last_modified       = BigInt()
 
     @staticmethod
     def purge_args(**kwargs):
-        cols = Partitions().keys()
-        purged_args = {}
-        for name, value in kwargs.items():
-            if name in cols:
-                purged_args[name] = value
-
-                
-        
-        return purged_args
+        return Partitions.codec.extract(kwargs)
 
     @staticmethod
     def updated_columns(old_partition, updated_partition):
-        dict_old_partition = dict(old_partition)
-        dict_updated_partition = dict(updated_partition)
+        return Partitions.codec.diff(as_row(old_partition), as_row(updated_partition))
 
-        common_keys = set(dict_old_partition.keys()).intersection(set(dict_updated_partition))
 
-        updated_cols = {}
-        for key in common_keys:
-            if dict_old_partition[key] != dict_updated_partition[key]:
-                updated_cols[key] = dict_updated_partition[key]
-            
-        return updated_cols
+Partitions.codec = RowCodec(Partitions)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+#
+# Write policies of the volatile columns of a table (the ones slurm changes
+# on nearly every poll), declared next to its columns and honored by the
+# diffs of its codec (see codec.RowCodec)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import zlib
+
+
+class Derived:
+    """
+    Never stored: the column can be computed from other ones by the
+    readers (e.g. run_time from start_time and end_time)
+    """
+
+
+class RateLimited:
+    """
+    Written at most once per seconds when it's the only change of a row
+    (it's written along with any other change). Rows are refreshed in
+    windows staggered by their key, so they aren't all written at once
+    """
+    def __init__(self, seconds:float):
+        self.seconds = seconds
+
+    def significant(self, old, new) -> bool:
+        return False
+
+
+class Delta:
+    """
+    Written when it moved at least threshold from its persisted value
+    (or along with another change of the row)
+    """
+    def __init__(self, threshold:float):
+        self.threshold = threshold
+
+    def significant(self, old, new) -> bool:
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+            return old != new
+        return abs(new - old) >= self.threshold
+
+
+def phase_of(key) -> int:
+    """
+    Offset of the refresh windows of a row: job ids as they are, names hashed
+    """
+    return key if isinstance(key, int) else zlib.crc32(str(key).encode())
+
+
+def window_due(seconds:float, phase:int, last:float, now:float) -> bool:
+    """
+    Whether a refresh window of a row ended in (last, now]
+    """
+    if last is None:
+        return False
+    phase = phase % seconds
+    return (now + phase) // seconds != (last + phase) // seconds
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# Query tables: denormalized copies of a few columns of Jobs partitioned
+# by the keys of the dashboards (user, partition and state, node), so
+# their queries are single-partition reads instead of scans of Jobs
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import re
+
+from cassandra.cqlengine.models import Model
+from cassandra.cqlengine.columns import *
+
+from .codec import RowCodec
+from .history import bucket_of
+from .jobs import TERMINAL_STATES
+
+# bucket of the jobs that didn't end yet (no day), the other ones are in
+# the bucket of the day they ended (see history.bucket_of), so a job is
+# moved once and the partitions of ended jobs stay bounded
+LIVE_BUCKET = -1
+
+# columns of Jobs that, with the bucket, place a job in the query tables:
+# a placement is (bucket, user_id, partition, job_state, nodes)
+PLACEMENT_COLUMNS = ('user_id', 'partition', 'job_state', 'nodes')
+
+# columns of Jobs copied to every query table
+PROJECTED = ('job_id', 'name', 'user_id', 'account', 'partition', 'job_state', 'state_reason',
+             'num_cpus', 'num_nodes', 'nodes', 'submit_time', 'start_time', 'end_time', 'exit_code')
+
+# moves leave tombstones in the live partitions, they're purged after a
+# few hours (a row resurrected by a lost delete is rewritten by the
+# collector on its next change)
+GC_GRACE_SECONDS = 3*3600
+
+_RANGE = re.compile(r'\[([^\]]*)\]')
+
+
+def expand_nodes(nodes:str) -> list:
+    """
+    Host names of a slurm hostlist, e.g. 'cn[01-03,07],gpu1'
+    """
+    if not nodes:
+        return []
+
+    # commas out of brackets split the hosts
+    hosts, depth, start = [], 0, 0
+    for index, char in enumerate(nodes):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            hosts.append(nodes[start:index])
+            start = index + 1
+    hosts.append(nodes[start:])
+
+    names = []
+    for host in hosts:
+        match = _RANGE.search(host)
+        if match is None:
+            if host:
+                names.append(host)
+            continue
+
+        prefix, suffix = host[:match.start()], host[match.end():]
+        for part in match.group(1).split(','):
+            first, _, last = part.partition('-')
+            width = len(first)
+            for number in range(int(first), int(last or first) + 1):
+                # the rest of the host may hold more ranges
+                names.extend(expand_nodes(f"{prefix}{number:0{width}d}{suffix}"))
+    return names
+
+
+def placement_of(row:dict, now:float) -> tuple:
+    """
+    Placement of a row of Jobs in the query tables
+    """
+    if row.get('job_state') in TERMINAL_STATES:
+        bucket = bucket_of(row.get('end_time') or now)
+    else:
+        bucket = LIVE_BUCKET
+    return (bucket, *(row.get(name) for name in PLACEMENT_COLUMNS))
+
+
+def project(row:dict) -> dict:
+    return {name: row.get(name) for name in PROJECTED}
+
+
+class JobsByUser(Model):
+    """
+    Jobs of a user: the live ones, or the ones that ended on a day
+    """
+    __table_name__          = "jobs_by_user"
+    __options__             = {'gc_grace_seconds': GC_GRACE_SECONDS}
+
+    user_id                 = Integer(partition_key=True)
+    bucket                  = Integer(partition_key=True)
+    job_id                  = Integer(primary_key=True, clustering_order="DESC")
+    name                    = Text()
+    account                 = Text()
+    partition               = Text()
+    job_state               = Text()
+    state_reason            = Text()
+    num_cpus                = Integer()
+    num_nodes               = Integer()
+    nodes                   = Text()
+    submit_time             = BigInt()
+    start_time              = BigInt()
+    end_time                = BigInt()
+    exit_code               = Text()
+    last_modified           = BigInt()
+
+    @staticmethod
+    def keys_of(job_id:int, placement:tuple) -> list:
+        bucket, user_id, _partition, _job_state, _nodes = placement
+        if user_id is None:
+            return []
+        return [{'user_id': user_id, 'bucket': bucket, 'job_id': job_id}]
+
+
+JobsByUser.codec = RowCodec(JobsByUser)
+
+
+class JobsByPartitionState(Model):
+    """
+    Jobs of a partition in a state: the live ones, or the ones that ended
+    on a day
+    """
+    __table_name__          = "jobs_by_partition_state"
+    __options__             = {'gc_grace_seconds': GC_GRACE_SECONDS}
+
+    partition               = Text(partition_key=True)
+    job_state               = Text(partition_key=True)
+    bucket                  = Integer(partition_key=True)
+    job_id                  = Integer(primary_key=True, clustering_order="DESC")
+    name                    = Text()
+    user_id                 = Integer()
+    account                 = Text()
+    state_reason            = Text()
+    num_cpus                = Integer()
+    num_nodes               = Integer()
+    nodes                   = Text()
+    submit_time             = BigInt()
+    start_time              = BigInt()
+    end_time                = BigInt()
+    exit_code               = Text()
+    last_modified           = BigInt()
+
+    @staticmethod
+    def keys_of(job_id:int, placement:tuple) -> list:
+        bucket, _user_id, partition, job_state, _nodes = placement
+        if partition is None or job_state is None:
+            return []
+        return [{'partition': partition, 'job_state': job_state, 'bucket': bucket, 'job_id': job_id}]
+
+
+JobsByPartitionState.codec = RowCodec(JobsByPartitionState)
+
+
+class JobsByNode(Model):
+    """
+    Jobs allocated to a node: the live ones, or the ones that ended on a day
+    """
+    __table_name__          = "jobs_by_node"
+    __options__             = {'gc_grace_seconds': GC_GRACE_SECONDS}
+
+    node                    = Text(partition_key=True)
+    bucket                  = Integer(partition_key=True)
+    job_id                  = Integer(primary_key=True, clustering_order="DESC")
+    name                    = Text()
+    user_id                 = Integer()
+    account                 = Text()
+    partition               = Text()
+    job_state               = Text()
+    state_reason            = Text()
+    num_cpus                = Integer()
+    num_nodes               = Integer()
+    nodes                   = Text()
+    submit_time             = BigInt()
+    start_time              = BigInt()
+    end_time                = BigInt()
+    exit_code               = Text()
+    last_modified           = BigInt()
+
+    @staticmethod
+    def keys_of(job_id:int, placement:tuple) -> list:
+        bucket, _user_id, _partition, _job_state, nodes = placement
+        return [{'node': node, 'bucket': bucket, 'job_id': job_id} for node in expand_nodes(nodes)]
+
+
+JobsByNode.codec = RowCodec(JobsByNode)
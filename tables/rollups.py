@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+#
+# Usage rollups: counters of the jobs per user, account and partition
+# and hour, incremented by the collector of jobs (see rollup.py)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+from cassandra.cqlengine.models import Model
+from cassandra.cqlengine.columns import *
+
+HOUR_SECONDS = 3600
+
+# dimensions of the rollups, with the column of Jobs keying each one
+DIMENSIONS = {
+    'user': 'user_id',
+    'account': 'account',
+    'partition': 'partition',
+}
+
+# counters of a rollup row, in the column order of the accumulators
+COUNTERS = ('core_seconds', 'jobs_started', 'jobs_ended', 'wait_seconds')
+
+
+def hour_of(timestamp:float) -> int:
+    return int(timestamp // HOUR_SECONDS)
+
+
+class UsageRollup(Model):
+    """
+    Usage of the jobs of a user, account or partition (name) in an hour:
+    core-seconds allocated in the hour, jobs started and ended in it, and
+    the queue wait (start - submit) of the started ones. A day of a
+    dimension is a single partition
+    """
+    __table_name__          = "usage_rollups"
+
+    dimension               = Text(partition_key=True)
+    day                     = Integer(partition_key=True)
+    hour                    = Integer(primary_key=True, clustering_order="ASC")
+    name                    = Text(primary_key=True)
+    core_seconds            = Counter()
+    jobs_started            = Counter()
+    jobs_ended              = Counter()
+    wait_seconds            = Counter()
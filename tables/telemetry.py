@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#
+# Node telemetry: min, max, mean and last value of the metrics of a node
+# per window, aggregated from the samples kept in memory by the telemetry
+# sampler (see telemetry.py)
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+from cassandra.cqlengine.models import Model
+from cassandra.cqlengine.columns import *
+
+from .codec import RowCodec
+
+# sampled metrics of a node (watts is the current_watts of its energy)
+TELEMETRY_METRICS = ('cpu_load', 'free_mem', 'alloc_cpus', 'alloc_mem', 'watts')
+
+AGGREGATES = ('min', 'max', 'mean', 'last')
+
+
+class NodeTelemetry(Model):
+    """
+    Aggregates of the samples of a node in a window (window seconds from
+    window_start), a day of a node is a single partition (see history.bucket_of)
+    """
+    __table_name__          = "node_telemetry"
+
+    name                    = Text(partition_key=True)
+    bucket                  = Integer(partition_key=True)
+    window_start            = BigInt(primary_key=True, clustering_order="ASC")
+    window                  = Integer()
+    samples                 = Integer()
+    cpu_load_min            = Double()
+    cpu_load_max            = Double()
+    cpu_load_mean           = Double()
+    cpu_load_last           = Double()
+    free_mem_min            = Double()
+    free_mem_max            = Double()
+    free_mem_mean           = Double()
+    free_mem_last           = Double()
+    alloc_cpus_min          = Double()
+    alloc_cpus_max          = Double()
+    alloc_cpus_mean         = Double()
+    alloc_cpus_last         = Double()
+    alloc_mem_min           = Double()
+    alloc_mem_max           = Double()
+    alloc_mem_mean          = Double()
+    alloc_mem_last          = Double()
+    watts_min               = Double()
+    watts_max               = Double()
+    watts_mean              = Double()
+    watts_last              = Double()
+    last_modified           = BigInt()
+
+
+NodeTelemetry.codec = RowCodec(NodeTelemetry)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#
+# High frequency telemetry of the nodes: the metrics of every node are
+# sampled into a numpy ring in memory, and only the aggregates of each
+# window (min, max, mean and last) are written to cassandra
+# (tables/telemetry.py), so the sampling rate doesn't set the write rate.
+# The raw samples of the ring are served locally (see recent())
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+from checkpoint import require_numpy
+from metrics import REGISTRY, Registry, TelemetryMetrics
+from tables.codec import stamp
+from tables.history import bucket_of
+from tables.telemetry import AGGREGATES, TELEMETRY_METRICS, NodeTelemetry
+from writer import BatchWriter, WriteError
+
+
+def metrics_of(data:dict) -> list:
+    """
+    Sampled metrics of a node (pyslurm dict), None when slurm doesn't report them
+    """
+    energy = data.get('energy') or {}
+    return [data.get('cpu_load'), data.get('free_mem'), data.get('alloc_cpus'), data.get('alloc_mem'),
+            energy.get('current_watts')]
+
+
+def _grown(values:'np.ndarray', rows:int, fill) -> 'np.ndarray':
+    return np.concatenate([values, np.full((rows, *values.shape[1:]), fill, dtype=values.dtype)])
+
+
+class Telemetry:
+    """
+    Samples of the metrics of the nodes, one per tick: the last capacity
+    samples of every node are kept in a ring (samples x nodes x metrics),
+    and the min, max, sum, count and last value of every node in the
+    current window are accumulated as they're taken.
+
+    Once a window is over, its aggregates are written as a row per node,
+    the rows of partitions whose write failed are sent again with the
+    aggregates of the next window
+    """
+    def __init__(self, source:Callable[[], Dict[Any, dict]], writer:BatchWriter = None,
+                 window:int = 60, capacity:int = 600, nodes:int = 64,
+                 name:str = 'nodes', registry:Registry = REGISTRY):
+        require_numpy("the node telemetry")
+
+        self.source = source
+        self.writer = writer or BatchWriter()
+        self.window = window
+        self.metrics = TelemetryMetrics(name, registry)
+
+        # node name -> column of the arrays
+        self.columns = {}
+        self.names = []
+
+        # ring of samples, head is the position of the next one
+        self.times = np.full(capacity, np.nan)
+        self.ring = np.full((capacity, nodes, len(TELEMETRY_METRICS)), np.nan, dtype=np.float32)
+        self.head = 0
+
+        # accumulators of the current window (nodes x metrics)
+        self.window_start = None
+        self.seen = np.zeros(nodes, dtype=np.int64)
+        self.mins = np.full((nodes, len(TELEMETRY_METRICS)), np.nan)
+        self.maxs = np.full((nodes, len(TELEMETRY_METRICS)), np.nan)
+        self.sums = np.zeros((nodes, len(TELEMETRY_METRICS)))
+        self.counts = np.zeros((nodes, len(TELEMETRY_METRICS)), dtype=np.int64)
+        self.lasts = np.full((nodes, len(TELEMETRY_METRICS)), np.nan)
+
+        # rows of the windows that are over, not written yet
+        self.pending = []
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self) -> int:
+        return len(self.times)
+
+    def _column(self, name:str) -> int:
+        column = self.columns.get(name)
+        if column is not None:
+            return column
+
+        column = self.columns[name] = len(self.names)
+        self.names.append(name)
+        if column == len(self.seen):
+            grow = max(column, 8)
+            self.ring = np.concatenate([self.ring, np.full((self.capacity, grow, len(TELEMETRY_METRICS)),
+                                                           np.nan, dtype=np.float32)], axis=1)
+            self.seen, self.counts, self.sums = (_grown(values, grow, 0)
+                                                 for values in (self.seen, self.counts, self.sums))
+            self.mins, self.maxs, self.lasts = (_grown(values, grow, np.nan)
+                                                for values in (self.mins, self.maxs, self.lasts))
+        return column
+
+    def sample(self, now:float = None):
+        """
+        Take a sample of every node
+        """
+        now = now or time.time()
+        data = self.source()
+
+        with self._lock:
+            window_start = int(now // self.window) * self.window
+            if self.window_start is not None and window_start != self.window_start:
+                self._close()
+            self.window_start = window_start
+
+            columns = [self._column(name) for name in data]
+            values = np.array([metrics_of(node) for node in data.values()],
+                              dtype=float).reshape(len(columns), len(TELEMETRY_METRICS))
+
+            sample = np.full(self.ring.shape[1:], np.nan, dtype=np.float32)
+            sample[columns] = values
+            self.ring[self.head] = sample
+            self.times[self.head] = now
+            self.head = (self.head + 1) % self.capacity
+
+            present = ~np.isnan(values)
+            self.seen[columns] += 1
+            self.counts[columns] += present
+            self.sums[columns] += np.where(present, values, 0)
+            self.mins[columns] = np.fmin(self.mins[columns], values)
+            self.maxs[columns] = np.fmax(self.maxs[columns], values)
+            self.lasts[columns] = np.where(present, values, self.lasts[columns])
+
+        self.metrics.samples.inc()
+        self.metrics.nodes.set(len(data))
+
+    def _close(self):
+        """
+        Queue the aggregates of the current window and reset them
+        """
+        start = self.window_start
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.sums / self.counts
+        aggregates = dict(zip(AGGREGATES, (self.mins, self.maxs, means, self.lasts)))
+
+        rows = []
+        for column in np.flatnonzero(self.seen).tolist():
+            row = {'name': self.names[column], 'bucket': bucket_of(start), 'window_start': start,
+                   'window': self.window, 'samples': int(self.seen[column])}
+            for index, metric in enumerate(TELEMETRY_METRICS):
+                known = self.counts[column, index] > 0
+                for aggregate, values in aggregates.items():
+                    row[f"{metric}_{aggregate}"] = float(values[column, index]) if known else None
+            rows.append(row)
+        self.pending.extend(rows)
+
+        self.seen[:] = 0
+        self.counts[:] = 0
+        self.sums[:] = 0
+        self.mins[:], self.maxs[:], self.lasts[:] = np.nan, np.nan, np.nan
+
+    def flush(self):
+        """
+        Write the aggregates of the windows that are over
+        """
+        with self._lock:
+            rows, self.pending = self.pending, []
+        if not rows:
+            return
+
+        last_modified = stamp()
+        for row in rows:
+            self.writer.insert(NodeTelemetry, dict(row, last_modified=last_modified))
+
+        start = time.monotonic()
+        try:
+            self.writer.flush()
+            failed = set()
+        except WriteError as error:
+            logging.error(f"Telemetry: {error}")
+            failed = {key for model, key in error.failed}
+        self.metrics.flush.observe(time.monotonic() - start)
+
+        kept = [row for row in rows if (row['name'], row['bucket']) in failed]
+        self.metrics.written.inc(len(rows) - len(kept))
+        if kept:
+            self.metrics.failed.inc(len(kept))
+            with self._lock:
+                self.pending[:0] = kept
+
+    def tick(self):
+        self.sample()
+        self.flush()
+
+    def recent(self, name:str, seconds:float = None) -> List[list]:
+        """
+        Raw samples of a node in the ring (of the last seconds), oldest first:
+        [time, *metrics] with None for the metrics slurm didn't report
+        """
+        with self._lock:
+            column = self.columns.get(name)
+            if column is None:
+                return []
+
+            order = (np.arange(self.capacity) + self.head) % self.capacity
+            times = self.times[order]
+            keep = ~np.isnan(times)
+            if seconds is not None:
+                keep &= times >= time.time() - seconds
+            samples = self.ring[order[keep], column]
+            times = times[keep]
+
+        # samples the node wasn't in
+        present = ~np.isnan(samples).all(axis=1)
+        samples, times = samples[present], times[present]
+
+        return [[timestamp, *(None if np.isnan(value) else float(value) for value in values)]
+                for timestamp, values in zip(times.tolist(), samples)]
+
+    def handle(self, params:Dict[str, List[str]]) -> dict:
+        """
+        Route of the metrics endpoint: /telemetry lists the sampled nodes,
+        /telemetry?node=NAME[&seconds=S] returns the recent samples of a node
+        """
+        if 'node' not in params:
+            with self._lock:
+                return {'nodes': list(self.names)}
+
+        seconds = float(params['seconds'][0]) if 'seconds' in params else None
+        return {'metrics': ['time', *TELEMETRY_METRICS],
+                'samples': {name: self.recent(name, seconds) for name in params['node']}}
+
+    def close(self):
+        # the window in progress is written as it is
+        with self._lock:
+            if self.window_start is not None and self.seen.any():
+                self._close()
+        self.flush()
+        self.writer.close()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+#
+# Write-behind queue between the collectors and cassandra: writes are
+# queued and coalesced per primary key, and a consumer thread drains
+# them, so a slow cassandra doesn't stall the pollers
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import REGISTRY, QueueMetrics, Registry
+from writer import BatchWriter, WriteError, partition_key
+
+
+def primary_key(model, values:dict) -> tuple:
+    return tuple(values[name] for name in model._primary_keys)
+
+
+def merge(entry:list, kind:str, values:dict):
+    """
+    Merge a write into the [kind, values] of a queued write of the same row
+    """
+    if kind == 'delete' or entry[0] == 'delete':
+        # the last one wins (the rows deleted are the ones of the query
+        # tables, which are always inserted whole)
+        entry[0], entry[1] = kind, dict(values)
+        return
+
+    # an insert writes every column, so the merged write is one too, unless
+    # it clears some (the null cells left are the ones of updates, which
+    # inserts don't write, see StatementCache.insert)
+    entry[1].update(values)
+    if None in entry[1].values():
+        entry[0] = 'update'
+    elif kind == 'insert':
+        entry[0] = kind
+
+
+def send(writer, kind:str, model, values:dict):
+    """
+    Hand a queued write (values holding the primary key) to a BatchWriter
+    """
+    if kind == 'insert':
+        writer.insert(model, values)
+    elif kind == 'delete':
+        writer.delete(model, values)
+    else:
+        key = {name: values[name] for name in model._primary_keys}
+        cols = {name: value for name, value in values.items() if name not in key}
+        writer.update(model, key, cols)
+
+
+class WriteBehindWriter:
+    """
+    Writer with the API of BatchWriter whose flush doesn't wait for
+    cassandra. Pending writes are kept in a bounded queue with one entry
+    per (model, primary key), and a consumer thread sends them through a
+    BatchWriter.
+
+    A write to a key that is still queued is merged into its entry (an
+    update adds its columns, an insert its row, a delete replaces it),
+    so an entity that
+    changes several times while cassandra lags behind is written once.
+    Entries wait at least linger seconds before being written, unless
+    the queue is full.
+
+    When max_pending keys are queued, insert and update block until the
+    consumer makes room (backpressure). Writes that failed are reported
+    by the next flush (or join) as a WriteError
+    """
+    def __init__(self, writer:BatchWriter = None, max_pending:int = 100000, linger:float = 0,
+                 batch_size:int = 5000, name:str = 'default', registry:Registry = REGISTRY):
+        self.writer = writer or BatchWriter()
+        self.max_pending = max_pending
+        self.linger = linger
+        self.batch_size = batch_size
+        self.name = name
+        self.metrics = QueueMetrics(name, registry)
+
+        # (model, primary key) -> [kind, values (primary key included), queued at]
+        self._pending = OrderedDict()
+        self._in_flight = 0
+        self._failed = []
+        self._joining = 0
+        self._closed = False
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+
+        self._consumer = threading.Thread(target=self._consume, name=f"{name}_writer", daemon=True)
+        self._consumer.start()
+
+    def insert(self, model, row:dict):
+        self._put('insert', model, row)
+
+    def update(self, model, key:dict, cols:dict):
+        self._put('update', model, dict(key, **cols))
+
+    def delete(self, model, key:dict):
+        self._put('delete', model, key)
+
+    def _put(self, kind:str, model, values:dict):
+        if kind == 'insert':
+            values = {name: value for name, value in values.items() if value is not None}
+        group = (model, primary_key(model, values))
+        blocked = None
+        with self._lock:
+            if self._closed:
+                raise Exception(f"Write-behind queue {self.name} is closed")
+
+            while True:
+                entry = self._pending.get(group)
+                if entry is not None:
+                    merge(entry, kind, values)
+                    self.metrics.coalesced.inc()
+                    break
+
+                if len(self._pending) < self.max_pending:
+                    self._pending[group] = [kind, dict(values), time.monotonic()]
+                    self._not_empty.notify()
+                    break
+
+                if blocked is None:
+                    blocked = time.monotonic()
+                self._not_full.wait()
+
+            self.metrics.depth.set(len(self._pending))
+
+        if blocked is not None:
+            self.metrics.blocked.inc(time.monotonic() - blocked)
+
+    def _take(self) -> list:
+        """
+        Wait for the next entries to write, None once closed and drained
+        """
+        with self._lock:
+            while True:
+                timeout = None
+                if self._pending:
+                    now = time.monotonic()
+                    urgent = self._closed or self._joining or len(self._pending) >= self.max_pending
+
+                    batch = []
+                    while self._pending and len(batch) < self.batch_size:
+                        group, entry = next(iter(self._pending.items()))
+                        if not urgent and now - entry[2] < self.linger:
+                            timeout = self.linger - (now - entry[2])
+                            break
+                        del self._pending[group]
+                        batch.append((group, entry))
+
+                    if batch:
+                        self._in_flight = len(batch)
+                        self.metrics.depth.set(len(self._pending))
+                        self.metrics.in_flight.set(self._in_flight)
+                        self._not_full.notify_all()
+                        return batch
+
+                elif self._closed:
+                    return None
+
+                self._not_empty.wait(timeout)
+
+    def _write(self, batch:list) -> list:
+        failed = []
+        for (model, primary), (kind, values, _queued) in batch:
+            try:
+                send(self.writer, kind, model, values)
+            except Exception as error:
+                logging.error(f"Unable to write {model.__name__} {primary}: {error}")
+                failed.append((model, partition_key(model, values)))
+
+        try:
+            self.writer.flush()
+        except WriteError as error:
+            failed.extend(error.failed)
+        return failed
+
+    def _consume(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+
+            start = time.monotonic()
+            failed = self._write(batch)
+            self.metrics.flush.observe(time.monotonic() - start)
+            self.metrics.written.inc(len(batch))
+            self.metrics.failed.inc(len(failed))
+
+            with self._lock:
+                self._failed.extend(failed)
+                self._in_flight = 0
+                self.metrics.in_flight.set(0)
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def _raise_failed(self):
+        with self._lock:
+            failed, self._failed = self._failed, []
+        if failed:
+            raise WriteError(f"{len(failed)} writes failed", failed)
+
+    def flush(self):
+        """
+        Hand the queued writes to the consumer (without waiting for them),
+        raise the writes that failed since the last flush
+        """
+        with self._lock:
+            self._not_empty.notify()
+        self._raise_failed()
+
+    def join(self, timeout:float = None) -> bool:
+        """
+        Wait until every queued write was sent (ignoring linger),
+        return False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._joining += 1
+            self._not_empty.notify()
+            try:
+                while self._pending or self._in_flight:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._idle.wait(remaining)
+            finally:
+                self._joining -= 1
+
+        self._raise_failed()
+        return True
+
+    def close(self, timeout:float = None):
+        """
+        Write what is left in the queue and stop the consumer
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        self._consumer.join(timeout)
+
+        if self._pending or self._consumer.is_alive():
+            logging.error(f"Write-behind queue {self.name} closed with {len(self._pending)} writes pending")
+        try:
+            self._raise_failed()
+        except WriteError as error:
+            logging.error(f"Write-behind queue {self.name}: {error}")
+        self.writer.close()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# Write paths used by the collectors to persist rows in cassandra
+#
+# Maintainer: glozanoa <glozanoa@uni.pe>
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+# THESE IMPORTS NEED OF cassandra-driver PYTHON PACKAGE
+from cassandra.cqlengine import connection
+from cassandra.query import BatchStatement, BatchType
+
+from statements import StatementCache
+
+
+class WriteError(Exception):
+    """
+    Some writes of a flush failed, failed holds (model, partition key) pairs
+    """
+    def __init__(self, message:str, failed:List[Tuple]):
+        super().__init__(message)
+        self.failed = failed
+
+
+def partition_key(model, values:dict) -> tuple:
+    return tuple(values[name] for name in model._partition_keys)
+
+
+def batch_of(statements:list, counter:bool = False) -> tuple:
+    """
+    Statement and params sending the bound statements of a partition
+    (an unlogged batch when there are several of them, a counter batch
+    for the updates of counters)
+    """
+    if len(statements) == 1:
+        return statements[0]
+
+    batch = BatchStatement(batch_type=BatchType.COUNTER if counter else BatchType.UNLOGGED)
+    for prepared, params in statements:
+        batch.add(prepared, params)
+    return batch, None
+
+
+class ModelWriter:
+    """
+    Write rows of a table through cqlengine, one synchronous statement per row
+    """
+    def __init__(self):
+        self._failed = []
+
+    def insert(self, model, row:dict):
+        try:
+            model.create(**row)
+        except Exception as error:
+            logging.error(error)
+            self._failed.append((model, partition_key(model, row)))
+
+    def update(self, model, key:dict, cols:dict):
+        try:
+            model.objects.filter(**key).update(**cols)
+        except Exception as error:
+            logging.error(error)
+            self._failed.append((model, partition_key(model, key)))
+
+    def delete(self, model, key:dict):
+        try:
+            model.objects.filter(**key).delete()
+        except Exception as error:
+            logging.error(error)
+            self._failed.append((model, partition_key(model, key)))
+
+    def flush(self):
+        failed, self._failed = self._failed, []
+        if failed:
+            raise WriteError(f"{len(failed)} writes failed", failed)
+
+    def close(self):
+        pass
+
+
+class BatchWriter:
+    """
+    Group the writes of a tick by partition key and send each group
+    asynchronously (as an unlogged batch when it holds several statements),
+    capping the number of in-flight requests
+    """
+    def __init__(self, session = None, max_in_flight:int = 128):
+        self._session = session
+        self.max_in_flight = max_in_flight
+
+        # (model, partition key) -> [(prepared statement, params), ...]
+        self._pending = OrderedDict()
+        self._statements = {}
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._done = threading.Condition()
+        self._outstanding = 0
+        self._failed = []
+
+    @property
+    def session(self):
+        # resolved on first use, so a writer can be built while cassandra is down
+        if self._session is None:
+            self._session = connection.get_session()
+        return self._session
+
+    def statements(self, model) -> StatementCache:
+        cache = self._statements.get(model)
+        if cache is None:
+            cache = self._statements[model] = StatementCache(self.session, model)
+        return cache
+
+    def insert(self, model, row:dict):
+        self._add(model, row, self.statements(model).insert(row))
+
+    def update(self, model, key:dict, cols:dict):
+        self._add(model, key, self.statements(model).update(key, cols))
+
+    def delete(self, model, key:dict):
+        self._add(model, key, self.statements(model).delete(key))
+
+    def increment(self, model, key:dict, cols:dict):
+        """
+        Add cols to the counters of a row (of a table of counters)
+        """
+        self._add(model, key, self.statements(model).increment(key, cols))
+
+    def _add(self, model, values:dict, bound:tuple):
+        group = (model, partition_key(model, values))
+        self._pending.setdefault(group, []).append(bound)
+
+    def _send(self, group, statements):
+        statement, params = batch_of(statements, group[0]._has_counter)
+
+        self._slots.acquire()
+        with self._done:
+            self._outstanding += 1
+
+        try:
+            future = self.session.execute_async(statement, params)
+        except Exception as error:
+            self._on_error(error, group)
+            return
+
+        future.add_callbacks(self._on_success, self._on_error, errback_args=(group,))
+
+    def _release(self):
+        self._slots.release()
+        with self._done:
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._done.notify_all()
+
+    def _on_success(self, _rows):
+        self._release()
+
+    def _on_error(self, error, group):
+        logging.error(f"Unable to write {group[0].__name__} {group[1]}: {error}")
+        self._failed.append(group)
+        self._release()
+
+    def flush(self):
+        """
+        Send every pending write and wait until all of them were acknowledged
+        """
+        pending, self._pending = self._pending, OrderedDict()
+        for group, statements in pending.items():
+            self._send(group, statements)
+
+        with self._done:
+            while self._outstanding:
+                self._done.wait()
+
+        failed, self._failed = self._failed, []
+        if failed:
+            raise WriteError(f"{len(failed)} writes failed", failed)
+
+    def close(self):
+        pass